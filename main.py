@@ -1,17 +1,28 @@
 
 from telegram import Chat, Message, Update, BotCommand, BotCommandScopeAllPrivateChats, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatMemberStatus, ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes, filters
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, ChatJoinRequestHandler, ContextTypes, filters
 
 import threading
 import os
+import sys
+import signal
+import atexit
+import queue
+import secrets
+import multiprocessing
+from multiprocessing.managers import BaseManager
+import time
 import re
 import html
 import logging
-from collections import defaultdict
-from datetime import datetime, timedelta, timezone
+import logging.handlers
+from collections import OrderedDict, defaultdict, deque
+from datetime import datetime, time as dtime, timedelta, timezone
 
-from flask import Flask
+from flask import Flask, jsonify, request
 
 try:
     from waitress import serve  # production-grade WSGI server (Railway uchun tavsiya)
@@ -19,10 +30,21 @@ except Exception:
     serve = None
 
 # --- New (Postgres) ---
+import abc
 import asyncio
+import contextvars
+import heapq
+import itertools
 import json
+import gzip
+import hashlib
+import dataclasses
+import contextlib
 import ssl
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from functools import lru_cache, partial, wraps
 from typing import List, Optional
 
 try:
@@ -90,6 +112,42 @@ app_flask = Flask(__name__)
 def home():
     return "Bot ishlayapti!"
 
+# Bot event loop'i (post_init'da olinadi). /metrics Flask thread'ida ishlaydi, shuning uchun
+# loop ichida o'zgaradigan holat (OUTBOX, batcher, trace deque'lari, breaker) snapshot'i
+# loop'ning o'zida olinadi — aks holda o'qish paytida dict/deque o'zgarib ketishi mumkin.
+_APP_LOOP: asyncio.AbstractEventLoop | None = None
+METRICS_TIMEOUT_SEC = float(os.getenv("METRICS_TIMEOUT_SEC", "2"))
+
+@app_flask.route("/metrics")
+def metrics():
+    loop = _APP_LOOP
+    if loop is None or not loop.is_running():
+        return jsonify(_metrics_snapshot())
+
+    async def snap():
+        return _metrics_snapshot()
+
+    try:
+        data = asyncio.run_coroutine_threadsafe(snap(), loop).result(METRICS_TIMEOUT_SEC)
+    except Exception as e:
+        return jsonify({"error": f"metrics snapshot: {e!r}"}), 503
+    return jsonify(data)
+
+def _metrics_snapshot() -> dict:
+    return {
+        "outbox": {"depth": OUTBOX.depth(), **OUTBOX.stats},
+        "delete_batcher": dict(DELETE_BATCHER.stats),
+        "channel_index": dict(_CHANNEL_INDEX_STATS),
+        "verdict_cache": {"size": len(_VERDICT_CACHE), **_VERDICT_STATS},
+        "db": {"state": DB_BREAKER.state, "replay_queue": len(_DB_REPLAY), **DB_BREAKER.stats},
+        "cache": {
+            "local": {"size": CACHE_L1._store.size(), **CACHE_L1.stats},
+            "shared": dict(CACHE_L2.stats) if CACHE_L2 is not None else None,
+        },
+        "logs": {"suppressed": LOG_LIMITER.suppressed_total},
+        "trace": trace_metrics(),
+    }
+
 def run_web():
     port = int(os.getenv("PORT", "8080"))
     if serve:
@@ -105,16 +163,111 @@ def start_web():
     if enable is None:
         enable = "1" if os.getenv("PORT") else "0"
     if str(enable).strip() in ("1", "true", "True", "yes", "YES"):
-        threading.Thread(target=run_web, daemon=True).start()
+        threading.Thread(target=run_web, daemon=True, name="web").start()
 
 
 # ---------------------- Config ----------------------
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Log yozuvlari event loop'ni to'xtatmasin: handler faqat navbatga qo'yadi, formatlash va
+# stderr'ga yozish QueueListener thread'ida. Bir xil shablonli xabarlar (masalan API
+# hodisasi paytidagi "Restrict failed") LOG_RATE_WINDOW_SEC ichida LOG_RATE_BURST tadan
+# ortiq o'tkazilmaydi; tashlab yuborilganlar soni keyingi xabarda yoki davriy xulosada.
+# LOG_FORMAT=json — har bir yozuv bitta JSON qator.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_RATE_WINDOW_SEC = float(os.getenv("LOG_RATE_WINDOW_SEC", "10"))
+LOG_RATE_BURST = int(os.getenv("LOG_RATE_BURST", "5"))
+
+class _LogRateLimit(logging.Filter):
+    """(logger, level, shablon) kaliti bo'yicha oyna ichida LOG_RATE_BURST tadan ortig'ini tashlash."""
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self.window, self.burst = window, burst
+        self._keys: dict[tuple, list] = {}  # key -> [oyna boshi, o'tkazilgan, tashlangan]
+        self._lock = threading.Lock()
+        self.suppressed_total = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.exc_info:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            st = self._keys.get(key)
+            if st is None or now - st[0] >= self.window:
+                if len(self._keys) > 10000:
+                    self._keys.clear()
+                record.suppressed = st[2] if st else 0
+                self._keys[key] = [now, 1, 0]
+                return True
+            if st[1] < self.burst:
+                st[1] += 1
+                record.suppressed = 0
+                return True
+            st[2] += 1
+            self.suppressed_total += 1
+            return False
+
+    def flush(self, logger: logging.Logger):
+        """Oynasi tugagan, lekin keyingi xabari kelmagan kalitlar uchun xulosa."""
+        now = time.monotonic()
+        with self._lock:
+            due = [(k, st[2]) for k, st in self._keys.items() if st[2] and now - st[0] >= self.window]
+            for k, _ in due:
+                del self._keys[k]
+        for (name, level, msg), count in due:
+            logger.log(level, "%s ta \"%s\" xabari o'tkazib yuborildi (%s logger).", count, msg, name)
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # Standart prepare() xabarni chaqiruvchi thread'da formatlaydi; navbat jarayon ichida,
+    # shuning uchun record o'zi uzatiladi va listener thread'ida formatlanadi.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" (+{record.suppressed} ta shunday xabar o'tkazib yuborilgan)"
+        return line
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        if getattr(record, "suppressed", 0):
+            data["suppressed"] = record.suppressed
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+def setup_logging() -> "_LogRateLimit":
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(_JsonFormatter())
+    else:
+        handler.setFormatter(_TextFormatter("%(asctime)s - %(levelname)s - %(message)s"))
+    q = queue.SimpleQueue()
+    qh = _LazyQueueHandler(q)
+    limiter = _LogRateLimit(LOG_RATE_WINDOW_SEC, LOG_RATE_BURST)
+    qh.addFilter(limiter)
+    root = logging.getLogger()
+    root.handlers[:] = [qh]
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return limiter
+
+LOG_LIMITER = setup_logging()
 log = logging.getLogger(__name__)
 
 TOKEN = os.getenv("TOKEN")
-if not TOKEN:
-    raise RuntimeError("TOKEN env o'rnatilmagan. Railway Variables ga TOKEN=... qo'ying.")
 def _parse_admin_ids(raw: str) -> set[int]:
     ids: set[int] = set()
     for part in re.split(r"[,\s]+", (raw or "").strip()):
@@ -139,9 +292,35 @@ KANAL_USERNAME = None
 MAJBUR_LIMIT = 0
 FOYDALANUVCHI_HISOBI = defaultdict(int)
 RUXSAT_USER_IDS = set()
-BLOK_VAQTLARI = {}  # (chat_id, user_id) -> until_datetime (UTC)
-MAJBUR_WARN_MSG_IDS = {}  # (chat_id, user_id) -> last warning message_id
-KANAL_WARN_MSG_IDS = {}   # (chat_id, user_id) -> last warning message_id
+BLOK_VAQTLARI = {}  # _pk(chat_id, user_id) -> until_datetime (UTC)
+MAJBUR_WARN_MSG_IDS = {}  # _pk(chat_id, user_id) -> _warn_pack(message_id, sent_at)
+KANAL_WARN_MSG_IDS = {}   # _pk(chat_id, user_id) -> _warn_pack(message_id, sent_at)
+
+# Janitor: eskirgan blok/ogohlantirish yozuvlarini davriy tozalash (JobQueue)
+JANITOR_INTERVAL_SEC = int(os.getenv("JANITOR_INTERVAL_SEC", "300"))
+WARN_MSG_TTL_SEC = int(os.getenv("WARN_MSG_TTL_SEC", str(48 * 3600)))  # 48 soatdan keyin Telegram baribir o'chirtirmaydi
+
+_PK_SHIFT = 64
+_PK_MASK = (1 << _PK_SHIFT) - 1
+
+def _pk(chat_id: int, user_id: int) -> int:
+    """(chat_id, user_id) juftini bitta int kalitga joylash (tuple'dan ancha ixcham)."""
+    return (chat_id << _PK_SHIFT) | user_id
+
+def _pk_chat(key: int) -> int:
+    return key >> _PK_SHIFT
+
+def _warn_pack(message_id: int, sent_at: float) -> int:
+    return (int(sent_at) << 32) | message_id
+
+def _warn_get(d: dict, key: int) -> int | None:
+    v = d.get(key)
+    return (v & 0xFFFFFFFF) if v is not None else None
+
+def _warn_put(d: dict, key: int, message_id: int):
+    # pop + qayta yozish: dict tartibi yuborilgan vaqt bo'yicha qoladi (janitor uchun)
+    d.pop(key, None)
+    d[key] = _warn_pack(message_id, time.time())
 
 # ✅ To'liq yozish ruxsatlari (guruh sozlamalari ruxsat bergan taqdirda)
 FULL_PERMS = ChatPermissions(
@@ -544,6 +723,142 @@ UYATLI_SOZLAR = {
 SUSPECT_KEYWORDS = {"open game", "play", "играть", "открыть игру", "game", "cattea", "gamee", "hamster", "notcoin", "tap to earn", "earn", "clicker"}
 SUSPECT_DOMAINS = {"cattea", "gamee", "hamster", "notcoin", "tgme", "t.me/gamee", "textra.fun", "ton"}
 
+# ----------- Update tracing: bosqichlar bo'yicha latency -----------
+# Har bir update uchun _Trace (contextvar): handler'lar, belgilangan bosqichlar (mod_ctx,
+# privileged, channels), har bir Bot API chaqiruvi (api:<method>), DB ulanishi (db) va
+# OUTBOX navbatida kutish (outbox_wait) vaqti yig'iladi. Bosqichlar ichma-ich bo'lishi
+# mumkin (handler vaqti uning ichidagi api/db'ni ham o'z ichiga oladi).
+# TRACE_SLOW_MS dan sekin update'lar to'liq taqsimoti bilan log qilinadi; /metrics da
+# har bir bosqich uchun oxirgi TRACE_SAMPLES ta o'lchovning p50/p99 qiymati.
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1").strip() not in ("0", "false", "no")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_SAMPLES = int(os.getenv("TRACE_SAMPLES", "1024"))
+
+_TRACE: contextvars.ContextVar["_Trace | None"] = contextvars.ContextVar("trace", default=None)
+_TRACE_SAMPLES: dict[str, deque] = {}
+_TRACE_COUNTS: dict[str, int] = defaultdict(int)
+
+def _trace_observe(stage: str, value: float):
+    dq = _TRACE_SAMPLES.get(stage)
+    if dq is None:
+        dq = _TRACE_SAMPLES[stage] = deque(maxlen=TRACE_SAMPLES)
+    dq.append(value)
+    _TRACE_COUNTS[stage] += 1
+
+class _Trace:
+    __slots__ = ("update_id", "start", "stages", "api_calls", "db_calls")
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.start = time.perf_counter()
+        self.stages: dict[str, list] = {}  # stage -> [jami sekund, chaqiruvlar soni]
+        self.api_calls = 0
+        self.db_calls = 0
+
+    def add(self, stage: str, seconds: float):
+        st = self.stages.get(stage)
+        if st is None:
+            self.stages[stage] = [seconds, 1]
+        else:
+            st[0] += seconds
+            st[1] += 1
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        _trace_observe("total", total)
+        _trace_observe("calls:api", self.api_calls)
+        _trace_observe("calls:db", self.db_calls)
+        for stage, (seconds, _) in self.stages.items():
+            _trace_observe(stage, seconds)
+        if total * 1000 >= TRACE_SLOW_MS:
+            breakdown = ", ".join(
+                f"{stage}={seconds * 1000:.0f}ms×{n}"
+                for stage, (seconds, n) in sorted(self.stages.items(), key=lambda kv: -kv[1][0])
+            )
+            log.warning(
+                "Sekin update %s: %.0f ms (api=%s, db=%s) — %s",
+                self.update_id, total * 1000, self.api_calls, self.db_calls, breakdown,
+            )
+
+def traced(stage: str):
+    """Async funksiya vaqtini joriy update trace'iga `stage` nomi bilan yozish."""
+    def deco(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            tr = _TRACE.get()
+            if tr is None:
+                return await fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                tr.add(stage, time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+def _detached_task(coro) -> asyncio.Task:
+    # Fon vazifalari (dispatcher, batcher) ularni birinchi yaratgan update trace'ini meros olmasin
+    return contextvars.Context().run(asyncio.get_running_loop().create_task, coro)
+
+class _TracedApplication(Application):
+    async def process_update(self, update: object) -> None:
+        if not TRACE_ENABLED:
+            return await super().process_update(update)
+        tr = _Trace(getattr(update, "update_id", None))
+        token = _TRACE.set(tr)
+        try:
+            await super().process_update(update)
+        finally:
+            _TRACE.reset(token)
+            tr.finish()
+
+class _TracedRequest(HTTPXRequest):
+    """Har bir Bot API chaqiruvini (metod nomi bo'yicha) joriy trace'ga yozadi."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        tr = _TRACE.get()
+        if tr is None:
+            return await super().do_request(url, method, *args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            tr.api_calls += 1
+            tr.add("api:" + url.rsplit("/", 1)[-1], time.perf_counter() - t0)
+
+def _trace_handlers(app):
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = traced(h.callback.__name__)(h.callback)
+
+def _percentile(sorted_vals: list, q: float):
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+def trace_metrics() -> dict:
+    out = {}
+    for stage, dq in list(_TRACE_SAMPLES.items()):
+        vals = sorted(dq.copy())
+        if not vals:
+            continue
+        if stage.startswith("calls:"):
+            out[stage] = {"n": _TRACE_COUNTS[stage], "p50": _percentile(vals, 0.5), "p99": _percentile(vals, 0.99)}
+        else:
+            out[stage] = {
+                "n": _TRACE_COUNTS[stage],
+                "p50_ms": round(_percentile(vals, 0.5) * 1000, 2),
+                "p99_ms": round(_percentile(vals, 0.99) * 1000, 2),
+            }
+    return out
+
+def new_app_builder() -> ApplicationBuilder:
+    return (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .application_class(_TracedApplication)
+        .request(_TracedRequest(connection_pool_size=256))
+    )
+
+
 # ----------- DM (Postgres-backed) -----------
 SUB_USERS_FILE = "subs_users.json"  # fallback/migration manbasi
 
@@ -555,6 +870,444 @@ def is_owner(update: Update) -> bool:
 # Postgres connection pool
 DB_POOL: Optional["asyncpg.Pool"] = None
 
+# ----------- DB circuit breaker -----------
+# Postgres sekin yoki o'chiq bo'lsa, har bir xabar acquire/timeout kutib qolmasin:
+# oxirgi chaqiruvlarning xato/sekinlik ulushi oshsa breaker "open" bo'ladi va hot-path
+# to'g'ridan-to'g'ri in-memory cache'lardan ishlaydi. DB_BREAKER_OPEN_SEC dan keyin bitta
+# sinov so'rovi o'tkaziladi (half-open); muvaffaqiyatli bo'lsa yana "closed".
+# Bu paytdagi yozishlar _DB_REPLAY navbatiga tushadi va DB tiklanganda tartib bilan bajariladi.
+DB_ACQUIRE_TIMEOUT_SEC = float(os.getenv("DB_ACQUIRE_TIMEOUT_SEC", "2"))
+DB_COMMAND_TIMEOUT_SEC = float(os.getenv("DB_COMMAND_TIMEOUT_SEC", "5"))
+DB_BREAKER_WINDOW = int(os.getenv("DB_BREAKER_WINDOW", "20"))
+DB_BREAKER_MIN_CALLS = int(os.getenv("DB_BREAKER_MIN_CALLS", "5"))
+DB_BREAKER_ERROR_RATE = float(os.getenv("DB_BREAKER_ERROR_RATE", "0.5"))
+DB_BREAKER_SLOW_SEC = float(os.getenv("DB_BREAKER_SLOW_MS", "1000")) / 1000.0
+DB_BREAKER_OPEN_SEC = float(os.getenv("DB_BREAKER_OPEN_SEC", "15"))
+DB_REPLAY_MAX = int(os.getenv("DB_REPLAY_MAX", "10000"))
+DB_REPLAY_TICK_SEC = int(os.getenv("DB_REPLAY_TICK_SEC", "5"))
+
+class _DbBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self._events: deque = deque(maxlen=max(1, DB_BREAKER_WINDOW))  # True = xato yoki sekin
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+        self.stats = {"opened": 0, "rejected": 0, "failures": 0, "slow": 0}
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < DB_BREAKER_OPEN_SEC:
+                self.stats["rejected"] += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_at = 0.0
+        # half-open: bir vaqtda bitta sinov (javobsiz qolgan sinov ham abadiy to'sib qo'ymasin)
+        if self._probe_at and now - self._probe_at < DB_BREAKER_OPEN_SEC:
+            self.stats["rejected"] += 1
+            return False
+        self._probe_at = now
+        return True
+
+    def record(self, ok: bool, latency: float):
+        slow = latency >= DB_BREAKER_SLOW_SEC
+        if not ok:
+            self.stats["failures"] += 1
+        elif slow:
+            self.stats["slow"] += 1
+        bad = (not ok) or slow
+        if self.state == self.HALF_OPEN:
+            if bad:
+                self._open()
+            else:
+                self.state = self.CLOSED
+                self._events.clear()
+                log.info("DB breaker: closed (DB tiklandi).")
+            return
+        if self.state == self.OPEN:
+            return
+        self._events.append(bad)
+        if len(self._events) >= DB_BREAKER_MIN_CALLS and sum(self._events) / len(self._events) >= DB_BREAKER_ERROR_RATE:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._events.clear()
+        self.stats["opened"] += 1
+        log.warning("DB breaker: open — %.0f s davomida in-memory cache'lardan ishlanadi.", DB_BREAKER_OPEN_SEC)
+
+DB_BREAKER = _DbBreaker()
+_DB_REPLAY: deque = deque()  # (label, sql, args) — breaker ochiq paytdagi yozishlar
+
+def db_ready() -> bool:
+    """DB ulangan va breaker so'rov o'tkazadi (hot-path shu bilan tekshiradi)."""
+    return DB_POOL is not None and DB_BREAKER.allow()
+
+@contextlib.asynccontextmanager
+async def db_conn():
+    """DB_POOL.acquire() o'rniga: acquire timeout + natija breaker'ga yoziladi.
+
+    Breaker faqat ulanish/timeout xatolarini muvaffaqiyatsiz deb sanaydi; SQL yoki
+    constraint xatosi DB javob berganini bildiradi, shuning uchun breaker'ni ochmaydi.
+    """
+    start = time.monotonic()
+    tr = _TRACE.get()
+    try:
+        async with DB_POOL.acquire(timeout=DB_ACQUIRE_TIMEOUT_SEC) as con:
+            yield con
+    except Exception as e:
+        DB_BREAKER.record(not _is_transient_db_error(e), time.monotonic() - start)
+        raise
+    finally:
+        if tr is not None:
+            tr.db_calls += 1
+            tr.add("db", time.monotonic() - start)
+    DB_BREAKER.record(True, time.monotonic() - start)
+
+# SQLite OperationalError "no such column"/sintaksis xatolarini ham o'z ichiga oladi — ular
+# qayta urinish bilan tuzalmaydi. Faqat band/qulflangan/IO xatolari vaqtinchalik.
+_SQLITE_TRANSIENT_CODES = (5, 6, 10)  # SQLITE_BUSY, SQLITE_LOCKED, SQLITE_IOERR
+_SQLITE_TRANSIENT_MARKERS = ("database is locked", "database table is locked", "database is busy", "disk i/o error")
+
+def _is_transient_db_error(e: Exception) -> bool:
+    if isinstance(e, sqlite3.OperationalError):
+        code = getattr(e, "sqlite_errorcode", None)
+        if code is not None:
+            return (code & 0xFF) in _SQLITE_TRANSIENT_CODES  # kengaytirilgan kodlar: past bayt asosiy kod
+        return any(m in str(e).lower() for m in _SQLITE_TRANSIENT_MARKERS)
+    if isinstance(e, (OSError, asyncio.TimeoutError)):
+        return True
+    return asyncpg is not None and isinstance(e, (asyncpg.PostgresConnectionError, asyncpg.InterfaceError))
+
+def _queue_db_replay(label: str, sql: str, args: tuple):
+    if len(_DB_REPLAY) >= DB_REPLAY_MAX:
+        _DB_REPLAY.popleft()
+        log.warning("DB replay navbati to'ldi — eng eski yozish tashlab yuborildi.")
+    _DB_REPLAY.append((label, sql, args))
+
+def _db_attaching() -> bool:
+    """Pool hali fonda ulanmoqda: cache-only oynadagi yozishlar replay navbatida kutadi."""
+    return DB_POOL is None and _DB_ATTACH_TASK is not None and not _DB_ATTACH_TASK.done()
+
+async def db_write(label: str, sql: str, *args):
+    """Bitta yozish so'rovi. Breaker ochiq yoki ulanish xatosi bo'lsa — replay navbatiga.
+
+    Navbatda yozuv bo'lsa yangisi ham navbatga tushadi (tartib buzilmasin). Pool hali
+    ulanmagan bo'lsa ham navbatga — _attach_db ulangach bajaradi.
+    """
+    if not DB_POOL:
+        if _db_attaching():
+            _queue_db_replay(label, sql, args)
+        return
+    if _DB_REPLAY or not DB_BREAKER.allow():
+        _queue_db_replay(label, sql, args)
+        return
+    try:
+        async with db_conn() as con:
+            await con.execute(sql, *args)
+    except Exception as e:
+        if _is_transient_db_error(e):
+            _queue_db_replay(label, sql, args)
+        else:
+            log.warning("%s xatolik: %s", label, e)
+
+async def db_replay_job(context: ContextTypes.DEFAULT_TYPE):
+    await replay_db_writes()
+
+async def replay_db_writes():
+    """DB tiklangach navbatdagi yozishlarni tartib bilan bajarish."""
+    if not _DB_REPLAY or not db_ready():
+        return
+    replayed = 0
+    try:
+        async with db_conn() as con:
+            while _DB_REPLAY:
+                label, sql, args = _DB_REPLAY[0]
+                try:
+                    await con.execute(sql, *args)
+                except Exception as e:
+                    if _is_transient_db_error(e):
+                        raise
+                    log.warning("DB replay: %s tashlab yuborildi: %s", label, e)
+                _DB_REPLAY.popleft()
+                replayed += 1
+    except Exception as e:
+        log.warning("DB replay to'xtadi (%s ta qoldi): %s", len(_DB_REPLAY), e)
+    if replayed:
+        log.info("DB replay: %s ta yozish bajarildi.", replayed)
+
+# ----------- Embedded SQLite backend (DATABASE_URL bo'lmasa) -----------
+# Postgres'siz deploy'larda ham holat (DM obunachilar, guruh sozlamalari, hisoblar,
+# imtiyozlar, bloklar) restart'dan keyin saqlansin. _SqlitePool asyncpg Pool/Connection'ning
+# bot ishlatadigan qismini (acquire, execute, executemany, fetch*, transaction) beradi,
+# shuning uchun DB_POOL ga bog'liq funksiyalar o'zgarishsiz ishlaydi. SQL dialekti
+# ($n, ::cast, = ANY(array), now()) avtomatik moslashtiriladi.
+# Bloklovchi chaqiruvlar bitta fon thread'ida (WAL rejimi); tranzaksiyadan tashqaridagi
+# yozishlar to'planib, bitta tranzaksiyada commit qilinadi.
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.sqlite3")  # "" — SQLite'ni o'chirish
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dm_users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    is_bot BOOLEAN DEFAULT FALSE,
+    language_code TEXT,
+    last_seen TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS group_settings (
+    chat_id BIGINT PRIMARY KEY,
+    tun BOOLEAN NOT NULL DEFAULT FALSE,
+    kanal_username TEXT,
+    majbur_limit INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    bot_status TEXT,
+    bot_status_at TIMESTAMPTZ,
+    tun_start TEXT,
+    tun_end TEXT,
+    tun_perms TEXT,
+    kanal_join BOOLEAN NOT NULL DEFAULT FALSE,
+    majbur_pre BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE TABLE IF NOT EXISTS group_user_counts (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    cnt INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS group_privileges (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    granted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS group_blocks (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    until_date TIMESTAMPTZ NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS group_verified (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    verified_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS group_pending (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    since TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS pending_deletes (
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL,
+    delete_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+"""
+
+_SQLITE_ANY_RE = re.compile(r"=\s*ANY\(\$(\d+)(?:::\w+\[\])?\)")
+_SQLITE_CAST_RE = re.compile(r"::\w+(?:\[\])?")
+_SQLITE_PARAM_RE = re.compile(r"\$(\d+)")
+
+sqlite3.register_adapter(datetime, lambda d: d.isoformat())
+sqlite3.register_converter("TIMESTAMPTZ", lambda b: datetime.fromisoformat(b.decode()))
+
+@lru_cache(maxsize=256)
+def _sqlite_sql(sql: str) -> str:
+    """Postgres dialektidagi so'rovni SQLite'ga moslashtirish."""
+    sql = _SQLITE_ANY_RE.sub(r"IN (SELECT value FROM json_each($\1))", sql)
+    sql = _SQLITE_CAST_RE.sub("", sql)
+    return _SQLITE_PARAM_RE.sub(r"?\1", sql)
+
+def _sqlite_args(args) -> tuple:
+    # Massiv parametrlar json_each uchun JSON matn sifatida uzatiladi
+    return tuple(json.dumps(list(a)) if isinstance(a, (list, tuple, set)) else a for a in args)
+
+class _SqlitePool:
+    """asyncpg.Pool o'rnini bosuvchi: bitta connection, bitta thread, yozishlar batch'da."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._db: sqlite3.Connection | None = None
+        self._lock = asyncio.Lock()  # tranzaksiya va batch commit'lar bir-biriga aralashmasin
+        self._batch: list = []  # (sql, rows, future)
+        self._flush_task: asyncio.Task | None = None
+        self.stats = {"batches": 0, "writes": 0}
+
+    def _open(self):
+        db = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL;")
+        db.execute("PRAGMA synchronous=NORMAL;")
+        db.execute("PRAGMA busy_timeout=5000;")
+        db.create_function("now", 0, lambda: datetime.now(timezone.utc).isoformat())
+        db.executescript(_SQLITE_SCHEMA)
+        self._db = db
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    # --- executor thread ichida ---
+    def _exec(self, sql: str, args: tuple):
+        return self._db.execute(_sqlite_sql(sql), _sqlite_args(args)).fetchall()
+
+    def _exec_many(self, sql: str, rows: list):
+        self._db.executemany(_sqlite_sql(sql), [_sqlite_args(r) for r in rows])
+
+    def _commit_batch(self, batch: list) -> list:
+        results = []
+        self._db.execute("BEGIN")
+        try:
+            for sql, rows, _ in batch:
+                # Bitta yozish xatosi qolganlarini bekor qilmasin
+                self._db.execute("SAVEPOINT w")
+                try:
+                    self._db.executemany(_sqlite_sql(sql), [_sqlite_args(r) for r in rows])
+                    self._db.execute("RELEASE w")
+                    results.append(None)
+                except Exception as e:
+                    self._db.execute("ROLLBACK TO w")
+                    self._db.execute("RELEASE w")
+                    results.append(e)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return results
+
+    # --- event loop tomonida ---
+    def write(self, sql: str, rows: list) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._batch.append((sql, rows, fut))
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush())
+        return fut
+
+    async def _flush(self):
+        async with self._lock:
+            batch, self._batch = self._batch, []
+            self._flush_task = None
+            if not batch:
+                return
+            try:
+                results = await self._run(self._commit_batch, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            self.stats["batches"] += 1
+            self.stats["writes"] += len(batch)
+            for (_, _, fut), res in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(None)
+
+    def acquire(self, timeout: float | None = None):
+        return _SqliteAcquire(self)
+
+    async def close(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+
+class _SqliteAcquire:
+    def __init__(self, pool: _SqlitePool):
+        self._con = _SqliteConnection(pool)
+
+    async def __aenter__(self):
+        return self._con
+
+    async def __aexit__(self, *exc):
+        return False
+
+class _SqliteConnection:
+    """asyncpg Connection'ning bot ishlatadigan qismi."""
+
+    def __init__(self, pool: _SqlitePool):
+        self._pool = pool
+        self._in_tx = False
+
+    async def _call(self, fn, *args):
+        if self._in_tx:
+            return await self._pool._run(fn, *args)
+        async with self._pool._lock:
+            return await self._pool._run(fn, *args)
+
+    async def execute(self, sql: str, *args):
+        if self._in_tx:
+            await self._pool._run(self._pool._exec, sql, args)
+        else:
+            await self._pool.write(sql, [args])
+
+    async def executemany(self, sql: str, rows):
+        rows = list(rows)
+        if self._in_tx:
+            await self._pool._run(self._pool._exec_many, sql, rows)
+        else:
+            await self._pool.write(sql, rows)
+
+    async def fetch(self, sql: str, *args):
+        return await self._call(self._pool._exec, sql, args)
+
+    async def fetchrow(self, sql: str, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, sql: str, *args):
+        row = await self.fetchrow(sql, *args)
+        return row[0] if row else None
+
+    async def copy_records_to_table(self, table_name: str, *, records, columns):
+        cols = ", ".join(columns)
+        marks = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+        await self.executemany(f"INSERT INTO {table_name} ({cols}) VALUES ({marks}) ON CONFLICT DO NOTHING;", records)
+
+    def transaction(self):
+        return _SqliteTransaction(self)
+
+class _SqliteTransaction:
+    def __init__(self, con: _SqliteConnection):
+        self._con = con
+
+    async def __aenter__(self):
+        pool = self._con._pool
+        await pool._lock.acquire()
+        try:
+            await pool._run(pool._db.execute, "BEGIN")
+        except BaseException:
+            pool._lock.release()
+            raise
+        self._con._in_tx = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pool = self._con._pool
+        self._con._in_tx = False
+        try:
+            await pool._run(pool._db.execute, "ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            pool._lock.release()
+        return False
+
 def _get_db_url() -> Optional[str]:
     return (
         os.getenv("DATABASE_URL")
@@ -563,15 +1316,22 @@ def _get_db_url() -> Optional[str]:
         or os.getenv("DB_URL")
     )
 
-async def init_db(app=None):
-    """Create asyncpg pool and ensure tables exist. Also migrate JSON -> DB once."""
+async def init_db(app=None, max_attempts: int | None = None):
+    """Create asyncpg pool and ensure tables exist. Also migrate JSON -> DB once.
+
+    Pool faqat sxema va migratsiya tugagandan keyin DB_POOL ga bitta qiymat berish bilan
+    ulanadi: handler'lar shu paytgacha cache-only rejimda ishlaydi va keyin DB yo'llariga
+    birdaniga o'tadi. Odatda post_init dan fon vazifasi sifatida ishga tushiriladi.
+    """
     global DB_POOL
     db_url = _get_db_url()
     if not db_url:
-        log.warning("DATABASE_URL topilmadi; DM ro'yxati JSON faylga yoziladi (ephemeral).")
+        log.warning("DATABASE_URL topilmadi; SQLite (%s) ishlatiladi.", SQLITE_PATH or "o'chirilgan")
+        await init_sqlite_db()
         return
     if asyncpg is None:
-        log.error("asyncpg o'rnatilmagan. requirements.txt ga 'asyncpg' qo'shing.")
+        log.error("asyncpg o'rnatilmagan. requirements.txt ga 'asyncpg' qo'shing. SQLite bilan davom etiladi.")
+        await init_sqlite_db()
         return
     # Railway/Render kabi PaaS larda Postgres ko'pincha SSL talab qiladi.
     # asyncpg uchun SSL konteksti beramiz. (Mahalliy DB ham odatda muammo qilmaydi.)
@@ -590,29 +1350,34 @@ async def init_db(app=None):
     except Exception:
         pass
     # Ba'zi PaaS/DB (ayniqsa Render free) birinchi ulanishda connection'ni yopib yuborishi mumkin.
-    # Shuning uchun retry/backoff bilan pool ochamiz.
-    DB_POOL = None
-    for attempt in range(1, 6):
+    # Shuning uchun retry/backoff bilan pool ochamiz. Fon vazifasida ishlagani uchun
+    # update'lar kutib qolmaydi; DB uyg'onguncha urinishda davom etamiz.
+    pool = None
+    attempt = 0
+    while pool is None:
+        attempt += 1
         try:
-            DB_POOL = await asyncpg.create_pool(
+            pool = await asyncpg.create_pool(
                 dsn=db_url,
                 min_size=1,
                 max_size=5,
                 ssl=(False if (urlparse(db_url).hostname or '').endswith('.railway.internal') else ssl_ctx),
                 timeout=30,
+                command_timeout=DB_COMMAND_TIMEOUT_SEC,
                 max_inactive_connection_lifetime=300,
             )
-            log.info("Postgres DB_POOL ochildi (attempt=%s).", attempt)
-            break
+            log.info("Postgres pool ochildi (attempt=%s).", attempt)
         except Exception as e:
-            log.warning("Postgres ulanish xatosi (attempt=%s/5): %r", attempt, e)
-            # exponential backoff: 1,2,4,8,16 (max 16s)
-            await asyncio.sleep(min(2 ** (attempt - 1), 16))
-    if DB_POOL is None:
-        log.error("Postgres'ga ulanib bo'lmadi. DB funksiyalar vaqtincha o'chadi; bot ishlashda davom etadi.")
-        return
+            log.warning("Postgres ulanish xatosi (attempt=%s): %r", attempt, e)
+            if max_attempts and attempt >= max_attempts:
+                log.error("Postgres'ga ulanib bo'lmadi (%s urinish).", attempt)
+                return
+            if attempt == 5:
+                log.error("Postgres'ga hali ulanib bo'lmadi; bot cache-only rejimda ishlamoqda, urinish davom etadi.")
+            # exponential backoff: 1,2,4,8,16,30,30,... (max 30s)
+            await asyncio.sleep(min(2 ** (attempt - 1), 30))
 
-    async with DB_POOL.acquire() as con:
+    async with pool.acquire() as con:
         await con.execute(
             """
             CREATE TABLE IF NOT EXISTS dm_users (
@@ -628,31 +1393,52 @@ async def init_db(app=None):
         )
     # Ensure per-group tables exist
     try:
-        await init_group_db()
+        await init_group_db(pool)
     except Exception as e:
         log.warning("init_group_db xatolik: %s", e)
 
+    await _migrate_json_subs(pool)
+
+    # Hammasi tayyor — handler'lar shu qatordan boshlab DB yo'llaridan foydalanadi
+    DB_POOL = pool
+    log.info("Postgres DB_POOL ulandi.")
+
+async def init_sqlite_db():
+    """DATABASE_URL bo'lmasa: SQLite faylini ochish (sxema _SqlitePool.open ichida)."""
+    global DB_POOL
+    if not SQLITE_PATH:
+        log.warning("SQLITE_PATH bo'sh; DM ro'yxati JSON faylga yoziladi (ephemeral).")
+        return
+    pool = _SqlitePool(SQLITE_PATH)
+    try:
+        await pool.open()
+    except Exception as e:
+        log.error("SQLite ochilmadi (%s): %s", SQLITE_PATH, e)
+        return
+    await _migrate_json_subs(pool)
+    DB_POOL = pool
+    log.info("SQLite DB_POOL ulandi: %s", SQLITE_PATH)
+
+async def _migrate_json_subs(pool):
     # Migrate from JSON (best-effort, only if DB empty)
     try:
-        if DB_POOL:
-            async with DB_POOL.acquire() as con:
+        if pool:
+            async with pool.acquire() as con:
                 count_row = await con.fetchval("SELECT COUNT(*) FROM dm_users;")
             if count_row == 0 and os.path.exists(SUB_USERS_FILE):
-                s = _load_ids(SUB_USERS_FILE)
-                if s:
-                    async with DB_POOL.acquire() as con:
-                        async with con.transaction():
-                            for cid in s:
-                                try:
-                                    cid_int = int(cid)
-                                except Exception:
-                                    continue
-                                await con.execute(
-                                    "INSERT INTO dm_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING;", cid_int
-                                )
-                    log.info(f"Migratsiya: JSON dan Postgresga {len(s)} ta ID import qilindi.")
+                ids = set()
+                for cid in _load_ids(SUB_USERS_FILE):
+                    try:
+                        ids.add(int(cid))
+                    except Exception:
+                        continue
+                if ids:
+                    # Jadval bo'sh — bitta COPY bilan (har ID uchun alohida INSERT emas)
+                    async with pool.acquire() as con:
+                        await con.copy_records_to_table("dm_users", records=[(i,) for i in ids], columns=["user_id"])
+                    log.info("Migratsiya: JSON dan DB'ga %s ta ID import qilindi.", len(ids))
     except Exception as e:
-        log.warning(f"Migratsiya vaqtida xato: {e}")
+        log.warning("Migratsiya vaqtida xato: %s", e)
 
 async def dm_upsert_user(user):
     """Add/update a user to dm_users (Postgres if available, else JSON)."""
@@ -661,7 +1447,7 @@ async def dm_upsert_user(user):
         return
     if DB_POOL:
         try:
-            async with DB_POOL.acquire() as con:
+            async with db_conn() as con:
                 await con.execute(
                     """
                     INSERT INTO dm_users (user_id, username, first_name, last_name, is_bot, language_code, last_seen)
@@ -677,7 +1463,7 @@ async def dm_upsert_user(user):
                     user.id, user.username, user.first_name, user.last_name, user.is_bot, getattr(user, "language_code", None)
                 )
         except Exception as e:
-            log.warning(f"dm_upsert_user(DB) xatolik: {e}")
+            log.warning("dm_upsert_user(DB) xatolik: %s", e)
     else:
         # Fallback to JSON
         add_chat_to_subs_fallback(user)
@@ -686,11 +1472,11 @@ async def dm_all_ids() -> List[int]:
     global DB_POOL
     if DB_POOL:
         try:
-            async with DB_POOL.acquire() as con:
+            async with db_conn() as con:
                 rows = await con.fetch("SELECT user_id FROM dm_users;")
             return [r["user_id"] for r in rows]
         except Exception as e:
-            log.warning(f"dm_all_ids(DB) xatolik: {e}")
+            log.warning("dm_all_ids(DB) xatolik: %s", e)
             return []
     else:
         return list(_load_ids(SUB_USERS_FILE))
@@ -699,10 +1485,10 @@ async def dm_remove_user(user_id: int):
     global DB_POOL
     if DB_POOL:
         try:
-            async with DB_POOL.acquire() as con:
+            async with db_conn() as con:
                 await con.execute("DELETE FROM dm_users WHERE user_id=$1;", user_id)
         except Exception as e:
-            log.warning(f"dm_remove_user(DB) xatolik: {e}")
+            log.warning("dm_remove_user(DB) xatolik: %s", e)
     else:
         remove_chat_from_subs_fallback(user_id)
 
@@ -721,7 +1507,7 @@ def _save_ids(path: str, data: set):
             json.dump(sorted(list(data)), f, ensure_ascii=False, indent=2)
     except Exception as e:
         try:
-            log.warning(f"IDs saqlashda xatolik: {e}")
+            log.warning("IDs saqlashda xatolik: %s", e)
         except Exception:
             print(f"IDs saqlashda xatolik: {e}")
 
@@ -765,9 +1551,10 @@ async def is_admin(update: Update) -> bool:
             return member.status in ("administrator", "creator", "owner")
         return False
     except Exception as e:
-        log.warning(f"is_admin tekshiruvda xatolik: {e}")
+        log.warning("is_admin tekshiruvda xatolik: %s", e)
         return False
 
+@traced("privileged")
 async def is_privileged_message(msg, bot) -> bool:
     """Adminlar, creatorlar yoki guruh/linked kanal nomidan yozilgan (sender_chat) xabarlar uchun True."""
     try:
@@ -787,7 +1574,7 @@ async def is_privileged_message(msg, bot) -> bool:
             if member.status in ("administrator", "creator", "owner"):
                 return True
     except Exception as e:
-        log.warning(f"is_privileged_message xatolik: {e}")
+        log.warning("is_privileged_message xatolik: %s", e)
     return False
 
 async def kanal_tekshir(user_id: int, bot) -> bool:
@@ -798,7 +1585,7 @@ async def kanal_tekshir(user_id: int, bot) -> bool:
         member = await bot.get_chat_member(KANAL_USERNAME, user_id)
         return member.status in ("member", "creator", "administrator")
     except Exception as e:
-        log.warning(f"kanal_tekshir xatolik: {e}")
+        log.warning("kanal_tekshir xatolik: %s", e)
         return False
 
 def matndan_sozlar_olish(matn: str):
@@ -845,7 +1632,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_chat.type == 'private':
             await dm_upsert_user(update.effective_user)
     except Exception as e:
-        log.warning(f"/start dm_upsert_user xatolik: {e}")
+        log.warning("/start dm_upsert_user xatolik: %s", e)
     kb = [[InlineKeyboardButton("➕ Guruhga qo‘shish", url=admin_add_link(context.bot.username))]]
     await update.effective_message.reply_text(
         "<b>САЛОМ👋</b>\n"
@@ -867,15 +1654,18 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📌 <b>БОТ ҚЎЛЛАНМАЛАРИ</b>\n\n"
         "🔹 <b>/id</b> - Аккаунтингиз ID сини кўрсатади.\n\n"
         "📘<b>ЁРДАМЧИ БУЙРУҚЛАР</b>\n"
-        "🔹 <b>/tun</b> — Тун режими(шу дақиқадан гурухга ёзилган хабарлар автоматик ўчирилиб турилади).\n"
-        "🔹 <b>/tunoff</b> — Тун режимини ўчириш.\n"
+        "🔹 <b>/tun</b> — Тун режими(шу дақиқадан гурух ёпилади, имтиёзлилар ёза олади).\n"
+        "🔹 <b>/tun 23:00 07:00</b> — Тун режимини ҳар куни шу вақтда ёқиш/ўчириш.\n"
+        "🔹 <b>/tunoff</b> — Тун режимини ўчириш (жадвал ҳам бекор қилинади).\n"
         "🔹 <b>/ruxsat</b> — (Ответит) орқали имтиёз бериш.\n"
         "🔹 <b>/ruxsatoff</b> — (Ответит) орқали имтиёзни олиб қўйиш.\n\n"
         "👥<b>ГУРУХГА МАЖБУР ОДАМ ҚЎШТИРИШ ВА КАНАЛГА МАЖБУР АЪЗО БЎЛДИРИШ</b>\n"
         "🔹 <b>/kanal @kanal1 @kanal2</b> — Мажбурий кўрсатилган каналга аъзо қилдириш.\n"
         "🔹 <b>/kanaloff</b> — Мажбурий каналга аъзони ўчириш.\n"
+        "🔹 <b>/kanaljoin on|off</b> — Гуруҳга кириш сўровларини (join request) каналга аъзолик бўйича текшириш.\n"
         "🔹 <b>/majbur [3–25]</b> — Гурухда мажбурий одам қўшишни ёқиш.\n"
-        "🔹 <b>/majburoff</b> — Мажбурий қўшишни ўчириш.\n\n"
+        "🔹 <b>/majburoff</b> — Мажбурий қўшишни ўчириш.\n"
+        "🔹 <b>/majburpre on|off</b> — Янги аъзолар лимитга етгунча ёзолмайди (етганда автоматик очилади).\n\n"
         "📈<b>ОДАМ ҚЎШГАНЛАРНИ ХИСОБЛАШ</b>\n"
         "🔹 <b>/top</b> — TOP одам қўшганлар.\n"
         "🔹 <b>/cleangroup</b> — Одам қўшганлар хисобини 0 қилиш.\n"
@@ -1083,7 +1873,7 @@ async def on_check_added(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         except Exception:
             pass
-        BLOK_VAQTLARI.pop((q.message.chat.id, uid), None)
+        BLOK_VAQTLARI.pop(_pk(q.message.chat.id, uid), None)
         return await q.edit_message_text("✅ Talab bajarilgan! Endi guruhda yozishingiz mumkin.")
 
     qoldi = max(MAJBUR_LIMIT - cnt, 0)
@@ -1297,7 +2087,7 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Agar foydalanuvchi hanuz blokda bo'lsa — xabarini o'chirib, hech narsa yubormaymiz
     now = datetime.now(timezone.utc)
-    key = (msg.chat_id, uid)
+    key = _pk(msg.chat_id, uid)
     until_old = BLOK_VAQTLARI.get(key)
     if until_old and now < until_old:
         try:
@@ -1320,7 +2110,7 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 1 daqiqaga blok
     until = datetime.now(timezone.utc) + timedelta(minutes=1)
-    BLOK_VAQTLARI[(msg.chat_id, uid)] = until
+    BLOK_VAQTLARI[_pk(msg.chat_id, uid)] = until
     try:
         await context.bot.restrict_chat_member(
             chat_id=msg.chat_id,
@@ -1329,7 +2119,7 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
             until_date=until
         )
     except Exception as e:
-        log.warning(f"Restrict failed: {e}")
+        log.warning("Restrict failed: %s", e)
 
     qoldi = max(MAJBUR_LIMIT - cnt, 0)
     kb = [
@@ -1348,13 +2138,26 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -------------- Bot my_status (admin emas) ogohlantirish --------------
 async def on_my_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        st = update.my_chat_member.new_chat_member.status
+        new_member = update.my_chat_member.new_chat_member
+        st = new_member.status
     except Exception:
         return
+    chat = update.effective_chat
+    if chat and chat.type == Chat.CHANNEL:
+        # Majburiy kanal: bot admin bo'lsa chat_member push'lari keladi
+        if chat.username:
+            _channel_push_reset("@" + chat.username.lower(), st in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER))
+        return
+    if chat and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        if st in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED):
+            # Bot chiqarildi/chiqdi — guruh holatini darhol tozalaymiz
+            return await forget_group_db(chat.id)
+        # Broadcast nishonlari uchun statusni saqlaymiz (get_chat_member'siz)
+        await set_group_bot_status(chat.id, str(st))
+        _BOT_CAN_DELETE[chat.id] = (_member_can_delete(new_member), time.monotonic())
     if st in (ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED):
-        me = await context.bot.get_me()
         kb = InlineKeyboardMarkup([[InlineKeyboardButton(
-            '🔐 Botni admin qilish', url=admin_add_link(me.username)
+            '🔐 Botni admin qilish', url=admin_add_link(context.bot.username)
         )]])
         try:
             await context.bot.send_message(
@@ -1376,7 +2179,35 @@ async def track_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await dm_upsert_user(update.effective_user)
     except Exception as e:
-        log.warning(f"track_private upsert xatolik: {e}")
+        log.warning("track_private upsert xatolik: %s", e)
+
+# Bir vaqtda faqat bitta owner broadcast: WORKERS>1 (yoki deploy paytida ikki nusxa)
+# bo'lsa Postgres advisory lock orqali, aks holda jarayon ichidagi lock bilan.
+_BROADCAST_LOCK_KEY = 0x74676562  # "tgeb"
+_BROADCAST_LOCAL_LOCK = asyncio.Lock()
+
+@contextlib.asynccontextmanager
+async def owner_broadcast_lock():
+    if _BROADCAST_LOCAL_LOCK.locked():
+        yield False
+        return
+    async with _BROADCAST_LOCAL_LOCK, contextlib.AsyncExitStack() as stack:
+        if not DB_POOL or isinstance(DB_POOL, _SqlitePool):
+            yield True
+            return
+        try:
+            # db_conn() emas: lock broadcast davomida ushlanadi, breaker latency'siga kirmasin
+            con = await stack.enter_async_context(DB_POOL.acquire(timeout=DB_ACQUIRE_TIMEOUT_SEC))
+            acquired = await con.fetchval("SELECT pg_try_advisory_lock($1);", _BROADCAST_LOCK_KEY)
+        except Exception as e:
+            log.warning("Broadcast advisory lock xatolik: %s", e)
+            acquired = False
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                with contextlib.suppress(Exception):
+                    await con.execute("SELECT pg_advisory_unlock($1);", _BROADCAST_LOCK_KEY)
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """(OWNER & DM) Matnni barcha DM obunachilarga yuborish."""
@@ -1390,19 +2221,25 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return await update.effective_message.reply_text("Foydalanish: /broadcast Yangilanish matni")
 
-    ids = await dm_all_ids()
-    total = len(ids); ok = 0; fail = 0
-    await update.effective_message.reply_text(f"📣 DM jo‘natish boshlandi. Jami foydalanuvchilar: {total}")
-    for cid in list(ids):
-        try:
-            await context.bot.send_message(cid, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-            ok += 1
-            await asyncio.sleep(0.05)
-        except (Exception,) as e:
-            # drop forbidden/bad users
-            await dm_remove_user(cid)
-            fail += 1
-    await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta, ❌ xatolik: {fail} ta.")
+    async with owner_broadcast_lock() as acquired:
+        if not acquired:
+            return await update.effective_message.reply_text("⏳ Boshqa broadcast hali davom etmoqda — tugashini kuting.")
+        ids = await dm_all_ids()
+        total = len(ids); ok = 0; fail = 0
+        await update.effective_message.reply_text(f"📣 DM jo‘natish boshlandi. Jami foydalanuvchilar: {total}")
+        for cid in list(ids):
+            if _SHUTTING_DOWN.is_set():
+                log.warning("DM broadcast to'xtatildi (shutdown): %s/%s yuborildi.", ok, total)
+                break
+            try:
+                await context.bot.send_message(cid, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+                ok += 1
+                await asyncio.sleep(0.05)
+            except (Exception,) as e:
+                # drop forbidden/bad users
+                await dm_remove_user(cid)
+                fail += 1
+        await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta, ❌ xatolik: {fail} ta.")
 
 async def broadcastpost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """(OWNER & DM) Reply qilingan postni barcha DM obunachilarga yuborish."""
@@ -1414,36 +2251,173 @@ async def broadcastpost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not msg:
         return await update.effective_message.reply_text("Foydalanish: /broadcastpost — yubormoqchi bo‘lgan xabarga reply qiling.")
 
-    ids = await dm_all_ids()
-    total = len(ids); ok = 0; fail = 0
-    await update.effective_message.reply_text(f"📣 DM post tarqatish boshlandi. Jami foydalanuvchilar: {total}")
-    for cid in list(ids):
-        try:
-            await context.bot.copy_message(chat_id=cid, from_chat_id=msg.chat_id, message_id=msg.message_id)
-            ok += 1
-            await asyncio.sleep(0.05)
-        except (Exception,) as e:
-            await dm_remove_user(cid)
-            fail += 1
-    await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta, ❌ xatolik: {fail} ta.")
+    async with owner_broadcast_lock() as acquired:
+        if not acquired:
+            return await update.effective_message.reply_text("⏳ Boshqa broadcast hali davom etmoqda — tugashini kuting.")
+        ids = await dm_all_ids()
+        total = len(ids); ok = 0; fail = 0
+        await update.effective_message.reply_text(f"📣 DM post tarqatish boshlandi. Jami foydalanuvchilar: {total}")
+        for cid in list(ids):
+            if _SHUTTING_DOWN.is_set():
+                log.warning("DM broadcast to'xtatildi (shutdown): %s/%s yuborildi.", ok, total)
+                break
+            try:
+                await context.bot.copy_message(chat_id=cid, from_chat_id=msg.chat_id, message_id=msg.message_id)
+                ok += 1
+                await asyncio.sleep(0.05)
+            except (Exception,) as e:
+                await dm_remove_user(cid)
+                fail += 1
+        await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta, ❌ xatolik: {fail} ta.")
 
 
 
 
 # ---------------------- GROUP: Broadcast (owner only) ----------------------
+# Botning har bir guruhdagi o'z statusi my_chat_member update'laridan kuzatiladi va
+# group_settings.bot_status ga yoziladi. Broadcast endi har guruh uchun get_chat_member
+# qilmaydi: nishonlar bitta SQL bilan olinadi va rate-limit'li parallel sender'ga beriladi.
+BOT_ADMIN_STATUSES = ("administrator", "creator", "owner")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+
 async def group_all_chat_ids() -> List[int]:
     # Guruh chat_id lar ro'yxati (DB'dagi group_settings jadvalidan).
     global DB_POOL
     if not DB_POOL:
         return []
     try:
-        async with DB_POOL.acquire() as con:
+        async with db_conn() as con:
             rows = await con.fetch("SELECT chat_id FROM group_settings;")
         return [int(r["chat_id"]) for r in rows]
     except Exception as e:
-        log.warning(f"group_all_chat_ids(DB) xatolik: {e}")
+        log.warning("group_all_chat_ids(DB) xatolik: %s", e)
         return []
 
+async def group_broadcast_targets() -> tuple[List[int], List[int]]:
+    """Broadcast nishonlari: (bot admin bo'lgan guruhlar, statusi hali noma'lum guruhlar).
+
+    Noma'lum status — bot_status ustuni qo'shilishidan oldingi eski qatorlar; ular
+    broadcast vaqtida bir marta tekshirilib, natija DB'ga yoziladi.
+    """
+    global DB_POOL
+    if not DB_POOL:
+        return [], []
+    try:
+        async with db_conn() as con:
+            rows = await con.fetch(
+                "SELECT chat_id, bot_status FROM group_settings "
+                "WHERE bot_status IS NULL OR bot_status = ANY($1::TEXT[]);",
+                list(BOT_ADMIN_STATUSES)
+            )
+    except Exception as e:
+        log.warning("group_broadcast_targets(DB) xatolik: %s", e)
+        return [], []
+    admin_ids: List[int] = []
+    unknown_ids: List[int] = []
+    for r in rows:
+        (unknown_ids if r["bot_status"] is None else admin_ids).append(int(r["chat_id"]))
+    return admin_ids, unknown_ids
+
+async def set_group_bot_status(chat_id: int, status: str | None):
+    """Botning guruhdagi statusini saqlash (my_chat_member yoki bir martalik tekshiruvdan)."""
+    await db_write(
+        "set_group_bot_status",
+        """
+        INSERT INTO group_settings (chat_id, bot_status, bot_status_at)
+        VALUES ($1,$2, now())
+        ON CONFLICT (chat_id) DO UPDATE SET
+            bot_status=EXCLUDED.bot_status,
+            bot_status_at=now();
+        """,
+        chat_id, status
+    )
+
+_GROUP_TABLES = ("group_user_counts", "group_privileges", "group_blocks", "group_verified", "group_pending", "pending_deletes", "group_settings")
+
+async def forget_group_db(chat_id: int):
+    """Bot guruhdan chiqarilganda/chiqqanda guruhning barcha holatini o'chirish.
+
+    group_settings bilan birga group_user_counts, group_privileges va group_blocks
+    ham bitta tranzaksiyada tozalanadi; in-memory cache'lar ham bo'shatiladi.
+    """
+    _GROUP_SETTINGS_CACHE.pop(chat_id, None)
+    _GROUP_PRIV_MEM.pop(chat_id, None)
+    _GROUP_VERIFIED_MEM.pop(chat_id, None)
+    _GROUP_PENDING_MEM.pop(chat_id, None)
+    _GROUP_COUNTS_MEM.pop(chat_id, None)
+    _GROUP_LINKED_ID_CACHE.pop(chat_id, None)
+    _BOT_CAN_DELETE.pop(chat_id, None)
+    for d in (BLOK_VAQTLARI, MAJBUR_WARN_MSG_IDS, KANAL_WARN_MSG_IDS):
+        for k in [k for k in d if _pk_chat(k) == chat_id]:
+            d.pop(k, None)
+    for k in [k for k in _MOD_CTX_MEMO if _pk_chat(k) == chat_id]:
+        _MOD_CTX_MEMO.pop(k, None)
+    if not DB_POOL:
+        return
+    if db_ready() and not _DB_REPLAY:
+        try:
+            async with db_conn() as con:
+                async with con.transaction():
+                    for table in _GROUP_TABLES:
+                        await con.execute(f"DELETE FROM {table} WHERE chat_id=$1;", chat_id)
+            log.info("Guruh tozalandi (bot chiqarildi): %s", chat_id)
+            return
+        except Exception as e:
+            if not _is_transient_db_error(e):
+                log.warning("forget_group_db xatolik: %s", e)
+                return
+    # DB hozir javob bermayapti — har bir jadval uchun alohida replay yozuvi
+    for table in _GROUP_TABLES:
+        await db_write("forget_group_db", f"DELETE FROM {table} WHERE chat_id=$1;", chat_id)
+
+async def _drop_dead_group(gid: int, err: Exception) -> bool:
+    # Agar bot guruhdan chiqarilgan bo'lsa — ro'yxatdan tozalab qo'yamiz (best-effort)
+    low = str(err).lower()
+    if not ("forbidden" in low or "kicked" in low or "chat not found" in low):
+        return False
+    await forget_group_db(gid)
+    return True
+
+def _retry_after_seconds(err) -> float:
+    ra = getattr(err, "retry_after", 1)
+    if isinstance(ra, timedelta):
+        return ra.total_seconds()
+    try:
+        return float(ra)
+    except Exception:
+        return 1.0
+
+async def _broadcast_to_groups(bot, send_one) -> tuple[int, int, int]:
+    """Guruhlarga OUTBOX orqali (eng past ustuvorlikda) jo'natish. Qaytaradi: (ok, skipped, fail)."""
+    admin_ids, unknown_ids = await group_broadcast_targets()
+    unknown_set = set(unknown_ids)
+    sem = asyncio.Semaphore(max(1, BROADCAST_CONCURRENCY))
+    stats = {"ok": 0, "skipped": 0, "fail": 0, "aborted": 0}
+
+    async def worker(gid: int):
+        async with sem:
+            if _SHUTTING_DOWN.is_set():
+                stats["aborted"] += 1
+                return
+            try:
+                if gid in unknown_set:
+                    # Eski qator: statusni bir marta aniqlab, DB'ga yozib qo'yamiz
+                    cm = await OUTBOX.submit(gid, PRIO_BULK, partial(bot.get_chat_member, gid, bot.id))
+                    await set_group_bot_status(gid, cm.status)
+                    if cm.status not in BOT_ADMIN_STATUSES:
+                        stats["skipped"] += 1
+                        return
+                await OUTBOX.submit(gid, PRIO_BULK, partial(send_one, gid))
+                stats["ok"] += 1
+            except Exception as e:
+                stats["fail"] += 1
+                await _drop_dead_group(gid, e)
+
+    await asyncio.gather(*(worker(gid) for gid in admin_ids + unknown_ids))
+    if stats["aborted"]:
+        log.warning("Group broadcast to'xtatildi (shutdown): %s ta guruhga yuborilmadi.", stats["aborted"])
+    return stats["ok"], stats["skipped"], stats["fail"]
+
 async def broadcastgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # (OWNER & DM) Matnni bot admin bo'lgan barcha guruhlarga yuborish.
     if update.effective_chat.type != "private":
@@ -1456,34 +2430,19 @@ async def broadcastgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text:
         return await update.effective_message.reply_text("Foydalanish: /broadcastgroup Matn (yoki xabarga reply qilib yuboring)")
 
-    group_ids = await group_all_chat_ids()
-    if not group_ids:
+    if not DB_POOL:
         return await update.effective_message.reply_text("⚠️ Guruhlar ro'yxati topilmadi (DB yo'q yoki hali guruh sozlamalari yaratilmagan).")
 
-    me = await context.bot.get_me()
-    total = len(group_ids); ok = 0; fail = 0; skipped = 0
-    await update.effective_message.reply_text(f"📣 Guruhlarga jo‘natish boshlandi. DB'da: {total} ta guruh (faqat bot admin bo‘lganlariga yuboriladi).")
-    for gid in list(group_ids):
-        try:
-            cm = await context.bot.get_chat_member(gid, me.id)
-            if cm.status not in ("administrator", "creator", "owner"):
-                skipped += 1
-                continue
+    async with owner_broadcast_lock() as acquired:
+        if not acquired:
+            return await update.effective_message.reply_text("⏳ Boshqa broadcast hali davom etmoqda — tugashini kuting.")
+        await update.effective_message.reply_text("📣 Guruhlarga jo‘natish boshlandi (faqat bot admin bo‘lgan guruhlarga yuboriladi).")
+
+        async def send_one(gid: int):
             await context.bot.send_message(gid, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-            ok += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            fail += 1
-            # Agar bot guruhdan chiqarilgan bo'lsa — keyinchalik ro'yxatdan tozalab qo'yamiz (best-effort)
-            try:
-                if DB_POOL:
-                    low = str(e).lower()
-                    if "forbidden" in low or "kicked" in low or "chat not found" in low:
-                        async with DB_POOL.acquire() as con:
-                            await con.execute("DELETE FROM group_settings WHERE chat_id=$1;", gid)
-            except Exception:
-                pass
-    await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta guruh, ⏭️ o‘tkazildi (admin emas): {skipped} ta, ❌ xatolik: {fail} ta.")
+
+        ok, skipped, fail = await _broadcast_to_groups(context.bot, send_one)
+        await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta guruh, ⏭️ o‘tkazildi (admin emas): {skipped} ta, ❌ xatolik: {fail} ta.")
 
 async def broadcastpostgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # (OWNER & DM) Reply qilingan postni bot admin bo'lgan barcha guruhlarga yuborish.
@@ -1495,40 +2454,26 @@ async def broadcastpostgroup(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not msg:
         return await update.effective_message.reply_text("Foydalanish: /broadcastpostgroup — yubormoqchi bo‘lgan xabarga reply qiling.")
 
-    group_ids = await group_all_chat_ids()
-    if not group_ids:
+    if not DB_POOL:
         return await update.effective_message.reply_text("⚠️ Guruhlar ro'yxati topilmadi (DB yo'q yoki hali guruh sozlamalari yaratilmagan).")
 
-    me = await context.bot.get_me()
-    total = len(group_ids); ok = 0; fail = 0; skipped = 0
-    await update.effective_message.reply_text(f"📣 Guruhlarga post tarqatish boshlandi. DB'da: {total} ta guruh (faqat bot admin bo‘lganlariga yuboriladi).")
-    for gid in list(group_ids):
-        try:
-            cm = await context.bot.get_chat_member(gid, me.id)
-            if cm.status not in ("administrator", "creator", "owner"):
-                skipped += 1
-                continue
+    async with owner_broadcast_lock() as acquired:
+        if not acquired:
+            return await update.effective_message.reply_text("⏳ Boshqa broadcast hali davom etmoqda — tugashini kuting.")
+        await update.effective_message.reply_text("📣 Guruhlarga post tarqatish boshlandi (faqat bot admin bo‘lgan guruhlarga yuboriladi).")
+
+        async def send_one(gid: int):
             await context.bot.copy_message(chat_id=gid, from_chat_id=msg.chat_id, message_id=msg.message_id)
-            ok += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            fail += 1
-            try:
-                if DB_POOL:
-                    low = str(e).lower()
-                    if "forbidden" in low or "kicked" in low or "chat not found" in low:
-                        async with DB_POOL.acquire() as con:
-                            await con.execute("DELETE FROM group_settings WHERE chat_id=$1;", gid)
-            except Exception:
-                pass
-    await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta guruh, ⏭️ o‘tkazildi (admin emas): {skipped} ta, ❌ xatolik: {fail} ta.")
+
+        ok, skipped, fail = await _broadcast_to_groups(context.bot, send_one)
+        await update.effective_message.reply_text(f"✅ Yuborildi: {ok} ta guruh, ⏭️ o‘tkazildi (admin emas): {skipped} ta, ❌ xatolik: {fail} ta.")
 
 
 # ====================== PER-GROUP SETTINGS (DB-backed) ======================
 # Muammo: TUN_REJIMI / KANAL_USERNAME / MAJBUR_LIMIT va hisoblar global edi.
 # Yechim: Har bir chat_id (guruh) uchun alohida saqlash (Railway Postgres).
 
-_GROUP_SETTINGS_CACHE = {}  # chat_id -> (settings_dict, fetched_monotonic)
+_GROUP_SETTINGS_CACHE = {}  # chat_id -> (GroupSettings, fetched_monotonic)
 _GROUP_SETTINGS_TTL_SEC = 20
 
 # In-memory fallback (DB bo'lmasa) — counts per (chat_id, user_id)
@@ -1537,15 +2482,58 @@ _GROUP_COUNTS_MEM = defaultdict(lambda: defaultdict(int))
 
 # In-memory privileges cache per group (DB bo'lsa ham tezkor bypass uchun)
 _GROUP_PRIV_MEM = defaultdict(set)  # chat_id -> set(user_id)
-def _default_group_settings():
-    return {"tun": False, "kanal_username": None, "majbur_limit": 0}
+@dataclasses.dataclass(frozen=True, slots=True)
+class GroupSettings:
+    """Guruh sozlamalari (o'zgarmas). Cache'da bitta nusxa saqlanadi va nusxa olinmasdan ulashiladi.
+
+    kanals — kanal_username dan bir marta (yuklanganda/o'zgarganda) parse qilingan tuple.
+    """
+    tun: bool = False
+    kanal_username: str | None = None
+    majbur_limit: int = 0
+    tun_start: str | None = None
+    tun_end: str | None = None
+    kanal_join: bool = False
+    majbur_pre: bool = False
+    kanals: tuple[str, ...] = dataclasses.field(default=(), init=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "kanals", tuple(_parse_kanal_usernames(self.kanal_username)))
+
+# Dangasa: GroupSettings() kanal parse helper'lariga tayanadi, ular fayl pastrog'ida
+_DEFAULT_GROUP_SETTINGS: GroupSettings | None = None
+
+def _default_group_settings() -> GroupSettings:
+    global _DEFAULT_GROUP_SETTINGS
+    if _DEFAULT_GROUP_SETTINGS is None:
+        _DEFAULT_GROUP_SETTINGS = GroupSettings()
+    return _DEFAULT_GROUP_SETTINGS
+
+_GROUP_SETTINGS_COLS = "tun, kanal_username, majbur_limit, tun_start, tun_end, kanal_join, majbur_pre"
+
+# Join request orqali kanal a'zoligi tekshirilib kirgan foydalanuvchilar (chat_id -> set(user_id))
+_GROUP_VERIFIED_MEM = defaultdict(set)
+# Jami yozuvlar shundan oshsa janitor eng eski guruhlarni tashlaydi (keyin qayta tekshiriladi
+# yoki DB'dan o'qiladi — bu faqat kanal tekshiruvini tejovchi kesh)
+GROUP_VERIFIED_MAX = int(os.getenv("GROUP_VERIFIED_MAX", "200000"))
+
+def _settings_from_row(row) -> GroupSettings:
+    return GroupSettings(
+        tun=bool(row["tun"]),
+        kanal_username=row["kanal_username"],
+        majbur_limit=int(row["majbur_limit"] or 0),
+        tun_start=row["tun_start"],
+        tun_end=row["tun_end"],
+        kanal_join=bool(row["kanal_join"]),
+        majbur_pre=bool(row["majbur_pre"]),
+    )
 
-async def init_group_db():
+async def init_group_db(pool=None):
     """Ensure per-group tables exist."""
-    global DB_POOL
-    if not DB_POOL:
+    pool = pool or DB_POOL
+    if not pool:
         return
-    async with DB_POOL.acquire() as con:
+    async with pool.acquire() as con:
         await con.execute(
             """
             CREATE TABLE IF NOT EXISTS group_settings (
@@ -1557,6 +2545,17 @@ async def init_group_db():
             );
             """
         )
+        # Botning guruhdagi o'z statusi (my_chat_member orqali yangilanadi)
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS bot_status TEXT;")
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS bot_status_at TIMESTAMPTZ;")
+        # Tun rejimi: jadval (HH:MM) va yopishdan oldingi guruh ruxsatlari (JSON)
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS tun_start TEXT;")
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS tun_end TEXT;")
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS tun_perms TEXT;")
+        # Join request rejimida kanal a'zoligini kirishda tekshirish
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS kanal_join BOOLEAN NOT NULL DEFAULT FALSE;")
+        # Majburiy qo'shish: yangi a'zolarni kirishda cheklash
+        await con.execute("ALTER TABLE group_settings ADD COLUMN IF NOT EXISTS majbur_pre BOOLEAN NOT NULL DEFAULT FALSE;")
         await con.execute(
             """
             CREATE TABLE IF NOT EXISTS group_user_counts (
@@ -1589,102 +2588,438 @@ async def init_group_db():
             );
             """
         )
-    log.info("Per-group DB jadvallari tayyor: group_settings, group_user_counts, group_privileges, group_blocks")
+        await con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS group_verified (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                verified_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (chat_id, user_id)
+            );
+            """
+        )
+        await con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS group_pending (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                since TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (chat_id, user_id)
+            );
+            """
+        )
+        await con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_deletes (
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                delete_at TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            );
+            """
+        )
+    log.info("Per-group DB jadvallari tayyor: group_settings, group_user_counts, group_privileges, group_blocks, group_verified, group_pending, pending_deletes")
+
+# --------- Cache tier: in-process + (ixtiyoriy) bir host'dagi jarayonlar uchun umumiy ----------
+# Jarayon ichidagi lug'atlar (_GROUP_SETTINGS_CACHE, _GROUP_PRIV_MEM, BLOK_VAQTLARI) L1 bo'lib
+# qoladi — ular sinxron o'qiladi va snapshot'ga kiradi. Ularning miss yo'lida DB'dan oldin
+# CACHE_L2 so'raladi, yozishlar esa L2'ga ham yoziladi: bir replika qo'ygan blok/imtiyoz
+# boshqasida TTL tugashini yoki DB replay'ni kutmasdan ko'rinadi.
+# CACHE_BACKEND: local (faqat in-process) | shared (unix socket orqali umumiy store) |
+# auto (WORKERS>1 bo'lsa shared). Umumiy store'ni front jarayoni yoki
+# `python main.py cache-server` ishga tushiradi.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "auto").strip().lower()
+CACHE_SOCKET = os.getenv("CACHE_SOCKET", "/tmp/tge-bot-cache.sock")
+CACHE_LOCAL_MAX = int(os.getenv("CACHE_LOCAL_MAX", "100000"))
+CACHE_SHARED_MAX = int(os.getenv("CACHE_SHARED_MAX", "1000000"))
+CACHE_SHARED_TTL_SEC = int(os.getenv("CACHE_SHARED_TTL_SEC", "600"))
+MEMBERSHIP_CACHE_TTL_SEC = int(os.getenv("MEMBERSHIP_CACHE_TTL_SEC", "60"))
+SHARED_NEG_TTL_SEC = float(os.getenv("SHARED_NEG_TTL_SEC", "5"))
+
+class CacheBackend(abc.ABC):
+    """(namespace, *id) kalitli TTL'li kesh. get() None qaytarsa — miss."""
+    tier = "base"
+
+    def __init__(self):
+        self.stats = {"hit": 0, "miss": 0, "set": 0, "delete": 0, "error": 0}
+
+    @abc.abstractmethod
+    async def get(self, key: tuple):
+        ...
+
+    async def get_many(self, keys: list[tuple]) -> list:
+        return [await self.get(k) for k in keys]
+
+    @abc.abstractmethod
+    async def set(self, key: tuple, value, ttl: float):
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key: tuple):
+        ...
+
+    @abc.abstractmethod
+    async def clear_chat(self, ns: str, chat_id: int):
+        """ns bo'yicha chat_id ga tegishli barcha kalitlarni o'chirish."""
+
+    def close(self):
+        pass
+
+class _TtlStore:
+    """LRU + TTL lug'at; LocalCache va umumiy server store uchun umumiy (thread-safe)."""
+
+    def __init__(self, max_items: int):
+        self._data: "OrderedDict[tuple, tuple[object, float]]" = OrderedDict()
+        self._max = max_items
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list[tuple]) -> list:
+        now = time.monotonic()
+        out = []
+        with self._lock:
+            for k in keys:
+                entry = self._data.get(k)
+                if entry is None:
+                    out.append(None)
+                elif entry[1] <= now:
+                    del self._data[k]
+                    out.append(None)
+                else:
+                    self._data.move_to_end(k)
+                    out.append(entry[0])
+        return out
+
+    def set(self, key: tuple, value, ttl: float):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max:
+                self._data.popitem(last=False)
+
+    def delete(self, key: tuple):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear_chat(self, ns: str, chat_id: int):
+        with self._lock:
+            for k in [k for k in self._data if k[0] == ns and k[1] == chat_id]:
+                del self._data[k]
+
+    def size(self) -> int:
+        return len(self._data)
+
+class LocalCache(CacheBackend):
+    tier = "local"
+
+    def __init__(self, max_items: int = CACHE_LOCAL_MAX):
+        super().__init__()
+        self._store = _TtlStore(max_items)
+
+    def _count(self, values: list) -> list:
+        hits = sum(v is not None for v in values)
+        self.stats["hit"] += hits
+        self.stats["miss"] += len(values) - hits
+        return values
+
+    async def get(self, key: tuple):
+        return self._count(self._store.get_many([key]))[0]
+
+    async def get_many(self, keys: list[tuple]) -> list:
+        return self._count(self._store.get_many(keys))
+
+    async def set(self, key: tuple, value, ttl: float):
+        self.stats["set"] += 1
+        self._store.set(key, value, ttl)
+
+    async def delete(self, key: tuple):
+        self.stats["delete"] += 1
+        self._store.delete(key)
+
+    async def clear_chat(self, ns: str, chat_id: int):
+        self.stats["delete"] += 1
+        self._store.clear_chat(ns, chat_id)
+
+class _CacheServerManager(BaseManager):
+    pass
+
+class _CacheClientManager(BaseManager):
+    pass
+
+_CacheClientManager.register("store")
+
+def _cache_authkey() -> bytes:
+    raw = os.getenv("CACHE_AUTHKEY") or f"tge-bot-cache:{TOKEN}"
+    return hashlib.sha256(raw.encode()).digest()
+
+def start_cache_server(address: str = CACHE_SOCKET):
+    """Umumiy store'ni joriy jarayonda (fon thread) ishga tushirish. server qaytaradi."""
+    store = _TtlStore(CACHE_SHARED_MAX)
+    _CacheServerManager.register("store", callable=lambda: store)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(address)  # avvalgi ishga tushirishdan qolgan socket
+    server = _CacheServerManager(address=address, authkey=_cache_authkey()).get_server()
+    threading.Thread(target=server.serve_forever, daemon=True, name="cache-server").start()
+    log.info("Umumiy cache server: %s", address)
+    return server
+
+class SharedCache(CacheBackend):
+    """Unix socket orqali umumiy store. Bloklovchi proxy chaqiruvlari alohida thread'da;
+    server yo'q bo'lsa RETRY_SEC davomida miss qaytaradi (L1 va DB ishlashda davom etadi)."""
+    tier = "shared"
+    RETRY_SEC = 5.0
+
+    def __init__(self, address: str = CACHE_SOCKET):
+        super().__init__()
+        self._address = address
+        self._proxy = None
+        self._down_until = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-cache")
+
+    def _call(self, method: str, *args):
+        if self._proxy is None:
+            mgr = _CacheClientManager(address=self._address, authkey=_cache_authkey())
+            mgr.connect()
+            self._proxy = mgr.store()
+        try:
+            return getattr(self._proxy, method)(*args)
+        except Exception:
+            self._proxy = None
+            raise
+
+    async def _run(self, method: str, *args):
+        if time.monotonic() < self._down_until:
+            raise ConnectionError("shared cache mavjud emas")
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, self._call, method, *args)
+        except Exception as e:
+            if not self._down_until:
+                log.warning("Shared cache (%s) xatolik: %r", self._address, e)
+            self._down_until = time.monotonic() + self.RETRY_SEC
+            raise
+        self._down_until = 0.0
+        return result
+
+    async def get_many(self, keys: list[tuple]) -> list:
+        try:
+            values = await self._run("get_many", keys)
+        except Exception:
+            self.stats["error"] += 1
+            return [None] * len(keys)
+        hits = sum(v is not None for v in values)
+        self.stats["hit"] += hits
+        self.stats["miss"] += len(values) - hits
+        return values
+
+    async def get(self, key: tuple):
+        return (await self.get_many([key]))[0]
 
-async def get_group_settings(chat_id: int) -> dict:
+    async def _write(self, stat: str, method: str, *args):
+        try:
+            await self._run(method, *args)
+            self.stats[stat] += 1
+        except Exception:
+            self.stats["error"] += 1
+
+    async def set(self, key: tuple, value, ttl: float):
+        await self._write("set", "set", key, value, ttl)
+
+    async def delete(self, key: tuple):
+        await self._write("delete", "delete", key)
+
+    async def clear_chat(self, ns: str, chat_id: int):
+        await self._write("delete", "clear_chat", ns, chat_id)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+CACHE_L1 = LocalCache()
+CACHE_L2: CacheBackend | None = None  # init_cache_tier() da
+
+def init_cache_tier():
+    global CACHE_L2
+    use_shared = CACHE_BACKEND == "shared" or (CACHE_BACKEND == "auto" and WORKER_INDEX is not None)
+    if use_shared and CACHE_L2 is None:
+        CACHE_L2 = SharedCache()
+        log.info("Cache tier: local + shared (%s)", CACHE_SOCKET)
+
+async def cache_get(key: tuple):
+    """L1 (LocalCache) → L2 (shared). L2 hit L1'ga qisqa TTL bilan yoziladi."""
+    v = await CACHE_L1.get(key)
+    if v is None and CACHE_L2 is not None:
+        v = await CACHE_L2.get(key)
+        if v is not None:
+            await CACHE_L1.set(key, v, _GROUP_SETTINGS_TTL_SEC)
+    return v
+
+async def cache_set(key: tuple, value, ttl: float = CACHE_SHARED_TTL_SEC, *, local: bool = True):
+    if ttl <= 0:
+        return await cache_delete(key)
+    if local:
+        await CACHE_L1.set(key, value, ttl)
+    if CACHE_L2 is not None:
+        await CACHE_L2.set(key, value, ttl)
+
+async def cache_delete(key: tuple):
+    await CACHE_L1.delete(key)
+    if CACHE_L2 is not None:
+        await CACHE_L2.delete(key)
+
+def _settings_to_shared(s: GroupSettings) -> dict:
+    # Frozen+slots dataclass o'rniga oddiy dict: pickle Python versiyalari orasida barqaror
+    return {f.name: getattr(s, f.name) for f in dataclasses.fields(s) if f.init}
+
+def _block_ttl(until_dt) -> float:
+    return (until_dt - datetime.now(timezone.utc)).total_seconds() if until_dt else 0.0
+
+async def pull_shared_state(chat_id: int, user_id: int) -> tuple[bool, object]:
+    """L2'dagi imtiyoz va blok: (has_priv, block_until). Settings L1'da bo'lmasa — u ham.
+
+    L2 qiymatlari jarayon lug'atlariga (_GROUP_PRIV_MEM, BLOK_VAQTLARI — TTL'siz) yozilmaydi,
+    CACHE_L1 da _GROUP_SETTINGS_TTL_SEC turadi: boshqa replikadagi revoke/clear shu muddatda
+    ko'rinadi. L2 miss ham SHARED_NEG_TTL_SEC eslab qolinadi — har xabarda round-trip yo'q.
+    """
+    if CACHE_L2 is None:
+        return False, None
+    ukeys = [("priv", chat_id, user_id), ("blk", chat_id, user_id)]
+    vals = await CACHE_L1.get_many(ukeys)
+    want_settings = chat_id not in _GROUP_SETTINGS_CACHE
+    missing = [i for i, v in enumerate(vals) if v is None]
+    if want_settings or missing:
+        keys = [ukeys[i] for i in missing] + ([("gs", chat_id)] if want_settings else [])
+        got = await CACHE_L2.get_many(keys)
+        for i, v in zip(missing, got):
+            vals[i] = False if v is None else v
+            await CACHE_L1.set(ukeys[i], vals[i], SHARED_NEG_TTL_SEC if v is None else _GROUP_SETTINGS_TTL_SEC)
+        if want_settings and got[-1] is not None:
+            _GROUP_SETTINGS_CACHE[chat_id] = (GroupSettings(**got[-1]), time.monotonic())
+    priv, until = vals
+    return bool(priv), (until or None)
+
+async def get_group_settings(chat_id: int) -> GroupSettings:
     """Fetch group settings from DB (cached).
 
     Muhim: DB vaqtincha uzilib qolsa ham, guruh sozlamalari (tun/kanal/majbur)
     "o'z-o'zidan o'chib ketmasligi" uchun oxirgi cache qilingan qiymat qaytariladi.
     """
-    import time
     now = time.monotonic()
     cached = _GROUP_SETTINGS_CACHE.get(chat_id)
     if cached and (now - cached[1]) < _GROUP_SETTINGS_TTL_SEC:
-        return dict(cached[0])
+        return cached[0]
+
+    if not cached and CACHE_L2 is not None:
+        shared = await CACHE_L2.get(("gs", chat_id))
+        if shared is not None:
+            s = GroupSettings(**shared)
+            _GROUP_SETTINGS_CACHE[chat_id] = (s, now)
+            return s
 
     # Cache bo'lsa, DB xatoda shuni qaytaramiz; bo'lmasa default.
-    fallback = dict(cached[0]) if cached else _default_group_settings()
+    fallback = cached[0] if cached else _default_group_settings()
 
-    if not DB_POOL:
-        # DB yo'q bo'lsa ham cache yangilanadi
-        _GROUP_SETTINGS_CACHE[chat_id] = (dict(fallback), now)
-        return dict(fallback)
+    if not db_ready():
+        # DB yo'q (yoki breaker ochiq) bo'lsa ham cache yangilanadi
+        _GROUP_SETTINGS_CACHE[chat_id] = (fallback, now)
+        return fallback
 
     s = _default_group_settings()
     try:
-        async with DB_POOL.acquire() as con:
+        async with db_conn() as con:
             row = await con.fetchrow(
-                "SELECT tun, kanal_username, majbur_limit FROM group_settings WHERE chat_id=$1;",
+                f"SELECT {_GROUP_SETTINGS_COLS} FROM group_settings WHERE chat_id=$1;",
                 chat_id
             )
         if row:
-            s["tun"] = bool(row["tun"])
-            s["kanal_username"] = row["kanal_username"]
-            s["majbur_limit"] = int(row["majbur_limit"] or 0)
+            s = _settings_from_row(row)
         else:
             # ensure row exists
-            async with DB_POOL.acquire() as con:
+            async with db_conn() as con:
                 await con.execute(
                     "INSERT INTO group_settings (chat_id) VALUES ($1) ON CONFLICT DO NOTHING;",
                     chat_id
                 )
     except Exception as e:
         # DB xatoda: oxirgi cache (yoki default) bilan davom etamiz
-        log.warning(f"get_group_settings xatolik (cache bilan davom): {e}")
-        return dict(fallback)
+        log.warning("get_group_settings xatolik (cache bilan davom): %s", e)
+        return fallback
 
-    _GROUP_SETTINGS_CACHE[chat_id] = (dict(s), now)
-    return dict(s)
+    _GROUP_SETTINGS_CACHE[chat_id] = (s, now)
+    await cache_set(("gs", chat_id), _settings_to_shared(s), local=False)
+    return s
 
 # Sentinel: differenciate between "parameter not provided" vs explicit None (e.g., /kanaloff)
 _GROUP_SETTINGS_UNSET = object()
 
-async def set_group_settings(chat_id: int, *, tun=_GROUP_SETTINGS_UNSET, kanal_username=_GROUP_SETTINGS_UNSET, majbur_limit=_GROUP_SETTINGS_UNSET):
+# DB ulanmasdan oldin (cache-only rejimda) o'zgartirilgan guruhlar: chat_id -> o'zgargan ustunlar.
+# Cache'dagi qolgan maydonlar DB'dagi haqiqiy qiymat emas (default), shuning uchun faqat shu ustunlar yoziladi.
+_GROUP_SETTINGS_DIRTY: dict[int, set[str]] = {}
+
+async def _write_group_settings_fields(chat_id: int, s: GroupSettings, fields):
+    """Faqat berilgan ustunlarni upsert qilish (qolganlari DB'dagi qiymatida qoladi)."""
+    cols = sorted(fields)
+    if not cols:
+        return
+    await db_write(
+        "set_group_settings",
+        f"""
+        INSERT INTO group_settings (chat_id, {', '.join(cols)}, updated_at)
+        VALUES ($1, {', '.join(f'${i}' for i in range(2, len(cols) + 2))}, now())
+        ON CONFLICT (chat_id) DO UPDATE SET
+            {', '.join(f'{c}=EXCLUDED.{c}' for c in cols)},
+            updated_at=now();
+        """,
+        chat_id, *(getattr(s, c) for c in cols)
+    )
+
+async def _flush_dirty_group_settings():
+    """Cache-only rejimda qilingan /tun, /kanal, /majbur o'zgarishlarini DB'ga yozish."""
+    dirty = dict(_GROUP_SETTINGS_DIRTY)
+    _GROUP_SETTINGS_DIRTY.clear()
+    for chat_id, fields in dirty.items():
+        cached = _GROUP_SETTINGS_CACHE.get(chat_id)
+        if not cached:
+            continue
+        await _write_group_settings_fields(chat_id, cached[0], fields)
+        # Keyingi o'qish DB'dagi birlashgan qatorni olsin (DB xatosida cache fallback bo'lib qoladi)
+        _GROUP_SETTINGS_CACHE[chat_id] = (cached[0], 0.0)
+    if dirty:
+        log.info("Cache-only rejimdagi %s ta guruh sozlamasi DB'ga yozildi.", len(dirty))
+
+async def set_group_settings(chat_id: int, *, tun=_GROUP_SETTINGS_UNSET, kanal_username=_GROUP_SETTINGS_UNSET, majbur_limit=_GROUP_SETTINGS_UNSET,
+                             tun_start=_GROUP_SETTINGS_UNSET, tun_end=_GROUP_SETTINGS_UNSET, kanal_join=_GROUP_SETTINGS_UNSET,
+                             majbur_pre=_GROUP_SETTINGS_UNSET):
     """Upsert group settings for chat_id.
 
     Important:
     - If a parameter is not provided (_GROUP_SETTINGS_UNSET), the existing value is preserved.
     - If kanal_username=None is provided, it is stored as None (this is needed for /kanaloff).
     """
+    # Keep unspecified fields unchanged (read current first)
+    changes = {}
+    if tun is not _GROUP_SETTINGS_UNSET:
+        changes["tun"] = bool(tun)
+    if kanal_username is not _GROUP_SETTINGS_UNSET:
+        changes["kanal_username"] = kanal_username
+    if majbur_limit is not _GROUP_SETTINGS_UNSET:
+        changes["majbur_limit"] = int(majbur_limit)
+    if tun_start is not _GROUP_SETTINGS_UNSET:
+        changes["tun_start"] = tun_start
+    if tun_end is not _GROUP_SETTINGS_UNSET:
+        changes["tun_end"] = tun_end
+    if kanal_join is not _GROUP_SETTINGS_UNSET:
+        changes["kanal_join"] = bool(kanal_join)
+    if majbur_pre is not _GROUP_SETTINGS_UNSET:
+        changes["majbur_pre"] = bool(majbur_pre)
+    cur = dataclasses.replace(await get_group_settings(chat_id), **changes)
+    _GROUP_SETTINGS_CACHE[chat_id] = (cur, time.monotonic())
+
     if not DB_POOL:
-        # cache-only fallback
-        cur = await get_group_settings(chat_id)
-        if tun is not _GROUP_SETTINGS_UNSET:
-            cur["tun"] = bool(tun)
-        if kanal_username is not _GROUP_SETTINGS_UNSET:
-            cur["kanal_username"] = kanal_username
-        if majbur_limit is not _GROUP_SETTINGS_UNSET:
-            cur["majbur_limit"] = int(majbur_limit)
-        _GROUP_SETTINGS_CACHE[chat_id] = (cur, __import__("time").monotonic())
+        # cache-only fallback (DB ulanganda _flush_dirty_group_settings faqat shu ustunlarni yozadi)
+        _GROUP_SETTINGS_DIRTY.setdefault(chat_id, set()).update(changes)
         return
 
-    # Keep unspecified fields unchanged (read current first)
-    cur = await get_group_settings(chat_id)
-    if tun is _GROUP_SETTINGS_UNSET:
-        tun = cur["tun"]
-    if kanal_username is _GROUP_SETTINGS_UNSET:
-        kanal_username = cur["kanal_username"]
-    if majbur_limit is _GROUP_SETTINGS_UNSET:
-        majbur_limit = cur["majbur_limit"]
-
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                """
-                INSERT INTO group_settings (chat_id, tun, kanal_username, majbur_limit, updated_at)
-                VALUES ($1,$2,$3,$4, now())
-                ON CONFLICT (chat_id) DO UPDATE SET
-                    tun=EXCLUDED.tun,
-                    kanal_username=EXCLUDED.kanal_username,
-                    majbur_limit=EXCLUDED.majbur_limit,
-                    updated_at=now();
-                """,
-                chat_id, bool(tun), kanal_username, int(majbur_limit)
-            )
-        _GROUP_SETTINGS_CACHE[chat_id] = ({"tun": bool(tun), "kanal_username": kanal_username, "majbur_limit": int(majbur_limit)}, __import__("time").monotonic())
-    except Exception as e:
-        log.warning(f"set_group_settings xatolik: {e}")
+    await cache_set(("gs", chat_id), _settings_to_shared(cur), local=False)
+    # Faqat o'zgargan ustunlar: cache eskirgan/default bo'lsa ham boshqa maydonlar ustiga yozilmaydi
+    await _write_group_settings_fields(chat_id, cur, changes)
 
 async def group_has_priv(chat_id: int, user_id: int) -> bool:
 
@@ -1695,12 +3030,15 @@ async def group_has_priv(chat_id: int, user_id: int) -> bool:
     except Exception:
         pass
 
-    if not DB_POOL:
-        # DB yo'q bo'lsa ham cache ishlaydi
+    if (await pull_shared_state(chat_id, user_id))[0]:
+        return True
+
+    if not db_ready():
+        # DB yo'q (yoki breaker ochiq) bo'lsa ham cache ishlaydi
         return user_id in _GROUP_PRIV_MEM.get(chat_id, set())
 
     try:
-        async with DB_POOL.acquire() as con:
+        async with db_conn() as con:
             v = await con.fetchval(
                 "SELECT 1 FROM group_privileges WHERE chat_id=$1 AND user_id=$2;",
                 chat_id, user_id
@@ -1710,7 +3048,7 @@ async def group_has_priv(chat_id: int, user_id: int) -> bool:
             _GROUP_PRIV_MEM[chat_id].add(user_id)
         return ok
     except Exception as e:
-        log.warning(f"group_has_priv xatolik: {e}")
+        log.warning("group_has_priv xatolik: %s", e)
         # DB vaqtincha muammo qilsa ham cache'dan qaytamiz
         return user_id in _GROUP_PRIV_MEM.get(chat_id, set())
 
@@ -1720,118 +3058,129 @@ async def grant_priv_db(chat_id: int, user_id: int):
         _GROUP_PRIV_MEM[chat_id].add(user_id)
     except Exception:
         pass
+    await cache_set(("priv", chat_id, user_id), True, local=False)
 
-    if not DB_POOL:
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                "INSERT INTO group_privileges (chat_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;",
-                chat_id, user_id
-            )
-    except Exception as e:
-        log.warning(f"grant_priv_db xatolik: {e}")
+    await db_write(
+        "grant_priv_db",
+        "INSERT INTO group_privileges (chat_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;",
+        chat_id, user_id
+    )
 
 async def revoke_priv_db(chat_id: int, user_id: int):
     # Cache'dan o'chiramiz
+    _invalidate_mod_ctx(chat_id, user_id)
     try:
         if chat_id in _GROUP_PRIV_MEM:
             _GROUP_PRIV_MEM[chat_id].discard(user_id)
     except Exception:
         pass
+    await cache_delete(("priv", chat_id, user_id))
 
-    if not DB_POOL:
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                "DELETE FROM group_privileges WHERE chat_id=$1 AND user_id=$2;",
-                chat_id, user_id
-            )
-    except Exception as e:
-        log.warning(f"revoke_priv_db xatolik: {e}")
+    await db_write(
+        "revoke_priv_db",
+        "DELETE FROM group_privileges WHERE chat_id=$1 AND user_id=$2;",
+        chat_id, user_id
+    )
 
 async def clear_privs_db(chat_id: int):
-    if not DB_POOL:
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute("DELETE FROM group_privileges WHERE chat_id=$1;", chat_id)
-    except Exception:
-        pass
-
-async def get_user_count_db(chat_id: int, user_id: int) -> int:
-    if not DB_POOL:
+    _GROUP_PRIV_MEM.pop(chat_id, None)
+    _MOD_CTX_MEMO.clear()
+    await CACHE_L1.clear_chat("priv", chat_id)
+    if CACHE_L2 is not None:
+        await CACHE_L2.clear_chat("priv", chat_id)
+    await db_write("clear_privs_db", "DELETE FROM group_privileges WHERE chat_id=$1;", chat_id)
+
+async def get_user_count_db(chat_id: int, user_id: int) -> int | None:
+    """Foydalanuvchi hisobi. DB rejimida DB javob bermasa — oxirgi memo qiymati,
+    u ham bo'lmasa None (noma'lum: chaqiruvchi foydalanuvchini bloklamasligi kerak)."""
+    if DB_POOL is None:
         try:
             return int(_GROUP_COUNTS_MEM[chat_id].get(user_id, 0))
         except Exception:
             return 0
-    try:
-        async with DB_POOL.acquire() as con:
-            v = await con.fetchval(
-                "SELECT cnt FROM group_user_counts WHERE chat_id=$1 AND user_id=$2;",
-                chat_id, user_id
-            )
-        return int(v or 0)
-    except Exception:
-        return 0
+    if db_ready():
+        try:
+            async with db_conn() as con:
+                v = await con.fetchval(
+                    "SELECT cnt FROM group_user_counts WHERE chat_id=$1 AND user_id=$2;",
+                    chat_id, user_id
+                )
+            return int(v or 0)
+        except Exception as e:
+            log.warning("get_user_count_db xatolik: %s", e)
+    hit = _MOD_CTX_MEMO.get(_pk(chat_id, user_id))
+    return hit[3] if hit else None
+
+async def inc_user_count_db(chat_id: int, user_id: int, delta: int = 1, *, bot=None) -> int | None:
+    """Hisobni oshirish; yangi qiymatni qaytaradi (xatoda None).
 
-async def inc_user_count_db(chat_id: int, user_id: int, delta: int = 1):
+    bot berilsa — limitga yetgan oldindan cheklangan foydalanuvchi shu yerda ochiladi.
+    """
+    cnt = await _inc_user_count(chat_id, user_id, delta)
+    if bot is not None and cnt is not None:
+        limit = (await get_group_settings(chat_id)).majbur_limit
+        await release_if_reached(bot, chat_id, user_id, int(cnt), limit)
+    return cnt
+
+async def _inc_user_count(chat_id: int, user_id: int, delta: int) -> int | None:
+    _invalidate_mod_ctx(chat_id, user_id)
+    sql = """
+        INSERT INTO group_user_counts (chat_id, user_id, cnt, updated_at)
+        VALUES ($1,$2,$3, now())
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            cnt = group_user_counts.cnt + EXCLUDED.cnt,
+            updated_at = now()
+        RETURNING cnt;
+        """
     if not DB_POOL:
+        if _db_attaching():
+            # Delta DB ulangach qo'shiladi (xotiradagi qiymat shu oyna uchun)
+            _queue_db_replay("inc_user_count_db", sql, (chat_id, user_id, int(delta)))
         try:
             _GROUP_COUNTS_MEM[chat_id][user_id] = int(_GROUP_COUNTS_MEM[chat_id].get(user_id, 0)) + int(delta)
+            return _GROUP_COUNTS_MEM[chat_id][user_id]
         except Exception:
-            pass
-        return
+            return None
+    if _DB_REPLAY or not DB_BREAKER.allow():
+        # Breaker ochiq: hisob yo'qolmasin — DB tiklanganda qo'shiladi (yangi qiymat noma'lum)
+        _queue_db_replay("inc_user_count_db", sql, (chat_id, user_id, int(delta)))
+        return None
     try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                """
-                INSERT INTO group_user_counts (chat_id, user_id, cnt, updated_at)
-                VALUES ($1,$2,$3, now())
-                ON CONFLICT (chat_id, user_id) DO UPDATE SET
-                    cnt = group_user_counts.cnt + EXCLUDED.cnt,
-                    updated_at = now();
-                """,
-                chat_id, user_id, int(delta)
-            )
+        async with db_conn() as con:
+            return await con.fetchval(sql, chat_id, user_id, int(delta))
     except Exception as e:
-        log.warning(f"inc_user_count_db xatolik: {e}")
+        if _is_transient_db_error(e):
+            _queue_db_replay("inc_user_count_db", sql, (chat_id, user_id, int(delta)))
+        log.warning("inc_user_count_db xatolik: %s", e)
+        return None
 
 async def set_user_count_db(chat_id: int, user_id: int, cnt: int):
+    _invalidate_mod_ctx(chat_id, user_id)
     if not DB_POOL:
         try:
             _GROUP_COUNTS_MEM[chat_id][user_id] = int(cnt)
         except Exception:
             pass
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                """
-                INSERT INTO group_user_counts (chat_id, user_id, cnt, updated_at)
-                VALUES ($1,$2,$3, now())
-                ON CONFLICT (chat_id, user_id) DO UPDATE SET
-                    cnt=EXCLUDED.cnt,
-                    updated_at=now();
-                """,
-                chat_id, user_id, int(cnt)
-            )
-    except Exception:
-        pass
+    await db_write(
+        "set_user_count_db",
+        """
+        INSERT INTO group_user_counts (chat_id, user_id, cnt, updated_at)
+        VALUES ($1,$2,$3, now())
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            cnt=EXCLUDED.cnt,
+            updated_at=now();
+        """,
+        chat_id, user_id, int(cnt)
+    )
 
 async def clear_group_counts_db(chat_id: int):
+    _MOD_CTX_MEMO.clear()
     if not DB_POOL:
         try:
             _GROUP_COUNTS_MEM.pop(chat_id, None)
         except Exception:
             pass
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute("DELETE FROM group_user_counts WHERE chat_id=$1;", chat_id)
-    except Exception:
-        pass
+    await db_write("clear_group_counts_db", "DELETE FROM group_user_counts WHERE chat_id=$1;", chat_id)
 
 async def top_group_counts_db(chat_id: int, limit: int = 100):
     if not DB_POOL:
@@ -1842,7 +3191,7 @@ async def top_group_counts_db(chat_id: int, limit: int = 100):
         except Exception:
             return []
     try:
-        async with DB_POOL.acquire() as con:
+        async with db_conn() as con:
             rows = await con.fetch(
                 "SELECT user_id, cnt FROM group_user_counts WHERE chat_id=$1 ORDER BY cnt DESC, user_id ASC LIMIT $2;",
                 chat_id, int(limit)
@@ -1856,11 +3205,14 @@ async def get_block_until_db(chat_id: int, user_id: int):
     1) Avval in-memory BLOK_VAQTLARI'ni tekshiradi (DB ishlamay qolsa ham cooldown ishlashi uchun).
     2) DB bo'lsa — DB'dan ham tekshiradi va eng kattasini qaytaradi.
     """
-    mem_until = BLOK_VAQTLARI.get((chat_id, user_id))
-    if not DB_POOL:
+    mem_until = BLOK_VAQTLARI.get(_pk(chat_id, user_id))
+    _, shared_until = await pull_shared_state(chat_id, user_id)
+    if shared_until and (not mem_until or shared_until > mem_until):
+        mem_until = shared_until
+    if not db_ready():
         return mem_until
     try:
-        async with DB_POOL.acquire() as con:
+        async with db_conn() as con:
             row = await con.fetchrow(
                 "SELECT until_date FROM group_blocks WHERE chat_id=$1 AND user_id=$2;",
                 chat_id, user_id
@@ -1873,47 +3225,208 @@ async def get_block_until_db(chat_id: int, user_id: int):
         return mem_until
 async def set_block_until_db(chat_id: int, user_id: int, until_dt):
     # Har doim in-memory'ni yangilab boramiz (DB xatosida ham cooldown ishlasin)
-    BLOK_VAQTLARI[(chat_id, user_id)] = until_dt
-    if not DB_POOL:
-        return
-    try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                """
-                INSERT INTO group_blocks (chat_id, user_id, until_date, updated_at)
-                VALUES ($1,$2,$3, now())
-                ON CONFLICT (chat_id, user_id) DO UPDATE SET
-                    until_date=EXCLUDED.until_date,
-                    updated_at=now();
-                """,
-                chat_id, user_id, until_dt
-            )
-    except Exception:
-        pass
+    BLOK_VAQTLARI[_pk(chat_id, user_id)] = until_dt
+    _invalidate_mod_ctx(chat_id, user_id)
+    await cache_set(("blk", chat_id, user_id), until_dt, _block_ttl(until_dt), local=False)
+    await db_write(
+        "set_block_until_db",
+        """
+        INSERT INTO group_blocks (chat_id, user_id, until_date, updated_at)
+        VALUES ($1,$2,$3, now())
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            until_date=EXCLUDED.until_date,
+            updated_at=now();
+        """,
+        chat_id, user_id, until_dt
+    )
 async def clear_block_db(chat_id: int, user_id: int):
     # In-memory'dan har doim o'chiramiz
-    BLOK_VAQTLARI.pop((chat_id, user_id), None)
-    if not DB_POOL:
-        return
+    BLOK_VAQTLARI.pop(_pk(chat_id, user_id), None)
+    _invalidate_mod_ctx(chat_id, user_id)
+    await cache_delete(("blk", chat_id, user_id))
+    await db_write(
+        "clear_block_db",
+        "DELETE FROM group_blocks WHERE chat_id=$1 AND user_id=$2;",
+        chat_id, user_id
+    )
+
+# --------- Hot-path: bitta so'rov bilan moderatsiya konteksti ----------
+# Bitta xabar uchun settings + imtiyoz + blok + hisob bitta round-trip'da olinadi.
+# majbur_filter va reklama_va_soz_filtri bir xil update uchun ketma-ket ishlaydi,
+# shuning uchun natija qisqa muddat (chat_id, user_id) bo'yicha saqlanadi.
+_MOD_CTX_MEMO = {}  # _pk(chat_id, user_id) -> (fetched_monotonic, db_priv, db_block_until, cnt)
+_MOD_CTX_TTL_SEC = 2.0
+_MOD_CTX_MEMO_MAX = 50000
+
+_MOD_CTX_SQL = """
+    SELECT gs.chat_id IS NOT NULL AS has_settings,
+           gs.tun, gs.kanal_username, gs.majbur_limit, gs.tun_start, gs.tun_end, gs.kanal_join, gs.majbur_pre,
+           gp.user_id IS NOT NULL AS has_priv,
+           gv.user_id IS NOT NULL AS is_verified,
+           gb.until_date,
+           gc.cnt
+    FROM (SELECT $1::BIGINT AS chat_id, $2::BIGINT AS user_id) k
+    LEFT JOIN group_settings gs ON gs.chat_id = k.chat_id
+    LEFT JOIN group_privileges gp ON gp.chat_id = k.chat_id AND gp.user_id = k.user_id
+    LEFT JOIN group_blocks gb ON gb.chat_id = k.chat_id AND gb.user_id = k.user_id
+    LEFT JOIN group_user_counts gc ON gc.chat_id = k.chat_id AND gc.user_id = k.user_id
+    LEFT JOIN group_verified gv ON gv.chat_id = k.chat_id AND gv.user_id = k.user_id;
+"""
+
+def _invalidate_mod_ctx(chat_id: int, user_id: int):
+    _MOD_CTX_MEMO.pop(_pk(chat_id, user_id), None)
+
+def _merge_mod_ctx(chat_id: int, user_id: int, db_priv: bool, db_until, cnt: int, shared=(False, None)) -> dict:
+    # In-memory qiymatlar har doim ustun (DB kechiksa ham blok/imtiyoz darhol ishlasin);
+    # shared — pull_shared_state natijasi (boshqa jarayonlar qo'ygan imtiyoz/blok)
+    cached = _GROUP_SETTINGS_CACHE.get(chat_id)
+    settings = cached[0] if cached else _default_group_settings()
+    until = db_until
+    for other in (BLOK_VAQTLARI.get(_pk(chat_id, user_id)), shared[1]):
+        if other and (not until or other >= until):
+            until = other
+    return {
+        "settings": settings,
+        "has_priv": bool(db_priv) or shared[0] or user_id in _GROUP_PRIV_MEM.get(chat_id, set()),
+        "block_until": until,
+        "cnt": None if cnt is None else int(cnt),
+        "verified": user_id in _GROUP_VERIFIED_MEM.get(chat_id, set()),
+    }
+
+@traced("mod_ctx")
+async def get_moderation_context(chat_id: int, user_id: int) -> dict:
+    """Moderatsiya qarori uchun hamma narsa: settings, has_priv, block_until, cnt.
+
+    DB bo'lsa — bitta LEFT JOIN so'rovi (cache-miss = 1 round-trip).
+    DB bo'lmasa yoki xato bo'lsa — in-memory qiymatlar bilan davom etadi.
+    """
+    now = time.monotonic()
+    key = _pk(chat_id, user_id)
+    hit = _MOD_CTX_MEMO.get(key)
+    # L1 hit'da lokal; L2 round-trip faqat L1 nusxasi eskirganda
+    shared = await pull_shared_state(chat_id, user_id)
+    if hit and (now - hit[0]) < _MOD_CTX_TTL_SEC and chat_id in _GROUP_SETTINGS_CACHE:
+        return _merge_mod_ctx(chat_id, user_id, hit[1], hit[2], hit[3], shared)
+
+    if not db_ready():
+        if hit and chat_id in _GROUP_SETTINGS_CACHE:
+            # Breaker ochiq: eskirgan bo'lsa ham oxirgi ma'lum kontekst 0 dan yaxshiroq
+            return _merge_mod_ctx(chat_id, user_id, hit[1], hit[2], hit[3], shared)
+        await get_group_settings(chat_id)
+        cnt = await get_user_count_db(chat_id, user_id)
+        return _merge_mod_ctx(chat_id, user_id, False, None, cnt, shared)
+
     try:
-        async with DB_POOL.acquire() as con:
-            await con.execute(
-                "DELETE FROM group_blocks WHERE chat_id=$1 AND user_id=$2;",
-                chat_id, user_id
-            )
-    except Exception:
-        pass
+        async with db_conn() as con:
+            row = await con.fetchrow(_MOD_CTX_SQL, chat_id, user_id)
+            if not row["has_settings"]:
+                # ensure row exists (guruh uchun faqat birinchi marta)
+                await con.execute(
+                    "INSERT INTO group_settings (chat_id) VALUES ($1) ON CONFLICT DO NOTHING;",
+                    chat_id
+                )
+    except Exception as e:
+        log.warning("get_moderation_context xatolik (cache bilan davom): %s", e)
+        cached = _GROUP_SETTINGS_CACHE.get(chat_id)
+        if not cached:
+            _GROUP_SETTINGS_CACHE[chat_id] = (_default_group_settings(), 0.0)
+        cnt = hit[3] if hit else None
+        return _merge_mod_ctx(chat_id, user_id, False, None, cnt, shared)
+
+    s = _settings_from_row(row) if row["has_settings"] else _default_group_settings()
+    _GROUP_SETTINGS_CACHE[chat_id] = (s, now)
+    if row["has_priv"]:
+        _GROUP_PRIV_MEM[chat_id].add(user_id)
+    if row["is_verified"]:
+        _GROUP_VERIFIED_MEM[chat_id].add(user_id)
+
+    if len(_MOD_CTX_MEMO) >= _MOD_CTX_MEMO_MAX:
+        _MOD_CTX_MEMO.clear()
+    _MOD_CTX_MEMO[key] = (now, bool(row["has_priv"]), row["until_date"], int(row["cnt"] or 0))
+    return _merge_mod_ctx(chat_id, user_id, row["has_priv"], row["until_date"], row["cnt"], shared)
+
 # --------- Override: kanal_tekshir per-group ----------
+# Kanal a'zoligi indeksi: bot admin bo'lgan majburiy kanallar uchun Telegram chat_member
+# update'larini push qiladi. Indeks dangasa to'ldiriladi (birinchi get_chat_member natijasi)
+# va keyin push'lar bilan yangilanib boradi. Bot admin bo'lmagan kanallar uchun har safar
+# get_chat_member (eski xatti-harakat).
+CHANNEL_MEMBER_STATUSES = ("member", "creator", "administrator")
+# Katta kanallarda indeks cheksiz o'smasin: har kanal uchun LRU, eng eskisi tashlanadi
+CHANNEL_INDEX_MAX = int(os.getenv("CHANNEL_INDEX_MAX", "100000"))
+_CHANNEL_INDEX: "dict[str, OrderedDict[int, bool]]" = {}  # "@kanal" (lower) -> {user_id: a'zomi}
+_CHANNEL_PUSH: dict[str, tuple[bool, float]] = {}  # "@kanal" (lower) -> (bot adminmi, tekshirilgan monotonic)
+_CHANNEL_PUSH_TTL_SEC = int(os.getenv("CHANNEL_PUSH_TTL_SEC", "3600"))
+_CHANNEL_INDEX_STATS = {"hit": 0, "miss": 0}
+
+def _channel_push_reset(key: str, bot_is_admin: bool):
+    # Bot statusi o'zgarganda indeksni noldan boshlaymiz (oradagi push'lar yo'qolgan bo'lishi mumkin)
+    _CHANNEL_PUSH[key] = (bot_is_admin, time.monotonic())
+    if bot_is_admin:
+        _CHANNEL_INDEX[key] = OrderedDict()
+    else:
+        _CHANNEL_INDEX.pop(key, None)
+
+def _channel_index_put(idx: "OrderedDict[int, bool]", user_id: int, ok: bool):
+    idx[user_id] = ok
+    idx.move_to_end(user_id)
+    while len(idx) > CHANNEL_INDEX_MAX:
+        idx.popitem(last=False)
+
+async def _channel_index_for(key: str, kanal_username: str, bot) -> "OrderedDict[int, bool] | None":
+    st = _CHANNEL_PUSH.get(key)
+    if st is None or (time.monotonic() - st[1]) >= _CHANNEL_PUSH_TTL_SEC:
+        try:
+            me = await bot.get_chat_member(kanal_username, bot.id)
+            is_admin = me.status in ("administrator", "creator")
+        except Exception:
+            is_admin = False
+        if st is None or st[0] != is_admin:
+            _channel_push_reset(key, is_admin)
+        else:
+            _CHANNEL_PUSH[key] = (is_admin, time.monotonic())
+    return _CHANNEL_INDEX.get(key)
+
 async def kanal_tekshir(user_id: int, bot, kanal_username: str | None) -> bool:
     if not kanal_username:
         return True
+    idx = await _channel_index_for(kanal_username.lower(), kanal_username, bot)
+    if idx is not None:
+        cached = idx.get(user_id)
+        if cached is not None:
+            _CHANNEL_INDEX_STATS["hit"] += 1
+            idx.move_to_end(user_id)
+            return cached
+    _CHANNEL_INDEX_STATS["miss"] += 1
+    mkey = ("member", kanal_username.lower(), user_id)
+    if idx is None and await cache_get(mkey):
+        return True
     try:
         member = await bot.get_chat_member(kanal_username, user_id)
-        return member.status in ("member", "creator", "administrator")
+        ok = member.status in CHANNEL_MEMBER_STATUSES
+        if idx is not None:
+            _channel_index_put(idx, user_id, ok)
+        elif ok:
+            # Faqat ijobiy natija: endigina a'zo bo'lgan foydalanuvchi "tekshirish"da kutib qolmasin
+            await cache_set(mkey, True, MEMBERSHIP_CACHE_TTL_SEC)
+        return ok
     except Exception as e:
-        log.warning(f"kanal_tekshir xatolik: {e}")
+        log.warning("kanal_tekshir xatolik: %s", e)
         return False
 
+async def on_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Majburiy kanaldan kelgan chat_member push'lari bilan a'zolik indeksini yangilash."""
+    cmu = update.chat_member
+    chat = getattr(cmu, "chat", None)
+    if not cmu or not chat or chat.type != Chat.CHANNEL or not chat.username:
+        return
+    key = "@" + chat.username.lower()
+    idx = _CHANNEL_INDEX.get(key)
+    if idx is None:
+        # chat_member push kelayapti => bot shu kanalda admin
+        _channel_push_reset(key, True)
+        idx = _CHANNEL_INDEX[key]
+    _channel_index_put(idx, cmu.new_chat_member.user.id, cmu.new_chat_member.status in CHANNEL_MEMBER_STATUSES)
+
 
 # --- Multi-channel /kanal helpers (per-group) ---
 
@@ -1939,7 +3452,7 @@ def _parse_kanal_usernames(raw) -> list[str]:
         if not s:
             return []
         try:
-            j = __import__("json").loads(s)
+            j = json.loads(s)
             if isinstance(j, list):
                 vals = [str(x) for x in j]
             else:
@@ -1971,6 +3484,7 @@ def _unique_preserve(seq: list[str]) -> list[str]:
             seen.add(x)
     return out
 
+@traced("channels")
 async def _check_all_channels(user_id: int, bot, channels: list[str]) -> tuple[bool, list[str]]:
     missing: list[str] = []
     for ch in channels:
@@ -1979,19 +3493,168 @@ async def _check_all_channels(user_id: int, bot, channels: list[str]) -> tuple[b
             missing.append(ch)
     return (len(missing) == 0, missing)
 
+# --------- Tun rejimi: set_chat_permissions orqali guruhni yopish ----------
+# Har bir xabarni o'chirish o'rniga guruh bitta set_chat_permissions bilan yopiladi va
+# /tunoff (yoki jadval) bilan avvalgi ruxsatlar qaytariladi. Imtiyozli foydalanuvchilarga
+# shaxsiy ruxsat beriladi. Yopib bo'lmasa (bot huquqi yo'q) — eski usul: xabarlar o'chiriladi.
+NIGHT_PERMS = ChatPermissions.no_permissions()
+TUN_TZ = timezone(timedelta(hours=float(os.getenv("TUN_TZ_OFFSET_HOURS", "5"))))  # Toshkent
+
+_TUN_SAVED_PERMS_MEM: dict[int, str | None] = {}  # DB bo'lmasa: chat_id -> avvalgi ruxsatlar (JSON)
+
+def _parse_hhmm(raw: str):
+    m = re.fullmatch(r"(\d{1,2})[:.](\d{2})", (raw or "").strip())
+    if not m:
+        return None
+    h, mi = int(m.group(1)), int(m.group(2))
+    if h > 23 or mi > 59:
+        return None
+    return f"{h:02d}:{mi:02d}"
+
+async def list_privs_db(chat_id: int) -> list[int]:
+    if not DB_POOL:
+        return list(_GROUP_PRIV_MEM.get(chat_id, set()))
+    try:
+        async with db_conn() as con:
+            rows = await con.fetch("SELECT user_id FROM group_privileges WHERE chat_id=$1;", chat_id)
+        return [int(r["user_id"]) for r in rows]
+    except Exception as e:
+        log.warning("list_privs_db xatolik: %s", e)
+        return list(_GROUP_PRIV_MEM.get(chat_id, set()))
+
+async def _save_tun_perms(chat_id: int, perms_json: str | None):
+    _TUN_SAVED_PERMS_MEM[chat_id] = perms_json
+    await db_write("_save_tun_perms", "UPDATE group_settings SET tun_perms=$2 WHERE chat_id=$1;", chat_id, perms_json)
+
+async def _pop_tun_perms(chat_id: int) -> str | None:
+    saved = _TUN_SAVED_PERMS_MEM.pop(chat_id, None)
+    if not DB_POOL:
+        await db_write("_pop_tun_perms", "UPDATE group_settings SET tun_perms=NULL WHERE chat_id=$1;", chat_id)
+        return saved
+    try:
+        async with db_conn() as con:
+            async with con.transaction():
+                saved = await con.fetchval("SELECT tun_perms FROM group_settings WHERE chat_id=$1;", chat_id) or saved
+                await con.execute("UPDATE group_settings SET tun_perms=NULL WHERE chat_id=$1;", chat_id)
+    except Exception as e:
+        log.warning("_pop_tun_perms xatolik: %s", e)
+    return saved
+
+async def night_lock(bot, chat_id: int) -> bool:
+    """Guruhni yopish. True — guruh set_chat_permissions bilan yopiq (ruxsatlari saqlangan)."""
+    if await list_privs_db(chat_id):
+        # Shaxsiy ruxsat guruh default'idan kengroq bo'lolmaydi: imtiyozlilar yoza olishi uchun
+        # guruh yopilmaydi, xabarlar o'chirish yo'lida (imtiyozlilardan tashqari) o'chiriladi
+        return False
+    try:
+        chat = await bot.get_chat(chat_id)
+        perms = getattr(chat, "permissions", None)
+        if perms is None:
+            # Qaytarib bo'lmaydigan holatga yopmaymiz
+            return False
+        if perms.can_send_messages is False:
+            # Allaqachon yopiq (ikkinchi /tun yoki admin ataylab yopgan): saqlangan ruxsatlar ustiga yozilmasin
+            return True
+        await _save_tun_perms(chat_id, json.dumps(perms.to_dict()))
+        await bot.set_chat_permissions(chat_id, NIGHT_PERMS, use_independent_chat_permissions=True)
+    except Exception as e:
+        log.warning("night_lock xatolik (xabar o'chirish rejimida davom): %s", e)
+        return False
+    return True
+
+async def night_unlock(bot, chat_id: int) -> bool:
+    """Faqat night_lock saqlagan ruxsatlarni qaytarish; saqlanmagan bo'lsa ruxsatlarga tegmaymiz."""
+    saved = await _pop_tun_perms(chat_id)
+    if not saved:
+        return False
+    try:
+        perms = ChatPermissions.de_json(json.loads(saved), bot)
+    except Exception as e:
+        log.warning("night_unlock: saqlangan ruxsatlar o'qilmadi: %s", e)
+        return False
+    if perms is None:
+        return False
+    try:
+        await bot.set_chat_permissions(chat_id, perms, use_independent_chat_permissions=True)
+        return True
+    except Exception as e:
+        log.warning("night_unlock xatolik: %s", e)
+        return False
+
+async def _tun_on_job(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    await night_lock(context.bot, chat_id)
+    await set_group_settings(chat_id, tun=True)
+
+async def _tun_off_job(context: ContextTypes.DEFAULT_TYPE):
+    chat_id = context.job.chat_id
+    await night_unlock(context.bot, chat_id)
+    await set_group_settings(chat_id, tun=False)
+
+def schedule_tun_jobs(job_queue, chat_id: int, tun_start: str | None, tun_end: str | None):
+    """Guruh uchun kundalik tun on/off ishlarini (qayta) ro'yxatdan o'tkazish."""
+    if job_queue is None:
+        return
+    for name in (f"tun_on:{chat_id}", f"tun_off:{chat_id}"):
+        for job in job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+    if not (tun_start and tun_end):
+        return
+    for name, hhmm, cb in ((f"tun_on:{chat_id}", tun_start, _tun_on_job), (f"tun_off:{chat_id}", tun_end, _tun_off_job)):
+        h, mi = map(int, hhmm.split(":"))
+        job_queue.run_daily(cb, time=dtime(h, mi, tzinfo=TUN_TZ), chat_id=chat_id, name=name)
+
+async def load_tun_schedules(app):
+    if not DB_POOL or app.job_queue is None:
+        return
+    try:
+        async with db_conn() as con:
+            rows = await con.fetch(
+                "SELECT chat_id, tun_start, tun_end FROM group_settings WHERE tun_start IS NOT NULL AND tun_end IS NOT NULL;"
+            )
+    except Exception as e:
+        log.warning("load_tun_schedules xatolik: %s", e)
+        return
+    rows = [r for r in rows if owns_chat(int(r["chat_id"]))]
+    for r in rows:
+        schedule_tun_jobs(app.job_queue, int(r["chat_id"]), r["tun_start"], r["tun_end"])
+    if rows:
+        log.info("Tun rejimi jadvali: %s ta guruh uchun tiklandi.", len(rows))
+
 # --------- Override commands: tun/tunoff/kanal/kanaloff/majbur/majburoff/ruxsat ----------
 async def tun(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
     chat_id = update.effective_chat.id
+
+    if context.args:
+        # /tun 23:00 07:00 — kundalik jadval
+        start_s = _parse_hhmm(context.args[0]) if len(context.args) == 2 else None
+        end_s = _parse_hhmm(context.args[1]) if len(context.args) == 2 else None
+        if not (start_s and end_s) or start_s == end_s:
+            return await update.effective_message.reply_text("Namuna: /tun 23:00 07:00")
+        await set_group_settings(chat_id, tun_start=start_s, tun_end=end_s)
+        schedule_tun_jobs(context.application.job_queue, chat_id, start_s, end_s)
+        return await update.effective_message.reply_text(
+            f"🌙 Tun rejimi jadvali: har kuni {start_s} – {end_s}. Faqat shu guruhga ta’sir qiladi."
+        )
+
+    locked = await night_lock(context.bot, chat_id)
     await set_group_settings(chat_id, tun=True)
-    await update.effective_message.reply_text("🌙 Tun rejimi yoqildi. Faqat shu guruhga ta’sir qiladi.")
+    if locked:
+        await update.effective_message.reply_text("🌙 Tun rejimi yoqildi: guruh yopildi (adminlar yoza oladi). Faqat shu guruhga ta’sir qiladi.")
+    else:
+        await update.effective_message.reply_text("🌙 Tun rejimi yoqildi. Faqat shu guruhga ta’sir qiladi.")
 
 async def tunoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
     chat_id = update.effective_chat.id
-    await set_group_settings(chat_id, tun=False)
+    settings = await get_group_settings(chat_id)
+    if settings.tun:
+        await night_unlock(context.bot, chat_id)
+    await set_group_settings(chat_id, tun=False, tun_start=None, tun_end=None)
+    schedule_tun_jobs(context.application.job_queue, chat_id, None, None)
     await update.effective_message.reply_text("🌞 Tun rejimi o‘chirildi. Faqat shu guruhga ta’sir qiladi.")
 
 async def kanal(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2010,7 +3673,8 @@ async def kanal(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await update.effective_message.reply_text("Namuna: /kanal @kanal1 @kanal2")
 
         # Store as JSON list (backward compatible: old single value still parses)
-        await set_group_settings(chat_id, kanal_username=__import__("json").dumps(channels, ensure_ascii=False))
+        await set_group_settings(chat_id, kanal_username=json.dumps(channels, ensure_ascii=False))
+        await clear_verified_db(chat_id)
         chan_lines = "\n".join([f"{i}) {ch}" for i, ch in enumerate(channels, start=1)])
         await update.effective_message.reply_text(
             "📢 Majburiy kanallar (faqat shu guruh учун):\n" + chan_lines
@@ -2023,8 +3687,78 @@ async def kanaloff(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
     chat_id = update.effective_chat.id
     await set_group_settings(chat_id, kanal_username=None)
+    await clear_verified_db(chat_id)
     await update.effective_message.reply_text("🚫 Majburiy kanal talabi o‘chirildi (faqat shu guruh uchun).")
 
+# --------- Join request: kanal a'zoligini kirishda bir marta tekshirish ----------
+async def mark_verified_db(chat_id: int, user_id: int):
+    _GROUP_VERIFIED_MEM[chat_id].add(user_id)
+    _invalidate_mod_ctx(chat_id, user_id)
+    await db_write(
+        "mark_verified_db",
+        "INSERT INTO group_verified (chat_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;",
+        chat_id, user_id
+    )
+
+async def clear_verified_db(chat_id: int):
+    # Kanal ro'yxati o'zgarsa, avvalgi tekshiruvlar endi haqiqiy emas
+    _GROUP_VERIFIED_MEM.pop(chat_id, None)
+    await db_write("clear_verified_db", "DELETE FROM group_verified WHERE chat_id=$1;", chat_id)
+
+async def kanaljoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update):
+        return await update.effective_message.reply_text("⛔ Faqat adminlar.")
+    chat_id = update.effective_chat.id
+    arg = (context.args[0].lower() if context.args else "")
+    if arg not in ("on", "off"):
+        return await update.effective_message.reply_text("Namuna: /kanaljoin on (yoki off)")
+    await set_group_settings(chat_id, kanal_join=(arg == "on"))
+    if arg == "on":
+        await update.effective_message.reply_text(
+            "✅ Kirish so‘rovlari (join request) majburiy kanallar bo‘yicha avtomatik tekshiriladi.\n"
+            "Guruh sozlamalarida «Approve new members» yoqilgan bo‘lishi kerak."
+        )
+    else:
+        await update.effective_message.reply_text("🚫 Kirish so‘rovlarini avtomatik tekshirish o‘chirildi.")
+
+async def on_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Kirish so'rovi: /kanal kanallariga a'zo bo'lsa — qabul, aks holda — rad (DM'da sababi)."""
+    req = update.chat_join_request
+    if not req:
+        return
+    chat_id = req.chat.id
+    settings = await get_group_settings(chat_id)
+    kanal_list = settings.kanals
+    if not settings.kanal_join or not kanal_list:
+        return  # adminlar qo'lda hal qiladi
+    uid = req.from_user.id
+    ok_all, missing = await _check_all_channels(uid, context.bot, kanal_list)
+    if ok_all:
+        try:
+            await req.approve()
+        except Exception as e:
+            log.warning("join request approve xatolik: %s", e)
+            return
+        await mark_verified_db(chat_id, uid)
+        return
+    try:
+        await req.decline()
+    except Exception as e:
+        log.warning("join request decline xatolik: %s", e)
+    chan_lines = "\n".join([f"{i}) {html.escape(ch)}" for i, ch in enumerate(missing, start=1)])
+    try:
+        await context.bot.send_message(
+            chat_id=req.user_chat_id,
+            text=(
+                f"⚠️ «{html.escape(req.chat.title or '')}» guruhiga kirish uchun avval shu kanallarga a'zo bo'ling:\n"
+                f"{chan_lines}\n\nSo‘ng qayta so‘rov yuboring."
+            ),
+            parse_mode="HTML",
+            disable_web_page_preview=True
+        )
+    except Exception:
+        pass
+
 async def majbur(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
@@ -2035,6 +3769,7 @@ async def majbur(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if not (3 <= val <= 30):
                 raise ValueError
             await set_group_settings(chat_id, majbur_limit=val)
+            await release_reached_pending(context.bot, chat_id, val)
             await update.effective_message.reply_text(
                 f"✅ Majburiy odam qo‘shish limiti: <b>{val}</b> (faqat shu guruh uchun)",
                 parse_mode="HTML"
@@ -2064,6 +3799,7 @@ async def on_set_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not (3 <= val <= 30):
             raise ValueError
         await set_group_settings(chat_id, majbur_limit=val)
+        await release_reached_pending(context.bot, chat_id, val)
         await q.edit_message_text(f"✅ Majburiy limit: <b>{val}</b> (faqat shu guruh uchun)", parse_mode="HTML")
     except Exception:
         await q.edit_message_text("❌ Noto‘g‘ri qiymat.")
@@ -2073,8 +3809,107 @@ async def majburoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
     chat_id = update.effective_chat.id
     await set_group_settings(chat_id, majbur_limit=0)
+    await release_all_pending(context.bot, chat_id)
     await update.effective_message.reply_text("🚫 Majburiy odam qo‘shish o‘chirildi (faqat shu guruh uchun).")
 
+# --------- Majburiy qo'shish: yangi a'zolarni oldindan cheklash ----------
+# majbur_pre yoqilgan guruhlarda yangi a'zo kirishi bilan bir marta cheklanadi va
+# group_pending ga yoziladi; limitga yetganda (inc_user_count_db natijasi) cheklov
+# avtomatik olinadi. Shu bilan har xabarda o'chirish/blok/ogohlantirish aylanasi yo'qoladi.
+_GROUP_PENDING_MEM = defaultdict(set)  # chat_id -> set(user_id) — cheklangan, limitga yetmaganlar
+
+async def add_pending_db(chat_id: int, user_ids: list[int]):
+    _GROUP_PENDING_MEM[chat_id].update(user_ids)
+    for uid in user_ids:
+        await db_write(
+            "add_pending_db",
+            "INSERT INTO group_pending (chat_id, user_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;",
+            chat_id, uid
+        )
+
+async def pop_pending_db(chat_id: int, user_id: int) -> bool:
+    """Foydalanuvchini pending ro'yxatidan olish. True — u oldindan cheklangan edi."""
+    was = user_id in _GROUP_PENDING_MEM.get(chat_id, set())
+    _GROUP_PENDING_MEM.get(chat_id, set()).discard(user_id)
+    if not DB_POOL:
+        await db_write("pop_pending_db", "DELETE FROM group_pending WHERE chat_id=$1 AND user_id=$2;", chat_id, user_id)
+        return was
+    try:
+        async with db_conn() as con:
+            v = await con.fetchval(
+                "DELETE FROM group_pending WHERE chat_id=$1 AND user_id=$2 RETURNING 1;",
+                chat_id, user_id
+            )
+        return was or bool(v)
+    except Exception as e:
+        log.warning("pop_pending_db xatolik: %s", e)
+        return was
+
+async def release_all_pending(bot, chat_id: int):
+    """majburoff / majburpre off: oldindan cheklanganlarning hammasini ochib yuborish."""
+    ids = set(_GROUP_PENDING_MEM.pop(chat_id, set()))
+    if DB_POOL:
+        try:
+            async with db_conn() as con:
+                rows = await con.fetch("DELETE FROM group_pending WHERE chat_id=$1 RETURNING user_id;", chat_id)
+            ids.update(int(r["user_id"]) for r in rows)
+        except Exception as e:
+            log.warning("release_all_pending xatolik: %s", e)
+    else:
+        await db_write("release_all_pending", "DELETE FROM group_pending WHERE chat_id=$1;", chat_id)
+    for uid in ids:
+        outbox_action(chat_id, partial(bot.restrict_chat_member, chat_id=chat_id, user_id=uid, permissions=FULL_PERMS))
+
+async def release_if_reached(bot, chat_id: int, user_id: int, cnt: int, limit: int):
+    """inc_user_count_db dan keyin: limitga yetgan oldindan cheklangan foydalanuvchini ochish."""
+    if limit <= 0 or cnt < limit:
+        return
+    if not await pop_pending_db(chat_id, user_id):
+        return
+    outbox_action(chat_id, partial(bot.restrict_chat_member, chat_id=chat_id, user_id=user_id, permissions=FULL_PERMS), label="Unrestrict")
+
+async def release_reached_pending(bot, chat_id: int, limit: int):
+    """/majbur o'zgarganda: yangi limitga allaqachon yetgan oldindan cheklanganlarni ochish."""
+    if limit <= 0:
+        return
+    ids = set(_GROUP_PENDING_MEM.get(chat_id, set()))
+    counts = dict(_GROUP_COUNTS_MEM.get(chat_id, {}))
+    if db_ready():
+        try:
+            async with db_conn() as con:
+                rows = await con.fetch(
+                    """
+                    SELECT p.user_id, COALESCE(c.cnt, 0) AS cnt
+                    FROM group_pending p
+                    LEFT JOIN group_user_counts c ON c.chat_id = p.chat_id AND c.user_id = p.user_id
+                    WHERE p.chat_id = $1;
+                    """,
+                    chat_id
+                )
+            for r in rows:
+                ids.add(int(r["user_id"]))
+                counts[int(r["user_id"])] = int(r["cnt"])
+        except Exception as e:
+            log.warning("release_reached_pending xatolik: %s", e)
+    for uid in ids:
+        await release_if_reached(bot, chat_id, uid, int(counts.get(uid, 0)), limit)
+
+async def majburpre(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update):
+        return await update.effective_message.reply_text("⛔ Faqat adminlar.")
+    chat_id = update.effective_chat.id
+    arg = (context.args[0].lower() if context.args else "")
+    if arg not in ("on", "off"):
+        return await update.effective_message.reply_text("Namuna: /majburpre on (yoki off)")
+    await set_group_settings(chat_id, majbur_pre=(arg == "on"))
+    if arg == "on":
+        await update.effective_message.reply_text(
+            "✅ Yangi a’zolar kirishi bilan cheklanadi va majburiy limitga yetganda avtomatik ochiladi (faqat shu guruh uchun)."
+        )
+    else:
+        await release_all_pending(context.bot, chat_id)
+        await update.effective_message.reply_text("🚫 Yangi a’zolarni oldindan cheklash o‘chirildi (faqat shu guruh uchun).")
+
 async def ruxsat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update):
         return await update.effective_message.reply_text("⛔ Faqat adminlar.")
@@ -2085,10 +3920,14 @@ async def ruxsat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = target_user.id
 
     await grant_priv_db(chat_id, uid)
+    if (await get_group_settings(chat_id)).tun:
+        # Yopiq guruhda imtiyozli yoza olmaydi: tun rejimi o'chirish yo'liga o'tadi
+        await night_unlock(context.bot, chat_id)
 
     # Agar foydalanuvchi avval bloklangan bo'lsa — darhol blokdan chiqaramiz
     try:
         await clear_block_db(chat_id, uid)
+        await pop_pending_db(chat_id, uid)
     except Exception:
         pass
     try:
@@ -2120,6 +3959,7 @@ async def ruxsatoff(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Avvalgi blok/cooldown bo'lsa — tozalaymiz (oddiy holatga qaytsin)
     try:
         await clear_block_db(chat_id, uid)
+        await pop_pending_db(chat_id, uid)
     except Exception:
         pass
     try:
@@ -2199,8 +4039,10 @@ async def count_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     uid = update.effective_user.id
     settings = await get_group_settings(chat_id)
-    limit = int(settings.get("majbur_limit") or 0)
+    limit = settings.majbur_limit
     cnt = await get_user_count_db(chat_id, uid)
+    if cnt is None:
+        return await update.effective_message.reply_text("⏳ Hisobni hozir o‘qib bo‘lmadi, birozdan so‘ng qayta urinib ko‘ring.")
     if limit > 0:
         qoldi = max(limit - cnt, 0)
         await update.effective_message.reply_text(f"📊 Siz {cnt} ta odam qo‘shgansiz. Qolgan: {qoldi} ta.")
@@ -2217,6 +4059,8 @@ async def replycount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = msg.reply_to_message.from_user
     uid = u.id
     cnt = await get_user_count_db(chat_id, uid)
+    if cnt is None:
+        return await msg.reply_text("⏳ Hisobni hozir o‘qib bo‘lmadi, birozdan so‘ng qayta urinib ko‘ring.")
     await msg.reply_text(f"👤 {_mention_user_html(u)} — <b>{cnt}</b> ta odam qo‘shgan (shu guruhda).", parse_mode="HTML")
 
 async def cleanuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2257,8 +4101,7 @@ async def kanal_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await q.answer()
 
     settings = await get_group_settings(chat_id)
-    kanal_raw = settings.get("kanal_username")
-    kanal_list = _parse_kanal_usernames(kanal_raw)
+    kanal_list = settings.kanals
 
     # If /kanaloff was used, allow writing.
     if not kanal_list:
@@ -2305,10 +4148,11 @@ async def on_check_added(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await q.answer("Bu tugma siz uchun emas!", show_alert=True)
 
     settings = await get_group_settings(chat_id)
-    limit = int(settings.get("majbur_limit") or 0)
+    limit = settings.majbur_limit
     cnt = await get_user_count_db(chat_id, uid)
 
-    if await group_has_priv(chat_id, uid) or (limit > 0 and cnt >= limit):
+    # cnt None — DB javob bermadi: majbur foydalanuvchini bloklab qoldirmaymiz
+    if await group_has_priv(chat_id, uid) or (limit > 0 and (cnt is None or cnt >= limit)):
         try:
             await context.bot.restrict_chat_member(
                 chat_id=chat_id,
@@ -2318,8 +4162,10 @@ async def on_check_added(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
         await clear_block_db(chat_id, uid)
+        await pop_pending_db(chat_id, uid)
         return await q.edit_message_text("✅ Talab bajarilgan! Endi guruhda yozishingiz mumkin.")
 
+    cnt = cnt or 0
     qoldi = max(limit - cnt, 0)
     return await q.answer(
         f"❗ Siz hozirgacha {cnt} ta foydalanuvchi qo‘shdingiz va yana {qoldi} ta foydalanuvchi qo‘shishingiz kerak",
@@ -2347,6 +4193,7 @@ async def on_grant_priv(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Agar foydalanuvchi blokda bo'lsa — darhol blokdan chiqaramiz
     try:
         await clear_block_db(chat.id, target_id)
+        await pop_pending_db(chat.id, target_id)
     except Exception:
         pass
     try:
@@ -2372,6 +4219,106 @@ async def on_grant_priv(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="HTML"
     )
 
+# --------- Kontent verdikti: bir xil spam payload'lar uchun LRU kesh ----------
+# Spam kampaniyalari bir xil matnni yuzlab guruhga tashlaydi. Kontent tekshiruvi
+# (reklama/ssilka/uyatli so'zlar) faqat xabar mazmuniga bog'liq, shuning uchun natija
+# normallashtirilgan matn + entity URL'lari + tugma URL'lari + bayroqlar xeshi bo'yicha
+# keshlanadi. Kalit so'z ro'yxatlari o'zgarsa kesh butunlay tozalanadi.
+VERDICT_CACHE_MAX = int(os.getenv("VERDICT_CACHE_MAX", "20000"))
+
+_VERDICT_CACHE: "OrderedDict[bytes, str | None]" = OrderedDict()
+_VERDICT_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+_VERDICT_FINGERPRINT: tuple = ()
+
+# verdikt -> (ogohlantirish matni, matnda mention bormi)
+_VERDICT_WARNINGS = {
+    "via_bot": ("⚠️ {mention}, yashirin ssilka yuborish taqiqlangan!", True),
+    "buttons": ("⚠️ O‘yin/veb-app tugmali reklama taqiqlangan!", False),
+    "game": ("⚠️ O‘yin reklamalari taqiqlangan!", False),
+    "bot_link": ("⚠️ {mention}, reklama/ssilka yuborish taqiqlangan!", True),
+    "hidden_link": ("⚠️ {mention}, yashirin ssilka yuborish taqiqlangan!", True),
+    "link": ("⚠️ {mention}, reklama/ssilka yuborish taqiqlangan!", True),
+    "swear": ("⚠️ {mention}, guruhda so‘kinish taqiqlangan!", True),
+}
+
+def _keywords_fingerprint() -> tuple:
+    # Ro'yxat almashtirilsa (id) yoki to'ldirilsa/qisqartirilsa (len) — boshqa fingerprint
+    return tuple((id(x), len(x)) for x in (UYATLI_SOZLAR, SUSPECT_KEYWORDS, SUSPECT_DOMAINS))
+
+def _content_verdict(msg, low: str, entities) -> str | None:
+    """Xabar mazmuni bo'yicha verdikt (None — toza). Faqat kalitdagi maydonlarga bog'liq."""
+    if getattr(msg, "via_bot", None):
+        return "via_bot"
+    if has_suspicious_buttons(msg):
+        return "buttons"
+    if any(k in low for k in SUSPECT_KEYWORDS):
+        return "game"
+    if getattr(msg.from_user, "is_bot", False):
+        has_game = bool(getattr(msg, "game", None))
+        has_url_entity = any(ent.type in ("text_link", "url", "mention") for ent in entities)
+        has_url_text = any(x in low for x in ("t.me","telegram.me","http://","https://","www.","youtu.be","youtube.com"))
+        if has_game or has_url_entity or has_url_text:
+            return "bot_link"
+    for ent in entities:
+        if ent.type in ("text_link", "url", "mention"):
+            url = getattr(ent, "url", "") or ""
+            if url and ("t.me" in url or "telegram.me" in url or "http://" in url or "https://" in url):
+                return "hidden_link"
+    if any(x in low for x in ("t.me","telegram.me","@","www.","https://youtu.be","http://","https://")):
+        return "link"
+    sozlar = matndan_sozlar_olish(low)
+    if any(s in UYATLI_SOZLAR for s in sozlar):
+        return "swear"
+    return None
+
+def _verdict_key(msg, low: str, entities) -> bytes:
+    buttons = ()
+    if msg.reply_markup:
+        buttons = tuple(
+            (getattr(btn, "url", None), getattr(getattr(btn, "web_app", None), "url", None),
+             getattr(btn, "callback_game", None) is not None)
+            for row in msg.reply_markup.inline_keyboard for btn in row
+        )
+    # hash() 64-bitli va to'qnashuvda boshqa xabarning verdiktini qaytarardi; 128-bit digest
+    # kalitni kichik saqlaydi va to'qnashuvni amalda imkonsiz qiladi
+    parts = (
+        low,
+        tuple((ent.type, getattr(ent, "url", None)) for ent in entities),
+        buttons,
+        bool(getattr(msg, "via_bot", None)),
+        bool(getattr(msg.from_user, "is_bot", False)),
+        bool(getattr(msg, "game", None)),
+    )
+    return hashlib.blake2b(repr(parts).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+def content_verdict(msg) -> str | None:
+    global _VERDICT_FINGERPRINT
+    fp = _keywords_fingerprint()
+    if fp != _VERDICT_FINGERPRINT:
+        if _VERDICT_CACHE:
+            _VERDICT_STATS["invalidations"] += 1
+        _VERDICT_CACHE.clear()
+        _VERDICT_FINGERPRINT = fp
+
+    low = (msg.text or msg.caption or "").lower()
+    entities = msg.entities or msg.caption_entities or []
+    try:
+        key = _verdict_key(msg, low, entities)
+    except Exception:
+        return _content_verdict(msg, low, entities)
+    try:
+        verdict = _VERDICT_CACHE[key]
+    except KeyError:
+        _VERDICT_STATS["misses"] += 1
+        verdict = _content_verdict(msg, low, entities)
+        _VERDICT_CACHE[key] = verdict
+        if len(_VERDICT_CACHE) > VERDICT_CACHE_MAX:
+            _VERDICT_CACHE.popitem(last=False)
+        return verdict
+    _VERDICT_STATS["hits"] += 1
+    _VERDICT_CACHE.move_to_end(key)
+    return verdict
+
 # --------- Override Filters: reklama_va_soz_filtri / majbur_filter ----------
 async def reklama_va_soz_filtri(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -2386,37 +4333,28 @@ async def reklama_va_soz_filtri(update: Update, context: ContextTypes.DEFAULT_TY
 
     chat_id = msg.chat_id
 
-    # Admin/creator/guruh nomidan xabarlar — teginmaymiz
-    if await is_privileged_message(msg, context.bot):
-        return
-    # Oq ro'yxat
-    if msg.from_user.id in WHITELIST or (msg.from_user.username and msg.from_user.username in WHITELIST):
+    # Admin/creator/guruh nomidan xabarlar va oq ro'yxat — teginmaymiz
+    if await _content_exempt(msg, context.bot):
+        _remember_verdict(chat_id, msg.message_id, None, None, True)
         return
 
     uid = msg.from_user.id
-    has_priv = await group_has_priv(chat_id, uid)
-
-    settings = await get_group_settings(chat_id)
+    mctx = await get_moderation_context(chat_id, uid)
+    has_priv = mctx["has_priv"]
+    settings = mctx["settings"]
 
     # Tun rejimi (shu guruh uchun) — imtiyozli foydalanuvchiga ta’sir qilmaydi
-    if settings.get("tun") and not has_priv:
-        try:
-            await msg.delete()
-        except Exception:
-            pass
+    if settings.tun and not has_priv:
+        queue_delete(context.bot, msg.chat_id, msg.message_id)
         return
 
-    kanal_raw = settings.get("kanal_username")
-    kanal_list = _parse_kanal_usernames(kanal_raw)
+    kanal_list = settings.kanals
 
     # Cooldown: foydalanuvchi 1 daqiqalik blokda bo'lsa — xabarini o'chirib, ogohlantirmaymiz
     now = datetime.now(timezone.utc)
-    until_old = await get_block_until_db(chat_id, uid)
+    until_old = mctx["block_until"]
     if until_old and now < until_old and not has_priv:
-        try:
-            await msg.delete()
-        except Exception:
-            pass
+        queue_delete(context.bot, msg.chat_id, msg.message_id)
         return
     if until_old and now < until_old and has_priv:
         try:
@@ -2427,26 +4365,22 @@ async def reklama_va_soz_filtri(update: Update, context: ContextTypes.DEFAULT_TY
         await clear_block_db(chat_id, uid)
 
     # Kanal a'zoligi (shu guruh uchun) - ko'p kanalli
-    if kanal_list and not has_priv:
+    # Join request orqali tekshirib kiritilganlar — qayta tekshirilmaydi
+    if kanal_list and not has_priv and not mctx["verified"]:
         ok_all, _missing = await _check_all_channels(uid, context.bot, kanal_list)
         if not ok_all:
-            try:
-                await msg.delete()
-            except Exception:
-                pass
+            queue_delete(context.bot, msg.chat_id, msg.message_id)
 
             # 1 daqiqaga blok (shu guruh uchun)
             until = datetime.now(timezone.utc) + timedelta(minutes=1)
             await set_block_until_db(chat_id, uid, until)
-            try:
-                await context.bot.restrict_chat_member(
-                    chat_id=chat_id,
-                    user_id=uid,
-                    permissions=BLOCK_PERMS,
-                    until_date=until
-                )
-            except Exception as e:
-                log.warning(f"Restrict failed: {e}")
+            outbox_action(chat_id, partial(
+                context.bot.restrict_chat_member,
+                chat_id=chat_id,
+                user_id=uid,
+                permissions=BLOCK_PERMS,
+                until_date=until
+            ), label="Restrict")
             kb = [
                 [InlineKeyboardButton("✅ Men a’zo bo‘ldim", callback_data=f"kanal_azo:{uid}")],
                 [InlineKeyboardButton("🎟 Imtiyoz berish", callback_data=f"grant:{uid}")],
@@ -2458,125 +4392,36 @@ async def reklama_va_soz_filtri(update: Update, context: ContextTypes.DEFAULT_TY
                 f"⚠️ {mention} guruhda yozish uchun shu kanallarga a'zo bo'ling:\n{chan_lines}\n\n"
                 "⏳ 1 daqiqaga bloklandi"
             )# Oldingi ogohlantirishni o'chirish (shu foydalanuvchi uchun)
-            key = (chat_id, uid)
-            prev_mid = KANAL_WARN_MSG_IDS.get(key)
+            key = _pk(chat_id, uid)
+            prev_mid = _warn_get(KANAL_WARN_MSG_IDS, key)
             if prev_mid:
-                try:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=prev_mid)
-                except Exception:
-                    pass
+                queue_delete(context.bot, chat_id, prev_mid)
 
-            warn_msg = await context.bot.send_message(
+            _send_warning(
+                context.bot,
                 chat_id=chat_id,
                 text=warn_text,
                 reply_markup=InlineKeyboardMarkup(kb),
                 parse_mode="HTML",
-                disable_web_page_preview=True
+                disable_web_page_preview=True,
+                track=(KANAL_WARN_MSG_IDS, key)
             )
-            KANAL_WARN_MSG_IDS[key] = warn_msg.message_id
             return
 
-    # Quyidagi qism — eski logikangiz (reklama/ssilka/uyatli sozlar) o'zgarishsiz:
-    text = msg.text or msg.caption or ""
-    entities = msg.entities or msg.caption_entities or []
-
-    if getattr(msg, "via_bot", None):
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"⚠️ {msg.from_user.mention_html()}, yashirin ssilka yuborish taqiqlangan!",
-            reply_markup=add_to_group_kb(context.bot.username),
-            parse_mode="HTML"
-        )
-        return
-
-    if has_suspicious_buttons(msg):
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="⚠️ O‘yin/veb-app tugmali reklama taqiqlangan!",
-            reply_markup=add_to_group_kb(context.bot.username)
-        )
-        return
-
-    low = text.lower()
-    if any(k in low for k in SUSPECT_KEYWORDS):
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="⚠️ O‘yin reklamalari taqiqlangan!",
-            reply_markup=add_to_group_kb(context.bot.username)
-        )
-        return
-
-    if getattr(msg.from_user, "is_bot", False):
-        has_game = bool(getattr(msg, "game", None))
-        has_url_entity = any(ent.type in ("text_link", "url", "mention") for ent in entities)
-        has_url_text = any(x in low for x in ("t.me","telegram.me","http://","https://","www.","youtu.be","youtube.com"))
-        if has_game or has_url_entity or has_url_text:
-            try:
-                await msg.delete()
-            except Exception:
-                pass
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"⚠️ {msg.from_user.mention_html()}, reklama/ssilka yuborish taqiqlangan!",
-                reply_markup=add_to_group_kb(context.bot.username),
-                parse_mode="HTML"
-            )
-            return
-
-    for ent in entities:
-        if ent.type in ("text_link", "url", "mention"):
-            url = getattr(ent, "url", "") or ""
-            if url and ("t.me" in url or "telegram.me" in url or "http://" in url or "https://" in url):
-                try:
-                    await msg.delete()
-                except Exception:
-                    pass
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"⚠️ {msg.from_user.mention_html()}, yashirin ssilka yuborish taqiqlangan!",
-                    reply_markup=add_to_group_kb(context.bot.username),
-                    parse_mode="HTML"
-                )
-                return
-
-    if any(x in low for x in ("t.me","telegram.me","@","www.","https://youtu.be","http://","https://")):
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"⚠️ {msg.from_user.mention_html()}, reklama/ssilka yuborish taqiqlangan!",
-            reply_markup=add_to_group_kb(context.bot.username),
-            parse_mode="HTML"
-        )
-        return
-
-    sozlar = matndan_sozlar_olish(text)
-    if any(s in UYATLI_SOZLAR for s in sozlar):
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"⚠️ {msg.from_user.mention_html()}, guruhda so‘kinish taqiqlangan!",
-            reply_markup=add_to_group_kb(context.bot.username),
-            parse_mode="HTML"
-        )
+    # Quyidagi qism — eski logikangiz (reklama/ssilka/uyatli sozlar), verdikt keshi orqali
+    verdict = content_verdict(msg)
+    _remember_verdict(chat_id, msg.message_id, _edit_text_hash(msg), verdict, False)
+    if verdict is None:
         return
+    queue_delete(context.bot, msg.chat_id, msg.message_id)
+    text, mention = _VERDICT_WARNINGS[verdict]
+    _send_warning(
+        context.bot,
+        chat_id=chat_id,
+        text=text.format(mention=msg.from_user.mention_html()),
+        reply_markup=add_to_group_kb(context.bot.username),
+        parse_mode="HTML" if mention else None
+    )
 
 async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
@@ -2594,13 +4439,14 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = msg.chat_id
     uid = msg.from_user.id
 
-    settings = await get_group_settings(chat_id)
-    limit = int(settings.get("majbur_limit") or 0)
+    mctx = await get_moderation_context(chat_id, uid)
+    settings = mctx["settings"]
+    limit = settings.majbur_limit
     if limit <= 0:
         return
 
     # Imtiyoz bo'lsa — majburiy talab/cooldown ishlamaydi
-    if await group_has_priv(chat_id, uid):
+    if mctx["has_priv"]:
         try:
             await clear_block_db(chat_id, uid)
         except Exception:
@@ -2609,38 +4455,33 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Agar foydalanuvchi hanuz blokda bo'lsa — xabarini o'chirib, hech narsa yubormaymiz
     now = datetime.now(timezone.utc)
-    until_old = await get_block_until_db(chat_id, uid)
+    until_old = mctx["block_until"]
     if until_old and now < until_old:
-        try:
-            await msg.delete()
-        except Exception:
-            pass
+        queue_delete(context.bot, msg.chat_id, msg.message_id)
         return
     if until_old and now >= until_old:
         await clear_block_db(chat_id, uid)
 
-    cnt = await get_user_count_db(chat_id, uid)
-    if cnt >= limit:
+    cnt = mctx["cnt"]
+    if cnt is None or cnt >= limit:
+        # None — DB javob bermadi va hisob noma'lum: bloklamaymiz
         return
 
-    # Xabarni o'chiramiz
-    try:
-        await msg.delete()
-    except Exception:
+    # Xabarni o'chira olmasak (huquq yo'q) — cheklash va ogohlantirish ham yo'q
+    if not await bot_can_delete(context.bot, chat_id):
         return
+    queue_delete(context.bot, msg.chat_id, msg.message_id)
 
     # 1 daqiqaga blok (shu guruh uchun)
     until = datetime.now(timezone.utc) + timedelta(minutes=1)
     await set_block_until_db(chat_id, uid, until)
-    try:
-        await context.bot.restrict_chat_member(
-            chat_id=chat_id,
-            user_id=uid,
-            permissions=BLOCK_PERMS,
-            until_date=until
-        )
-    except Exception as e:
-        log.warning(f"Restrict failed: {e}")
+    outbox_action(chat_id, partial(
+        context.bot.restrict_chat_member,
+        chat_id=chat_id,
+        user_id=uid,
+        permissions=BLOCK_PERMS,
+        until_date=until
+    ), label="Restrict")
 
     qoldi = max(limit - cnt, 0)
     kb = [
@@ -2650,21 +4491,89 @@ async def majbur_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("⏳ 1 daqiqaga bloklandi", callback_data="noop")]
     ]
     # Oldingi ogohlantirishni o'chirish (shu foydalanuvchi uchun)
-    key = (chat_id, uid)
-    prev_mid = MAJBUR_WARN_MSG_IDS.get(key)
+    key = _pk(chat_id, uid)
+    prev_mid = _warn_get(MAJBUR_WARN_MSG_IDS, key)
     if prev_mid:
+        queue_delete(context.bot, chat_id, prev_mid)
+
+    _send_warning(
+        context.bot,
+        chat_id=chat_id,
+        text=f"⚠️ {_mention_user_html(msg.from_user)} guruhda yozish uchun {limit} ta odam qo‘shishingiz kerak! Qolgan: {qoldi} ta.",
+        reply_markup=InlineKeyboardMarkup(kb),
+        parse_mode="HTML",
+        track=(MAJBUR_WARN_MSG_IDS, key)
+    )
+
+# --------- Tahrirlangan xabarlar: faqat kontent filtrlari, oldingi verdikt keshi bilan ----------
+# Toza matn yozib, keyin unga ssilka qo'shib tahrirlash — filtrni chetlab o'tish yo'li edi.
+# Tahrirlar endi alohida handler'dan o'tadi: majbur/kanal/tun qayta ishlamaydi, faqat kontent.
+# Har xabar uchun (matn xeshi, verdikt, imtiyozli, vaqt) saqlanadi: faqat bo'shliq yoki
+# formatlash o'zgargan bo'lsa qayta tahlil qilinmaydi, imtiyoz esa EDIT_CTX_TTL_SEC ichida qayta so'ralmaydi.
+EDIT_CACHE_MAX = int(os.getenv("EDIT_CACHE_MAX", "20000"))
+EDIT_CTX_TTL_SEC = int(os.getenv("EDIT_CTX_TTL_SEC", "300"))
+
+_EDIT_VERDICTS: "OrderedDict[int, tuple[int | None, str | None, bool, float]]" = OrderedDict()
+
+async def _content_exempt(msg, bot) -> bool:
+    if await is_privileged_message(msg, bot):
+        return True
+    return msg.from_user.id in WHITELIST or bool(msg.from_user.username and msg.from_user.username in WHITELIST)
+
+def _edit_text_hash(msg) -> int:
+    # Bo'shliqlar va formatlash (bold/italic...) hisobga olinmaydi; havola/mention'lar olinadi
+    low = (msg.text or msg.caption or "").lower()
+    entities = msg.entities or msg.caption_entities or []
+    return hash((
+        " ".join(low.split()),
+        tuple((ent.type, getattr(ent, "url", None)) for ent in entities if ent.type in ("text_link", "url", "mention")),
+    ))
+
+def _remember_verdict(chat_id: int, message_id: int, text_hash: int | None, verdict: str | None, privileged: bool):
+    key = _pk(chat_id, message_id)
+    _EDIT_VERDICTS.pop(key, None)
+    _EDIT_VERDICTS[key] = (text_hash, verdict, privileged, time.monotonic())
+    if len(_EDIT_VERDICTS) > EDIT_CACHE_MAX:
+        _EDIT_VERDICTS.popitem(last=False)
+
+async def on_edited_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not msg or not msg.chat or not msg.from_user:
+        return
+    chat_id = msg.chat_id
+    prev = _EDIT_VERDICTS.get(_pk(chat_id, msg.message_id))
+    fresh = prev is not None and (time.monotonic() - prev[3]) < EDIT_CTX_TTL_SEC
+    if fresh and prev[2]:
+        return
+
+    text_hash = _edit_text_hash(msg)
+    if prev is not None and prev[0] == text_hash:
+        # Mazmun o'zgarmagan (faqat bo'shliq/formatlash) — oldingi verdikt amal qiladi
+        return
+
+    if not fresh:
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=prev_mid)
+            if await is_linked_channel_autoforward(msg, context.bot):
+                return
         except Exception:
             pass
+        if await _content_exempt(msg, context.bot):
+            _remember_verdict(chat_id, msg.message_id, None, None, True)
+            return
 
-    warn_msg = await context.bot.send_message(
+    verdict = content_verdict(msg)
+    _remember_verdict(chat_id, msg.message_id, text_hash, verdict, False)
+    if verdict is None:
+        return
+    queue_delete(context.bot, chat_id, msg.message_id)
+    text, mention = _VERDICT_WARNINGS[verdict]
+    _send_warning(
+        context.bot,
         chat_id=chat_id,
-        text=f"⚠️ {_mention_user_html(msg.from_user)} guruhda yozish uchun {limit} ta odam qo‘shishingiz kerak! Qolgan: {qoldi} ta.",
-        reply_markup=InlineKeyboardMarkup(kb),
-        parse_mode="HTML"
+        text=text.format(mention=msg.from_user.mention_html()),
+        reply_markup=add_to_group_kb(context.bot.username),
+        parse_mode="HTML" if mention else None
     )
-    MAJBUR_WARN_MSG_IDS[key] = warn_msg.message_id
 
 # --------- Override join handler: per-group count ----------
 async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2674,23 +4583,747 @@ async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not adder:
         return
     chat_id = msg.chat_id
+    added = sum(1 for m in members if adder.id != m.id)
+    settings = await get_group_settings(chat_id)
+    limit = settings.majbur_limit
+    if added:
+        await inc_user_count_db(chat_id, adder.id, added, bot=context.bot)
+    queue_delete(context.bot, msg.chat_id, msg.message_id)
+
+    # Oldindan cheklash: yangi a'zo limitga yetmaguncha yoza olmaydi (bir marta)
+    if limit <= 0 or not settings.majbur_pre:
+        return
+    targets, futs = [], []
     for m in members:
-        if adder.id != m.id:
-            await inc_user_count_db(chat_id, adder.id, 1)
-    try:
-        await msg.delete()
-    except Exception:
-        pass
+        if getattr(m, "is_bot", False) or await group_has_priv(chat_id, m.id):
+            continue
+        cnt = await get_user_count_db(chat_id, m.id)
+        if cnt is None or cnt >= limit:
+            continue
+        targets.append(m)
+        futs.append(outbox_action(chat_id, partial(context.bot.restrict_chat_member, chat_id=chat_id, user_id=m.id, permissions=BLOCK_PERMS)))
+    if not targets:
+        return
+    # Kirish to'lqinida cheklashlar chat bucket'i tezligida ketadi: handler ularni kutmaydi
+    # (update'lar ketma-ket ishlanadi — kutilsa butun bot to'xtab qolardi)
+    task = _detached_task(_finish_pre_restrict(context.bot, chat_id, limit, targets, futs))
+    _PRE_RESTRICT_TASKS.add(task)
+    task.add_done_callback(_PRE_RESTRICT_TASKS.discard)
+
+_PRE_RESTRICT_TASKS: set = set()
+
+async def _finish_pre_restrict(bot, chat_id: int, limit: int, targets: list, futs: list):
+    """Oldindan cheklash natijalari: muvaffaqiyatlilarni pending'ga yozish va bitta ogohlantirish."""
+    results = await asyncio.gather(*futs, return_exceptions=True)
+    restricted = []
+    for m, res in zip(targets, results):
+        if isinstance(res, BaseException):
+            log.warning("Restrict failed: %s", res)
+            continue
+        restricted.append(m)
+    if not restricted:
+        return
+    await add_pending_db(chat_id, [m.id for m in restricted])
+    mentions = ", ".join(_mention_user_html(m) for m in restricted[:10])
+    kb = [
+        [InlineKeyboardButton("✅ Odam qo‘shdim", callback_data=f"check_added:{restricted[0].id}")] if len(restricted) == 1 else [],
+        [InlineKeyboardButton("➕ Guruhga qo‘shish", url=admin_add_link(bot.username))],
+    ]
+    _send_warning(
+        bot,
+        chat_id=chat_id,
+        text=f"👋 {mentions}, guruhda yozish uchun {limit} ta odam qo‘shishingiz kerak. Limitga yetganingizda yozish avtomatik ochiladi.",
+        reply_markup=InlineKeyboardMarkup([row for row in kb if row]),
+        parse_mode="HTML"
+    )
 
 # --------- Leave handler: delete “user left / removed” service messages ----------
 async def on_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.effective_message
     if not msg:
         return
+    queue_delete(context.bot, msg.chat_id, msg.message_id)
+
+# --------- Chiquvchi Bot API chaqiruvlari uchun markaziy scheduler ----------
+# Telegram limitlari: guruhga ~1 xabar/sek, umumiy ~30 xabar/sek. Moderatsiya amallari
+# (o'chirish, cheklash) handler'lardan to'g'ridan-to'g'ri emas, shu navbat orqali yuboriladi:
+# har chat uchun token bucket + umumiy bucket, ustuvorlik bo'yicha (amallar avval,
+# ogohlantirishlar oxirida). Chat limitdan oshgan bo'lsa ogohlantirish tashlab yuboriladi.
+PRIO_ACTION = 0  # delete / restrict
+PRIO_WARN = 1    # ogohlantirish xabarlari (tashlab yuborilishi mumkin)
+PRIO_BULK = 2    # broadcast
+
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "5"))
+_OUTBOX_MAX_ATTEMPTS = 3
+_OUTBOX_BUCKET_IDLE_SEC = 600
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def penalize(self, seconds: float):
+        # RetryAfter: shu chat uchun Telegram aytgan muddatgacha hech narsa yubormaymiz
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class _OutItem:
+    __slots__ = ("chat_id", "priority", "factory", "future", "droppable", "on_result", "label", "attempts", "trace", "queued_at")
+
+    def __init__(self, chat_id, priority, factory, future, droppable, on_result, label):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.factory = factory
+        self.future = future
+        self.droppable = droppable
+        self.on_result = on_result
+        self.label = label
+        self.attempts = 0
+        self.trace = _TRACE.get()
+        self.queued_at = time.perf_counter()
+
+def _consume_future_exc(fut: asyncio.Future):
+    # Hech kim kutmagan future'lardagi xato "never retrieved" deb log qilinmasin
+    if not fut.cancelled():
+        fut.exception()
+
+class _OutboundScheduler:
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self._heap: list = []      # (priority, seq, item)
+        self._deferred: list = []  # (ready_at_monotonic, seq, item)
+        self._seq = itertools.count()
+        self._global = _TokenBucket(global_rate, max(1.0, global_rate))
+        self._chat_rate = chat_rate
+        self._chat_burst = max(1.0, chat_burst)
+        self._buckets: dict[int, _TokenBucket] = {}
+        self._running = 0
+        self._tasks: set = set()
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self.stats = {"submitted": 0, "sent": 0, "dropped": 0, "retry_after": 0, "failed": 0}
+
+    def _bucket(self, chat_id: int) -> _TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = self._buckets[chat_id] = _TokenBucket(self._chat_rate, self._chat_burst)
+        return b
+
+    def depth(self) -> int:
+        return len(self._heap) + len(self._deferred) + self._running
+
+    def submit(self, chat_id: int, priority: int, factory, *, droppable: bool = False, on_result=None, label: str | None = None) -> asyncio.Future:
+        """factory() -> coroutine. Natija future orqali (kutish shart emas)."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        fut.add_done_callback(_consume_future_exc)
+        self.stats["submitted"] += 1
+        if droppable and self._bucket(chat_id).wait_time(time.monotonic()) > 0:
+            self.stats["dropped"] += 1
+            fut.set_result(None)
+            return fut
+        item = _OutItem(chat_id, priority, factory, fut, droppable, on_result, label)
+        heapq.heappush(self._heap, (priority, next(self._seq), item))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = _detached_task(self._run())
+        self._wakeup.set()
+        return fut
+
+    def _drop(self, item: _OutItem):
+        self.stats["dropped"] += 1
+        if not item.future.done():
+            item.future.set_result(None)
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, seq, item = heapq.heappop(self._deferred)
+                heapq.heappush(self._heap, (item.priority, seq, item))
+            if not self._heap:
+                timeout = (self._deferred[0][0] - now) if self._deferred else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            gwait = self._global.wait_time(now)
+            if gwait > 0:
+                await asyncio.sleep(gwait)
+                continue
+            _, seq, item = heapq.heappop(self._heap)
+            bucket = self._bucket(item.chat_id)
+            cwait = bucket.wait_time(now)
+            if cwait > 0:
+                if item.droppable:
+                    self._drop(item)
+                else:
+                    heapq.heappush(self._deferred, (now + cwait, seq, item))
+                continue
+            bucket.take(now)
+            self._global.take(now)
+            self._running += 1
+            task = asyncio.get_running_loop().create_task(self._execute(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, item: _OutItem):
+        if item.trace is not None:
+            # Bot API chaqiruvi navbatga qo'ygan update'ga yoziladi (task konteksti alohida)
+            item.trace.add("outbox_wait", time.perf_counter() - item.queued_at)
+            _TRACE.set(item.trace)
+        try:
+            result = await item.factory()
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            delay = _retry_after_seconds(e)
+            self._bucket(item.chat_id).penalize(delay)
+            item.attempts += 1
+            if item.droppable:
+                self._drop(item)
+            elif item.attempts < _OUTBOX_MAX_ATTEMPTS:
+                heapq.heappush(self._deferred, (time.monotonic() + delay, next(self._seq), item))
+                self._wakeup.set()
+            elif not item.future.done():
+                self.stats["failed"] += 1
+                item.future.set_exception(e)
+        except Exception as e:
+            self.stats["failed"] += 1
+            if item.label:
+                log.warning("%s failed: %s", item.label, e)
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.stats["sent"] += 1
+            if item.on_result is not None:
+                try:
+                    item.on_result(result)
+                except Exception as e:
+                    log.warning("outbox on_result xatolik: %s", e)
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._running -= 1
+
+    async def drain(self, timeout: float) -> bool:
+        """Navbat bo'shaguncha kutish (shutdown uchun). True — hammasi yuborildi."""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.depth() == 0
+
+    def drop_droppable(self):
+        """Shutdown: hali yuborilmagan ogohlantirishlarni tashlab, navbatni amallarga qoldirish."""
+        for name in ("_heap", "_deferred"):
+            keep = []
+            for entry in getattr(self, name):
+                if entry[2].droppable:
+                    self._drop(entry[2])
+                else:
+                    keep.append(entry)
+            heapq.heapify(keep)
+            setattr(self, name, keep)
+
+    def prune(self):
+        # Uzoq vaqt jim turgan (to'la) chat bucket'larini o'chirish
+        now = time.monotonic()
+        idle = [cid for cid, b in self._buckets.items() if (now - b.updated) > _OUTBOX_BUCKET_IDLE_SEC]
+        for cid in idle:
+            self._buckets.pop(cid, None)
+
+OUTBOX = _OutboundScheduler(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+
+def outbox_action(chat_id: int, factory, label: str | None = None) -> asyncio.Future:
+    """Moderatsiya amali (restrict/delete) — eng yuqori ustuvorlik, tashlab yuborilmaydi."""
+    return OUTBOX.submit(chat_id, PRIO_ACTION, factory, label=label)
+
+# --------- Ogohlantirishlarni taymer bo'yicha avtomatik o'chirish ----------
+# Har bir ogohlantirish WARN_DELETE_AFTER_SEC dan keyin o'chiriladi. Navbat chat bo'yicha
+# guruhlanib delete_messages (100 tagacha ID) bilan tozalanadi; restart'dan keyin ham
+# yo'qolmasligi uchun pending_deletes jadvalida saqlanadi.
+WARN_DELETE_AFTER_SEC = int(os.getenv("WARN_DELETE_AFTER_SEC", "120"))  # 0 = o'chirmaslik
+WARN_DELETE_TICK_SEC = int(os.getenv("WARN_DELETE_TICK_SEC", "5"))
+_DELETE_BATCH_MAX = 100  # Bot API deleteMessages limiti
+
+_PENDING_DELETES: list[tuple[float, int, int]] = []  # heap: (delete_at_epoch, chat_id, message_id)
+_PENDING_DELETES_NEW: list[tuple[int, int, datetime]] = []  # DB'ga hali yozilmaganlar
+
+def schedule_message_delete(chat_id: int, message_id: int, delay_sec: float | None = None):
+    delay = WARN_DELETE_AFTER_SEC if delay_sec is None else delay_sec
+    if delay <= 0:
+        return
+    due = time.time() + delay
+    heapq.heappush(_PENDING_DELETES, (due, chat_id, message_id))
+    _PENDING_DELETES_NEW.append((chat_id, message_id, datetime.fromtimestamp(due, timezone.utc)))
+
+def _send_warning(bot, chat_id: int, text: str, *, track=None, **kwargs) -> asyncio.Future:
+    """Ogohlantirishni OUTBOX orqali yuborish va uni avtomatik o'chirish navbatiga qo'yish.
+
+    Chat limitdan oshgan bo'lsa ogohlantirish tashlab yuboriladi (o'chirish/cheklash
+    amallari baribir bajariladi). track=(dict, key) — yuborilgan xabar ID'si shu yerga yoziladi.
+    """
+    def on_sent(warn_msg):
+        schedule_message_delete(chat_id, warn_msg.message_id)
+        if track is not None:
+            _warn_put(track[0], track[1], warn_msg.message_id)
+
+    return OUTBOX.submit(
+        chat_id, PRIO_WARN,
+        partial(bot.send_message, chat_id=chat_id, text=text, **kwargs),
+        droppable=True, on_result=on_sent,
+    )
+
+async def load_pending_deletes():
+    """Restart'dan keyin DB'dagi o'chirilmagan ogohlantirishlarni navbatga qaytarish."""
+    if not DB_POOL:
+        return
     try:
-        await msg.delete()
+        async with db_conn() as con:
+            rows = await con.fetch("SELECT chat_id, message_id, delete_at FROM pending_deletes;")
+    except Exception as e:
+        log.warning("load_pending_deletes xatolik: %s", e)
+        return
+    rows = [r for r in rows if owns_chat(int(r["chat_id"]))]
+    for r in rows:
+        heapq.heappush(_PENDING_DELETES, (r["delete_at"].timestamp(), int(r["chat_id"]), int(r["message_id"])))
+    if rows:
+        log.info("pending_deletes: %s ta ogohlantirish navbatga qaytarildi.", len(rows))
+
+async def pending_deletes_job(context: ContextTypes.DEFAULT_TYPE):
+    await process_pending_deletes(context.bot)
+
+async def process_pending_deletes(bot):
+    """Muddati kelgan ogohlantirishlarni chat bo'yicha bulk o'chirish, yangilarini DB'ga yozish."""
+    new_rows = _PENDING_DELETES_NEW[:]
+    _PENDING_DELETES_NEW.clear()
+
+    now = time.time()
+    due: dict[int, list[int]] = defaultdict(list)
+    while _PENDING_DELETES and _PENDING_DELETES[0][0] <= now:
+        _, chat_id, message_id = heapq.heappop(_PENDING_DELETES)
+        due[chat_id].append(message_id)
+
+    chunks: list[tuple[int, list[int]]] = []
+    for chat_id, ids in due.items():
+        for i in range(0, len(ids), _DELETE_BATCH_MAX):
+            chunks.append((chat_id, ids[i:i + _DELETE_BATCH_MAX]))
+    results = await asyncio.gather(
+        *(outbox_action(chat_id, partial(bot.delete_messages, chat_id=chat_id, message_ids=chunk))
+          for chat_id, chunk in chunks),
+        return_exceptions=True
+    )
+
+    done: list[tuple[int, list[int]]] = []
+    for (chat_id, chunk), res in zip(chunks, results):
+        if isinstance(res, RetryAfter):
+            # Keyinroq qayta urinamiz (DB'dagi qator joyida qoladi)
+            retry_at = time.time() + _retry_after_seconds(res)
+            for mid in chunk:
+                heapq.heappush(_PENDING_DELETES, (retry_at, chat_id, mid))
+            continue
+        # Boshqa xato: xabar allaqachon o'chirilgan yoki huquq yo'q — qayta urinish foydasiz
+        done.append((chat_id, chunk))
+
+    if not DB_POOL:
+        if _db_attaching():
+            # Pool hali ulanmoqda: yangi qatorlar keyingi tick'gacha xotirada
+            _PENDING_DELETES_NEW[:0] = new_rows
+        return
+    if not (new_rows or done):
+        return
+    if not db_ready():
+        # Breaker ochiq: yangi qatorlar xotirada kutadi, o'chirishlar replay navbatiga
+        _PENDING_DELETES_NEW[:0] = new_rows
+        for chat_id, chunk in done:
+            await db_write("pending_deletes", "DELETE FROM pending_deletes WHERE chat_id=$1 AND message_id = ANY($2::BIGINT[]);", chat_id, chunk)
+        return
+    try:
+        async with db_conn() as con:
+            async with con.transaction():
+                if new_rows:
+                    await con.executemany(
+                        "INSERT INTO pending_deletes (chat_id, message_id, delete_at) VALUES ($1,$2,$3) ON CONFLICT DO NOTHING;",
+                        new_rows
+                    )
+                for chat_id, chunk in done:
+                    await con.execute(
+                        "DELETE FROM pending_deletes WHERE chat_id=$1 AND message_id = ANY($2::BIGINT[]);",
+                        chat_id, chunk
+                    )
+    except Exception as e:
+        # Yozilmagan qatorlar yo'qolmasin — keyingi tick'da qayta urinamiz
+        if _is_transient_db_error(e):
+            _PENDING_DELETES_NEW[:0] = new_rows
+        log.warning("pending_deletes(DB) xatolik: %s", e)
+
+# --------- O'chirishlarni micro-batch qilish (delete_messages) ----------
+# Handler'lar xabarni darhol o'chirmaydi: ID chat navbatiga qo'shiladi va DELETE_BATCH_WINDOW_MS
+# ichida yig'ilganlar bitta delete_messages (100 tagacha) chaqiruvi bilan o'chiriladi.
+# Kirdi-chiqdi to'lqinlari va spam hujumlarida API chaqiruvlari keskin kamayadi.
+DELETE_BATCH_WINDOW_MS = int(os.getenv("DELETE_BATCH_WINDOW_MS", "150"))
+
+class _DeleteBatcher:
+    def __init__(self, window_sec: float):
+        self._window = window_sec
+        self._pending: dict[int, list[int]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self.stats = {"ids": 0, "calls": 0}
+
+    def add(self, bot, chat_id: int, message_id: int):
+        self._pending.setdefault(chat_id, []).append(message_id)
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = _detached_task(self._flush_later(bot, chat_id))
+
+    async def _flush_later(self, bot, chat_id: int):
+        ids: list[int] = []
+        try:
+            await asyncio.sleep(self._window)
+        finally:
+            # flush_all bizni bekor qilib, chatni allaqachon olgan bo'lsa — undan keyin
+            # qo'shilgan yangi task/ID'larga tegmaymiz
+            if self._tasks.get(chat_id) is asyncio.current_task():
+                self._tasks.pop(chat_id, None)
+                ids = self._pending.pop(chat_id, [])
+        await self._delete(bot, chat_id, ids)
+
+    async def _delete(self, bot, chat_id: int, ids: list[int]):
+        ids = list(dict.fromkeys(ids))
+        futs = []
+        for i in range(0, len(ids), _DELETE_BATCH_MAX):
+            chunk = ids[i:i + _DELETE_BATCH_MAX]
+            self.stats["calls"] += 1
+            self.stats["ids"] += len(chunk)
+            # RetryAfter qayta urinishlari OUTBOX ichida; boshqa xatolar (allaqachon o'chirilgan) e'tiborsiz
+            futs.append(outbox_action(chat_id, partial(bot.delete_messages, chat_id=chat_id, message_ids=chunk)))
+        await asyncio.gather(*futs, return_exceptions=True)
+
+    async def flush_all(self, bot):
+        """Kutilayotgan hamma o'chirishlarni darhol bajarish (shutdown uchun)."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        pending, self._pending = self._pending, {}
+        self._tasks = {}
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for chat_id, ids in pending.items():
+            await self._delete(bot, chat_id, ids)
+
+DELETE_BATCHER = _DeleteBatcher(DELETE_BATCH_WINDOW_MS / 1000.0)
+
+def queue_delete(bot, chat_id: int, message_id: int):
+    # Albom vakili o'chirilsa — albomning hamma qismi shu batch'ga qo'shiladi
+    siblings = _ALBUM_SIBLINGS.get(_pk(chat_id, message_id))
+    for mid in siblings or (message_id,):
+        DELETE_BATCHER.add(bot, chat_id, mid)
+
+# O'chirish endi asinxron, shuning uchun "o'chira olmadik" natijasini handler ko'rmaydi.
+# Botning o'chirish huquqi alohida keshlanadi (my_chat_member push'lari bilan yangilanadi).
+_BOT_CAN_DELETE: dict[int, tuple[bool, float]] = {}  # chat_id -> (o'chira oladimi, tekshirilgan monotonic)
+_BOT_CAN_DELETE_TTL_SEC = int(os.getenv("BOT_CAN_DELETE_TTL_SEC", "600"))
+
+def _member_can_delete(member) -> bool:
+    st = getattr(member, "status", None)
+    if st == ChatMemberStatus.OWNER:
+        return True
+    return st == ChatMemberStatus.ADMINISTRATOR and bool(getattr(member, "can_delete_messages", False))
+
+async def bot_can_delete(bot, chat_id: int) -> bool:
+    cached = _BOT_CAN_DELETE.get(chat_id)
+    if cached and time.monotonic() - cached[1] < _BOT_CAN_DELETE_TTL_SEC:
+        return cached[0]
+    try:
+        ok = _member_can_delete(await bot.get_chat_member(chat_id, bot.id))
     except Exception:
-        pass
+        # Tekshirib bo'lmadi — eski xatti-harakat: o'chirishga urinamiz
+        return True
+    _BOT_CAN_DELETE[chat_id] = (ok, time.monotonic())
+    return ok
+
+# --------- Albomlar (media_group_id): bitta birlik sifatida moderatsiya ----------
+# 10 ta rasmli albom 10 ta alohida update bo'lib keladi. album_gate ularni ALBUM_WINDOW_MS
+# davomida yig'ib, filtrlarni faqat bitta vakil xabar uchun ishlatadi: imtiyoz/kanal
+# tekshiruvi va ogohlantirish bir marta, o'chirish esa hamma qismlar uchun bitta
+# delete_messages chaqiruvi bilan.
+ALBUM_WINDOW_MS = int(os.getenv("ALBUM_WINDOW_MS", "800"))
+
+_ALBUM_BUFFERS: dict[tuple[int, str], tuple[ContextTypes.DEFAULT_TYPE, list[Update]]] = {}
+_ALBUM_SIBLINGS: dict[int, tuple[int, ...]] = {}  # _pk(chat_id, vakil message_id) -> albom message_id'lari
+_ALBUM_TASKS: set = set()
+
+async def album_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    if not msg or not msg.media_group_id:
+        return
+    key = (msg.chat_id, msg.media_group_id)
+    buf = _ALBUM_BUFFERS.get(key)
+    if buf is None:
+        _ALBUM_BUFFERS[key] = (context, [update])
+        task = _detached_task(_moderate_album_later(key))
+        _ALBUM_TASKS.add(task)
+        task.add_done_callback(_ALBUM_TASKS.discard)
+    else:
+        buf[1].append(update)
+    # Qolgan filtrlar albom uchun _moderate_album ichida bir marta ishlaydi
+    raise ApplicationHandlerStop
+
+async def _moderate_album_later(key: tuple[int, str]):
+    await asyncio.sleep(ALBUM_WINDOW_MS / 1000.0)
+    # Albom moderatsiyasi alohida trace (update_id o'rniga "album:<media_group_id>")
+    tr = _Trace(f"album:{key[1]}") if TRACE_ENABLED else None
+    _TRACE.set(tr)
+    try:
+        await _moderate_album(key)
+    finally:
+        if tr is not None:
+            tr.finish()
+
+async def _moderate_album(key: tuple[int, str]):
+    buf = _ALBUM_BUFFERS.pop(key, None)
+    if not buf:
+        return
+    context, updates = buf
+    chat_id = key[0]
+    # Vakil: har bir qismning izohi alohida bo'lishi mumkin — kontent tekshiruvidan o'tmagan
+    # birinchi qism (filtr butun albomni o'chiradi); bo'lmasa izohli qism yoki birinchisi
+    rep_update = next(
+        (u for u in updates if content_verdict(u.effective_message) is not None),
+        None,
+    ) or next((u for u in updates if u.effective_message.caption), updates[0])
+    rep_key = _pk(chat_id, rep_update.effective_message.message_id)
+    _ALBUM_SIBLINGS[rep_key] = tuple(u.effective_message.message_id for u in updates)
+    try:
+        for handler in (majbur_filter, reklama_va_soz_filtri):
+            try:
+                await handler(rep_update, context)
+            except Exception as e:
+                log.warning("Albom moderatsiyasi xatolik (%s): %s", handler.__name__, e)
+    finally:
+        _ALBUM_SIBLINGS.pop(rep_key, None)
+
+async def flush_albums():
+    """Yig'ilayotgan albomlarni kutmasdan moderatsiya qilish (shutdown uchun)."""
+    for task in list(_ALBUM_TASKS):
+        task.cancel()
+    for key in list(_ALBUM_BUFFERS):
+        await _moderate_album(key)
+
+# --------- Janitor: in-memory lug'atlarni davriy tozalash ----------
+async def janitor_job(context: ContextTypes.DEFAULT_TYPE):
+    """Muddati o'tgan bloklar, eski ogohlantirish ID'lari va memo yozuvlarini o'chiradi."""
+    LOG_LIMITER.flush(log)
+    now_dt = datetime.now(timezone.utc)
+    expired = [k for k, until in BLOK_VAQTLARI.items() if not until or until <= now_dt]
+    for k in expired:
+        BLOK_VAQTLARI.pop(k, None)
+
+    # Ogohlantirishlar dict'i yuborilgan vaqt bo'yicha tartiblangan: birinchi yangi yozuvda to'xtaymiz
+    cutoff = int(time.time() - WARN_MSG_TTL_SEC) << 32
+    evicted_warn = 0
+    for d in (MAJBUR_WARN_MSG_IDS, KANAL_WARN_MSG_IDS):
+        old = []
+        for k, v in d.items():
+            if v >= cutoff:
+                break
+            old.append(k)
+        for k in old:
+            del d[k]
+        evicted_warn += len(old)
+
+    mono = time.monotonic()
+    # Breaker ochiq paytda memo — DB o'rnini bosuvchi yagona manba, uni tozalamaymiz
+    stale = [] if DB_BREAKER.state != DB_BREAKER.CLOSED else [k for k, v in _MOD_CTX_MEMO.items() if (mono - v[0]) >= _MOD_CTX_TTL_SEC]
+    for k in stale:
+        _MOD_CTX_MEMO.pop(k, None)
+    OUTBOX.prune()
+
+    verified_total = sum(len(v) for v in _GROUP_VERIFIED_MEM.values())
+    evicted_verified = 0
+    for cid in list(_GROUP_VERIFIED_MEM):
+        if verified_total <= GROUP_VERIFIED_MAX:
+            break
+        n = len(_GROUP_VERIFIED_MEM.pop(cid, ()))
+        verified_total -= n
+        evicted_verified += n
+    if evicted_verified:
+        log.info("Janitor: %s ta verified yozuvi tashlandi (limit=%s).", evicted_verified, GROUP_VERIFIED_MAX)
+
+    if expired or evicted_warn:
+        log.info(
+            "Janitor: %s ta blok, %s ta ogohlantirish tozalandi (qoldi: blok=%s, warn=%s).",
+            len(expired), evicted_warn, len(BLOK_VAQTLARI),
+            len(MAJBUR_WARN_MSG_IDS) + len(KANAL_WARN_MSG_IDS),
+        )
+
+# --------- Warm restart: in-memory cache'larning diskdagi snapshot'i ----------
+# Redeploy'dan keyin cache'lar bo'sh bo'lgani uchun birinchi daqiqalarda DB va Bot API
+# ortiqcha yuklanadi; DB'siz rejimda esa hisob/imtiyozlar umuman yo'qoladi. Shuning uchun
+# asosiy cache'lar shutdown'da va davriy ravishda gzip JSON faylga yoziladi va startda
+# qayta yuklanadi. Versiya mos kelmasa yoki fayl SNAPSHOT_MAX_AGE_SEC dan eski bo'lsa
+# (DB'siz rejimdan tashqari — u yerda snapshot yagona manba) yuklanmaydi.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "cache_snapshot.json.gz")  # "" — o'chirish
+SNAPSHOT_INTERVAL_SEC = int(os.getenv("SNAPSHOT_INTERVAL_SEC", "300"))
+SNAPSHOT_MAX_AGE_SEC = int(os.getenv("SNAPSHOT_MAX_AGE_SEC", str(6 * 3600)))
+_SNAPSHOT_VERSION = 1
+
+def _memory_is_authoritative() -> bool:
+    # Na Postgres, na SQLite: snapshot'dagi hisob/imtiyozlarning boshqa manbasi yo'q
+    return not _get_db_url() and not SQLITE_PATH
+
+def _build_snapshot() -> dict:
+    now_dt = datetime.now(timezone.utc)
+    return {
+        "version": _SNAPSHOT_VERSION,
+        "written_at": time.time(),
+        "settings": [
+            [cid, {f.name: getattr(gs, f.name) for f in dataclasses.fields(gs) if f.init}]
+            for cid, (gs, _) in _GROUP_SETTINGS_CACHE.items()
+        ],
+        "privs": [[cid, sorted(uids)] for cid, uids in _GROUP_PRIV_MEM.items() if uids],
+        "verified": [[cid, sorted(uids)] for cid, uids in _GROUP_VERIFIED_MEM.items() if uids],
+        "pending": [[cid, sorted(uids)] for cid, uids in _GROUP_PENDING_MEM.items() if uids],
+        "counts": [[cid, list(m.items())] for cid, m in _GROUP_COUNTS_MEM.items() if m],
+        "linked": list(_GROUP_LINKED_ID_CACHE.items()),
+        "blocks": [[k, until.timestamp()] for k, until in BLOK_VAQTLARI.items() if until and until > now_dt],
+        "warn_majbur": list(MAJBUR_WARN_MSG_IDS.items()),
+        "warn_kanal": list(KANAL_WARN_MSG_IDS.items()),
+        "tun_perms": list(_TUN_SAVED_PERMS_MEM.items()),
+    }
+
+def _write_snapshot_file(data: dict):
+    tmp = SNAPSHOT_PATH + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, SNAPSHOT_PATH)
+
+async def save_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    try:
+        data = _build_snapshot()  # event loop'da — tuzilmalar izchil holatda olinadi
+        await asyncio.to_thread(_write_snapshot_file, data)
+    except Exception as e:
+        log.warning("Snapshot yozishda xatolik: %s", e)
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    await save_snapshot()
+
+def load_snapshot():
+    """Startda (DB ulanishidan oldin) cache'larni snapshot'dan tiklash."""
+    if not SNAPSHOT_PATH or not os.path.exists(SNAPSHOT_PATH):
+        return
+    try:
+        with gzip.open(SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception as e:
+        log.warning("Snapshot o'qilmadi: %s", e)
+        return
+    if data.get("version") != _SNAPSHOT_VERSION:
+        log.warning("Snapshot versiyasi mos emas (%s) — e'tiborsiz qoldirildi.", data.get("version"))
+        return
+    age = time.time() - float(data.get("written_at") or 0)
+    if age > SNAPSHOT_MAX_AGE_SEC and not _memory_is_authoritative():
+        log.warning("Snapshot eskirgan (%.0f s) — e'tiborsiz qoldirildi.", age)
+        return
+
+    mono = time.monotonic()
+    for cid, fields in data.get("settings", []):
+        _GROUP_SETTINGS_CACHE[int(cid)] = (GroupSettings(**fields), mono)
+    for key, target in (("privs", _GROUP_PRIV_MEM), ("verified", _GROUP_VERIFIED_MEM), ("pending", _GROUP_PENDING_MEM)):
+        for cid, uids in data.get(key, []):
+            target[int(cid)].update(int(u) for u in uids)
+    for cid, items in data.get("counts", []):
+        for uid, cnt in items:
+            _GROUP_COUNTS_MEM[int(cid)][int(uid)] = int(cnt)
+    for cid, linked in data.get("linked", []):
+        _GROUP_LINKED_ID_CACHE[int(cid)] = linked
+    now_ts = time.time()
+    for k, until_ts in data.get("blocks", []):
+        if until_ts > now_ts:
+            BLOK_VAQTLARI[int(k)] = datetime.fromtimestamp(until_ts, timezone.utc)
+    # Ogohlantirish dict'lari yuborilgan vaqt bo'yicha tartibda bo'lishi kerak (janitor shunga tayanadi)
+    for key, target in (("warn_majbur", MAJBUR_WARN_MSG_IDS), ("warn_kanal", KANAL_WARN_MSG_IDS)):
+        for k, v in sorted(data.get(key, []), key=lambda kv: kv[1]):
+            target[int(k)] = int(v)
+    for cid, perms in data.get("tun_perms", []):
+        _TUN_SAVED_PERMS_MEM[int(cid)] = perms
+    log.info(
+        "Snapshot yuklandi (%.0f s oldin): %s ta guruh sozlamasi, %s ta blok.",
+        age, len(_GROUP_SETTINGS_CACHE), len(BLOK_VAQTLARI),
+    )
+
+# --------- Graceful shutdown ----------
+# SIGTERM/SIGINT: yangi update'lar qabul qilinmaydi (stop_running), broadcast'lar yangi
+# chat'larga yubormay to'xtaydi, PTB ishlayotgan handler'larni kutadi. So'ng post_stop
+# SHUTDOWN_DEADLINE_SEC ichida buferlarni bo'shatadi (albomlar, o'chirishlar, OUTBOX
+# amallari, ogohlantirish navbati, DB replay), post_shutdown esa snapshot yozib pool'ni yopadi.
+SHUTDOWN_DEADLINE_SEC = float(os.getenv("SHUTDOWN_DEADLINE_SEC", "8"))
+_SHUTTING_DOWN = asyncio.Event()
+
+def _request_shutdown(app):
+    if _SHUTTING_DOWN.is_set():
+        return
+    log.info("To'xtash signali: update qabul qilish to'xtatildi, navbatlar bo'shatilmoqda.")
+    _SHUTTING_DOWN.set()
+    if WORKER_INDEX is None:
+        app.stop_running()
+    # Worker rejimida _run_worker navbatni front'ning None sentinel'igacha bo'shatadi
+
+def install_signal_handlers(app):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, _request_shutdown, app)
+        except (NotImplementedError, RuntimeError):
+            # Windows: KeyboardInterrupt'ni PTB o'zi ushlaydi
+            pass
+
+async def post_stop(app):
+    _SHUTTING_DOWN.set()
+    deadline = time.monotonic() + SHUTDOWN_DEADLINE_SEC
+
+    async def step(name: str, make_coro):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            log.warning("Shutdown: %s o'tkazib yuborildi (deadline).", name)
+            return
+        try:
+            await asyncio.wait_for(make_coro(), left)
+        except Exception as e:
+            log.warning("Shutdown: %s xatolik: %r", name, e)
+
+    await step("albomlar", flush_albums)
+    await step("o'chirish batch'i", lambda: DELETE_BATCHER.flush_all(app.bot))
+    # Cheklash/o'chirish amallari muhimroq: yuborilmagan ogohlantirishlar tashlanadi
+    OUTBOX.drop_droppable()
+    await step("outbox", lambda: OUTBOX.drain(max(0.0, deadline - time.monotonic())))
+    await step("oldindan cheklashlar", lambda: asyncio.gather(*list(_PRE_RESTRICT_TASKS), return_exceptions=True))
+    await step("pending_deletes", lambda: process_pending_deletes(app.bot))
+    if DB_POOL:
+        await step("db replay", replay_db_writes)
+        await step("guruh sozlamalari", _flush_dirty_group_settings)
+    log.info(
+        "Shutdown: navbatlar bo'shatildi (outbox=%s, replay=%s).",
+        OUTBOX.depth(), len(_DB_REPLAY),
+    )
 
 # --------- Override post_init to also init group tables ----------
 async def noop_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2720,12 +5353,14 @@ async def set_commands(app):
             BotCommand("replycount", "(reply) foydalanuvchi nechta qo‘shganini ko‘rish"),
             BotCommand("majbur", "Majburiy odam limitini (3–30) o‘rnatish"),
             BotCommand("majburoff", "Majburiy qo‘shishni o‘chirish"),
+            BotCommand("majburpre", "Yangi a’zolarni limitgacha cheklash (on/off)"),
             BotCommand("cleangroup", "Hamma hisobini 0 qilish"),
             BotCommand("cleanuser", "(reply) foydalanuvchi hisobini 0 qilish"),
             BotCommand("ruxsat", "(reply) imtiyoz berish"),
             BotCommand("ruxsatoff", "(reply) imtiyozni olib qo‘yish"),
             BotCommand("kanal", "Majburiy kanalni sozlash"),
             BotCommand("kanaloff", "Majburiy kanalni o‘chirish"),
+            BotCommand("kanaljoin", "Kirish so‘rovlarini kanal bo‘yicha tekshirish (on/off)"),
             BotCommand("tun", "Tun rejimini yoqish"),
             BotCommand("tunoff", "Tun rejimini o‘chirish"),
             BotCommand("broadcast", "Barcha DM foydalanuvchilarga matn yuborish (owner)"),
@@ -2736,21 +5371,266 @@ async def set_commands(app):
         scope=BotCommandScopeAllPrivateChats()
     )
 
+_DB_ATTACH_TASK: asyncio.Task | None = None
+
+async def _attach_db(app):
+    """Fon vazifasi: pool ochilgach DB'ga bog'liq yuklashlarni bajarish."""
+    try:
+        await init_db(app)
+        if not DB_POOL:
+            return
+        await _flush_dirty_group_settings()
+        # Cache-only oynadagi imtiyoz/blok/hisob/pending yozishlari — tartib bilan
+        await replay_db_writes()
+        await load_pending_deletes()
+        await load_tun_schedules(app)
+    except Exception as e:
+        log.warning("DB ulash xatolik: %s", e)
+    finally:
+        if not DB_POOL and _DB_REPLAY:
+            log.warning("DB ulanmadi: cache-only oynadagi %s ta yozish tashlab yuborildi.", len(_DB_REPLAY))
+            _DB_REPLAY.clear()
+
 async def post_init(app):
-    await init_db(app)
-    await set_commands(app)
+    global _DB_ATTACH_TASK, _APP_LOOP
+    _APP_LOOP = asyncio.get_running_loop()
+    install_signal_handlers(app)
+    init_cache_tier()
+    load_snapshot()
+    # Polling darhol boshlanadi; Postgres fonda ulanadi (shu paytgacha cache-only)
+    _DB_ATTACH_TASK = asyncio.get_running_loop().create_task(_attach_db(app))
+    if not WORKER_INDEX:
+        await set_commands(app)
+
+async def post_shutdown(app):
+    global DB_POOL
+    await save_snapshot()
+    if CACHE_L2 is not None:
+        CACHE_L2.close()
+    if _DB_ATTACH_TASK and not _DB_ATTACH_TASK.done():
+        _DB_ATTACH_TASK.cancel()
+    pool, DB_POOL = DB_POOL, None
+    if pool is not None:
+        try:
+            await asyncio.wait_for(pool.close(), 5)
+        except Exception as e:
+            log.warning("DB pool yopishda xatolik: %r", e)
+            if hasattr(pool, "terminate"):
+                pool.terminate()
+        log.info("DB pool yopildi.")
+
+
+# --------- Multi-worker: webhook front + chat_id bo'yicha shard qilingan worker'lar ----------
+# WORKERS=N (N>1): asosiy jarayon faqat webhook qabul qiladi va update'ni chat_id'ning
+# jump consistent hash'i bo'yicha N ta worker jarayonidan biriga yuboradi. Bitta chat har
+# doim bitta worker'ga tushadi, shuning uchun har bir worker faqat o'z chat'lari uchun
+# in-memory cache'larni ushlaydi; umumiy holat Postgres'da. N o'zgarsa chat'larning
+# atigi ~1/N qismi boshqa worker'ga ko'chadi. Istisno — kanal chat_member/my_chat_member
+# push'lari: majburiy kanal har qanday worker'dagi guruhda tekshiriladi, shuning uchun
+# ular hamma worker'ga yuboriladi (har birida o'z _CHANNEL_INDEX'i).
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+WORKER_QUEUE_MAX = int(os.getenv("WORKER_QUEUE_MAX", "10000"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or (
+    f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}" if os.getenv("RAILWAY_PUBLIC_DOMAIN") else None
+)
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(24)
+
+WORKER_INDEX: int | None = None  # worker jarayonida: 0..N-1
+WORKER_COUNT = 1
+_FRONT_QUEUES: list = []
+
+def _jump_hash(key: int, buckets: int) -> int:
+    """Lamping–Veach jump consistent hash."""
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
+
+def owns_chat(chat_id: int) -> bool:
+    return WORKER_COUNT <= 1 or _jump_hash(chat_id, WORKER_COUNT) == WORKER_INDEX
+
+def _update_chat_id(data: dict) -> int:
+    """Xom update JSON'idan shard kaliti: chat id, bo'lmasa foydalanuvchi id."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post",
+                "my_chat_member", "chat_member", "chat_join_request"):
+        obj = data.get(key)
+        if isinstance(obj, dict) and "chat" in obj:
+            return int(obj["chat"]["id"])
+    cq = data.get("callback_query")
+    if isinstance(cq, dict):
+        if isinstance(cq.get("message"), dict):
+            return int(cq["message"]["chat"]["id"])
+        return int(cq.get("from", {}).get("id", 0))
+    for obj in data.values():
+        if isinstance(obj, dict) and isinstance(obj.get("from"), dict):
+            return int(obj["from"]["id"])
+    return 0
+
+def _is_channel_member_update(data: dict) -> bool:
+    # Kanal a'zoligi push'lari (_CHANNEL_INDEX) har bir worker'ning o'z indeksiga kerak
+    for key in ("chat_member", "my_chat_member"):
+        obj = data.get(key)
+        if isinstance(obj, dict) and isinstance(obj.get("chat"), dict):
+            return obj["chat"].get("type") == "channel"
+    return False
+
+@app_flask.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    if not _FRONT_QUEUES:
+        # Shutdown yoki polling rejimi: Telegram keyinroq qayta yuboradi
+        return "", 503
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return "", 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return "", 400
+    queues = _FRONT_QUEUES
+    if _is_channel_member_update(data):
+        targets = list(queues)
+    else:
+        targets = [queues[_jump_hash(_update_chat_id(data), len(queues))]]
+    try:
+        for q in targets:
+            q.put(data, timeout=2)
+    except queue.Full:
+        log.warning("Worker navbati to'la — update Telegram tomonidan qayta yuboriladi.")
+        return "", 503
+    return "", 200
+
+def _queue_get(q):
+    try:
+        return q.get(timeout=1)
+    except queue.Empty:
+        return queue.Empty
+
+async def _run_worker(q):
+    app = build_app(new_app_builder().updater(None))
+    loop = asyncio.get_running_loop()
+    # Bir nechta reader bloklanib qolmasin: navbat uchun alohida thread
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="worker-queue")
+    await app.initialize()
+    try:
+        await post_init(app)
+        await app.start()
+        # Signal kelsa ham navbatdagi update'lar yo'qolmasin: front None sentinel
+        # yuborguncha (yoki SHUTDOWN_DEADLINE_SEC tugaguncha) o'qishda davom etamiz
+        drain_until = None
+        while True:
+            if _SHUTTING_DOWN.is_set():
+                if drain_until is None:
+                    drain_until = time.monotonic() + SHUTDOWN_DEADLINE_SEC
+                elif time.monotonic() >= drain_until:
+                    log.warning("Worker %s: navbat deadline ichida bo'shamadi.", WORKER_INDEX)
+                    break
+            data = await loop.run_in_executor(reader, _queue_get, q)
+            if data is queue.Empty:
+                continue
+            if data is None:
+                break
+            try:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+            except Exception as e:
+                log.warning("Worker %s: update parse xatolik: %s", WORKER_INDEX, e)
+    finally:
+        _SHUTTING_DOWN.set()
+        if app.running:
+            await app.stop()
+        await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+        reader.shutdown(wait=False)
+
+def worker_main(index: int, count: int, q):
+    global WORKER_INDEX, WORKER_COUNT, SNAPSHOT_PATH
+    WORKER_INDEX, WORKER_COUNT = index, count
+    if SNAPSHOT_PATH:
+        SNAPSHOT_PATH = f"{SNAPSHOT_PATH}.w{index}"
+    # Bot API global limiti barcha worker'lar o'rtasida bo'linadi
+    rate = OUTBOX_GLOBAL_RATE / count
+    OUTBOX._global = _TokenBucket(rate, max(1.0, rate))
+    log.info("Worker %s/%s ishga tushdi (pid=%s).", index, count, os.getpid())
+    asyncio.run(_run_worker(q))
+
+async def _set_webhook():
+    from telegram import Bot
+    async with Bot(TOKEN) as bot:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=100,
+        )
+
+def run_front(count: int):
+    if not WEBHOOK_URL:
+        raise RuntimeError("WORKERS>1 uchun WEBHOOK_URL (yoki RAILWAY_PUBLIC_DOMAIN) kerak.")
+    if not _get_db_url():
+        raise RuntimeError("WORKERS>1 uchun umumiy Postgres (DATABASE_URL) kerak — SQLite jarayonlararo ishlamaydi.")
+    if CACHE_BACKEND in ("auto", "shared"):
+        start_cache_server()
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=WORKER_QUEUE_MAX) for _ in range(count)]
+
+    def spawn(i: int):
+        p = ctx.Process(target=worker_main, args=(i, count, queues[i]), name=f"worker-{i}")
+        p.start()
+        return p
+
+    procs = [spawn(i) for i in range(count)]
+    _FRONT_QUEUES[:] = queues
+    if not any(t.name == "web" for t in threading.enumerate()):
+        threading.Thread(target=run_web, daemon=True, name="web").start()
+    asyncio.run(_set_webhook())
+    log.info("Webhook o'rnatildi: %s%s → %s ta worker.", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH, count)
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    while not stop.wait(5):
+        for i, p in enumerate(procs):
+            if not p.is_alive():
+                log.warning("Worker %s to'xtab qoldi (exit=%s) — qayta ishga tushirilmoqda.", i, p.exitcode)
+                procs[i] = spawn(i)
+
+    # Yangi update'lar 503 oladi (Telegram qayta yuboradi), worker'lar navbatini tugatadi
+    _FRONT_QUEUES.clear()
+    for q in queues:
+        with contextlib.suppress(Exception):
+            q.put(None, timeout=1)
+    deadline = time.monotonic() + SHUTDOWN_DEADLINE_SEC + 10
+    for p in procs:
+        p.join(max(0.0, deadline - time.monotonic()))
+        if p.is_alive():
+            log.warning("%s deadline ichida to'xtamadi — terminate.", p.name)
+            p.terminate()
 
 
 def main():
     start_web()
 
-    log.info("Bot start: polling mode (Railway).")
+    log.info("Bot start: %s (Railway).", f"webhook front + {WORKERS} worker" if WORKERS > 1 else "polling mode")
     if os.getenv("DATABASE_URL") or os.getenv("INTERNAL_DATABASE_URL") or os.getenv("DATABASE_INTERNAL_URL") or os.getenv("DB_URL"):
         log.info("DB: Postgres URL topildi (asyncpg pool init qilinadi).")
     else:
-        log.warning("DB: DATABASE_URL topilmadi (DM ro'yxat JSON fallback). Railway'da Postgres ulasangiz, Variables ga DATABASE_URL qo'ying.")
+        log.warning("DB: DATABASE_URL topilmadi (SQLite fallback: %s). Railway'da Postgres ulasangiz, Variables ga DATABASE_URL qo'ying.", SQLITE_PATH or "o'chirilgan")
+
+    if not TOKEN:
+        raise RuntimeError("TOKEN env o'rnatilmagan. Railway Variables ga TOKEN=... qo'ying.")
+    if WORKERS > 1:
+        return run_front(WORKERS)
+    app = build_app(new_app_builder())
+
+    # Signal'lar install_signal_handlers orqali: avval intake to'xtaydi, keyin navbatlar bo'shatiladi
+    app.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
+
 
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_app(builder):
+    """Handler'lar, davriy ishlar va hook'lar — polling va worker rejimi uchun umumiy."""
+    app = builder.build()
 
     # Commands
     app.add_handler(CommandHandler("start", start))
@@ -2762,8 +5642,10 @@ def main():
     app.add_handler(CommandHandler("ruxsatoff", ruxsatoff))
     app.add_handler(CommandHandler("kanal", kanal))
     app.add_handler(CommandHandler("kanaloff", kanaloff))
+    app.add_handler(CommandHandler("kanaljoin", kanaljoin))
     app.add_handler(CommandHandler("majbur", majbur))
     app.add_handler(CommandHandler("majburoff", majburoff))
+    app.add_handler(CommandHandler("majburpre", majburpre))
     app.add_handler(CommandHandler("top", top_cmd))
     app.add_handler(CommandHandler("cleangroup", cleangroup))
     app.add_handler(CommandHandler("count", count_cmd))
@@ -2775,8 +5657,9 @@ def main():
     app.add_handler(CommandHandler("broadcastpost", broadcastpost))
 
     # GROUP broadcast (owner only)
-    app.add_handler(CommandHandler("broadcastgroup", broadcastgroup))
-    app.add_handler(CommandHandler("broadcastpostgroup", broadcastpostgroup))
+    # block=False: uzoq broadcast moderatsiya update'larini to'xtatib qo'ymasin
+    app.add_handler(CommandHandler("broadcastgroup", broadcastgroup, block=False))
+    app.add_handler(CommandHandler("broadcastpostgroup", broadcastpostgroup, block=False))
 
     # Callbacks
     app.add_handler(CallbackQueryHandler(on_set_limit, pattern=r"^set_limit:"))
@@ -2786,19 +5669,131 @@ def main():
     app.add_handler(CallbackQueryHandler(noop_cb, pattern=r"^noop$"))
 
     # Events & Filters
+    app.add_handler(ChatMemberHandler(on_my_status, ChatMemberHandler.MY_CHAT_MEMBER))
+    app.add_handler(ChatMemberHandler(on_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(ChatJoinRequestHandler(on_join_request))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, on_new_members))
     app.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, on_left_member))
     media_filters = (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.Document.ALL | filters.ANIMATION | filters.VOICE | filters.VIDEO_NOTE | filters.GAME)
+    # MessageHandler edited_message'larni ham oladi: yangi xabar filtrlari faqat MESSAGE uchun,
+    # tahrirlar esa on_edited_message orqali (faqat kontent tekshiruvi)
+    new_msg = filters.UpdateType.MESSAGE & media_filters & (~filters.COMMAND)
+    app.add_handler(MessageHandler(filters.ChatType.GROUPS & new_msg, album_gate), group=-4)
     app.add_handler(MessageHandler(filters.ChatType.PRIVATE, track_private), group=-3)
-    app.add_handler(MessageHandler(media_filters & (~filters.COMMAND), majbur_filter), group=-2)
-    app.add_handler(MessageHandler(media_filters & (~filters.COMMAND), reklama_va_soz_filtri), group=-1)
+    app.add_handler(MessageHandler(new_msg, majbur_filter), group=-2)
+    app.add_handler(MessageHandler(new_msg, reklama_va_soz_filtri), group=-1)
+    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.EDITED_MESSAGE & media_filters & (~filters.COMMAND), on_edited_message), group=-1)
+
+    # Davriy fon ishlari
+    if app.job_queue:
+        app.job_queue.run_repeating(janitor_job, interval=JANITOR_INTERVAL_SEC, first=JANITOR_INTERVAL_SEC, name="janitor")
+        app.job_queue.run_repeating(pending_deletes_job, interval=WARN_DELETE_TICK_SEC, first=WARN_DELETE_TICK_SEC, name="pending_deletes")
+        app.job_queue.run_repeating(db_replay_job, interval=DB_REPLAY_TICK_SEC, first=DB_REPLAY_TICK_SEC, name="db_replay")
+        if SNAPSHOT_PATH:
+            app.job_queue.run_repeating(snapshot_job, interval=SNAPSHOT_INTERVAL_SEC, first=SNAPSHOT_INTERVAL_SEC, name="snapshot")
+    else:
+        log.warning("JobQueue mavjud emas (python-telegram-bot[job-queue] o'rnatilmagan) — janitor va ogohlantirish avto-o'chirish ishlamaydi.")
 
-    # Post-init hook
+    # Post-init / shutdown hooks
     app.post_init = post_init
+    app.post_stop = post_stop
+    app.post_shutdown = post_shutdown
+    if TRACE_ENABLED:
+        _trace_handlers(app)
+    return app
+
+
+# ---------------------- CLI: export / import ----------------------
+# Hostni ko'chirishda: `python main.py export DIR` va yangi joyda `python main.py import DIR`.
+# Har bir jadval COPY (binary) bilan oqim sifatida yoziladi/o'qiladi — millionlab qator
+# soniyalarda. DIR/manifest.json da jadval ustunlari va qatorlar soni saqlanadi.
+# Import mavjud qatorlarni o'zgartirmaydi (ON CONFLICT DO NOTHING), qayta ishga tushirish xavfsiz.
+_EXPORT_TABLES = (
+    "dm_users", "group_settings", "group_user_counts", "group_privileges",
+    "group_blocks", "group_verified", "group_pending", "pending_deletes",
+)
+
+def _copy_rows(status: str) -> int:
+    # asyncpg COPY/INSERT statusi: "COPY 123" / "INSERT 0 123"
+    try:
+        return int(str(status).split()[-1])
+    except Exception:
+        return 0
+
+async def export_data(out_dir: str):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {"format": "pgcopy-binary", "exported_at": datetime.now(timezone.utc).isoformat(), "tables": {}}
+    async with DB_POOL.acquire() as con:
+        for table in _EXPORT_TABLES:
+            cols = [r["column_name"] for r in await con.fetch(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = $1 ORDER BY ordinal_position;",
+                table
+            )]
+            if not cols:
+                continue
+            t0 = time.monotonic()
+            status = await con.copy_from_query(
+                f"SELECT {', '.join(cols)} FROM {table}",
+                output=os.path.join(out_dir, f"{table}.bin"),
+                format="binary",
+            )
+            manifest["tables"][table] = {"columns": cols, "rows": _copy_rows(status)}
+            log.info("export: %s — %s qator (%.1f s)", table, _copy_rows(status), time.monotonic() - t0)
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+async def import_data(in_dir: str):
+    with open(os.path.join(in_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    async with DB_POOL.acquire() as con:
+        for table in _EXPORT_TABLES:
+            meta = manifest.get("tables", {}).get(table)
+            if not meta:
+                continue
+            cols = ", ".join(meta["columns"])
+            stage = f"_import_{table}"
+            t0 = time.monotonic()
+            async with con.transaction():
+                await con.execute(f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+                await con.copy_to_table(
+                    stage,
+                    source=os.path.join(in_dir, f"{table}.bin"),
+                    columns=meta["columns"],
+                    format="binary",
+                )
+                status = await con.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {stage} ON CONFLICT DO NOTHING;")
+            log.info("import: %s — %s/%s qator qo'shildi (%.1f s)", table, _copy_rows(status), meta.get("rows"), time.monotonic() - t0)
+
+def cli(argv: list[str]) -> int:
+    cmd = argv[0]
+    path = argv[1] if len(argv) > 1 else "export"
+    if not _get_db_url():
+        log.error("%s uchun DATABASE_URL (Postgres) kerak. SQLite uchun faylning o'zini ko'chiring.", cmd)
+        return 2
+
+    async def run() -> int:
+        await init_db(max_attempts=3)
+        if not DB_POOL or isinstance(DB_POOL, _SqlitePool):
+            return 1
+        try:
+            await (export_data if cmd == "export" else import_data)(path)
+        finally:
+            await DB_POOL.close()
+        return 0
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    return asyncio.run(run())
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("export", "import"):
+        sys.exit(cli(sys.argv[1:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "cache-server":
+        # Bir host'dagi alohida replikalar uchun: CACHE_BACKEND=shared bilan ishga tushiring
+        stop_sigs = {signal.SIGINT, signal.SIGTERM}
+        signal.pthread_sigmask(signal.SIG_BLOCK, stop_sigs)
+        start_cache_server(sys.argv[2] if len(sys.argv) > 2 else CACHE_SOCKET)
+        signal.sigwait(stop_sigs)
+        sys.exit(0)
     main()
 
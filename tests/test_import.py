@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_main_imports():
+    pytest.importorskip("telegram")
+    pytest.importorskip("flask")
+    env = dict(os.environ, TOKEN="123:smoke", ENABLE_WEB="0")
+    code = "import main; main._default_group_settings(); main.build_app(main.new_app_builder())"
+    proc = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr